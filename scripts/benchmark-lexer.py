@@ -0,0 +1,79 @@
+"""Compares the speed of the source lexer with and without combined state
+regexes, and checks that both produce the same tokens.
+
+usage: python scripts/benchmark-lexer.py [FILE...]
+
+Without files, the sources of the telepythy package are used.
+
+The speedup depends on the sources and the Python build: between about
+1.2x and 2x has been measured, e.g. 1.6-1.9x on the package sources, and
+1.2-2x on typing.py and argparse.py.
+"""
+
+import os
+import sys
+import glob
+import time
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from telepythy.gui import lexer
+
+REPEAT = 5
+
+def get_sources(paths):
+    if not paths:
+        root = os.path.join(os.path.dirname(__file__), os.pardir, 'telepythy')
+        paths = glob.glob(os.path.join(root, '**', '*.py'), recursive=True)
+
+    sources = []
+    for path in sorted(paths):
+        with open(path, encoding='utf8') as f:
+            sources.append(f.read())
+    return sources
+
+def lex_lines(lex, text):
+    """Lexes *text* one line at a time, as the highlighter does."""
+    tokens = []
+    lex.reset()
+    for line in text.splitlines(True):
+        tokens.extend(lex.get_tokens_unprocessed(line))
+    return tokens
+
+def measure(lex, sources):
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for text in sources:
+            lex_lines(lex, text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    sources = get_sources(sys.argv[1:])
+    size = sum(len(text) for text in sources)
+    lines = sum(text.count('\n') for text in sources)
+    print('{} files, {} lines, {} characters'.format(
+        len(sources), lines, size))
+
+    fast = lexer.Lexer()
+    slow = lexer.Lexer()
+    # try the rules one by one in every state
+    slow._machines = collections.defaultdict(type(None))
+
+    for text in sources:
+        if lex_lines(fast, text) != lex_lines(slow, text):
+            print('tokens differ')
+            return 1
+
+    slow_time = measure(slow, sources)
+    fast_time = measure(fast, sources)
+    print('rules:    {:.3f}s ({:.0f} lines/s)'.format(
+        slow_time, lines / slow_time))
+    print('combined: {:.3f}s ({:.0f} lines/s)'.format(
+        fast_time, lines / fast_time))
+    print('speedup:  {:.2f}x'.format(slow_time / fast_time))
+
+if __name__ == '__main__':
+    sys.exit(main())
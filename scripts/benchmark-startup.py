@@ -0,0 +1,85 @@
+"""Measures how long the service package takes to start a session, with and
+without the precompiled modules.
+
+usage: python scripts/benchmark-startup.py [PYTHON]
+
+The time is measured from starting the process until the service's 'start'
+event is received. PYTHON is the interpreter to start the service with (the
+current one by default).
+"""
+
+import os
+import sys
+import time
+import socket
+import zipfile
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from telepythy import pack
+from telepythy.lib import sockio
+
+REPEAT = 10
+
+def sources_only(src_path, dst_path):
+    """Writes a copy of the package without the pycs, compressed like
+    packages were before they were precompiled."""
+    with zipfile.ZipFile(src_path) as src, open(dst_path, 'wb') as f:
+        f.write(b'#! /usr/bin/env python\n')
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for name in src.namelist():
+                if not name.endswith('.pyc'):
+                    dst.writestr(name, src.read(name))
+
+def start_session(python, path, server):
+    address = '{}:{}'.format(*server.getsockname())
+    start = time.perf_counter()
+    # the service logs an error when the connection is closed
+    proc = subprocess.Popen([python, path, '-c', address],
+        stderr=subprocess.DEVNULL)
+    try:
+        conn, _addr = server.accept()
+        sock = sockio.SockIO(conn)
+        try:
+            while True:
+                msg = sock.recvmsg()
+                if msg is not None and msg['evt'] == 'start':
+                    return time.perf_counter() - start
+        finally:
+            sock.close()
+    finally:
+        proc.kill()
+        proc.wait()
+
+def measure(python, path, server):
+    times = sorted(start_session(python, path, server)
+        for _ in range(REPEAT))
+    return times[0], times[len(times) // 2]
+
+def main():
+    python = sys.argv[1] if len(sys.argv) > 1 else sys.executable
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('localhost', 0))
+    server.listen(1)
+    server.settimeout(30)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        compiled = pack.pack(os.path.join(tmp, 'compiled.pyz'))
+        sources = os.path.join(tmp, 'sources.pyz')
+        sources_only(compiled, sources)
+
+        # warm up the file system cache
+        start_session(python, sources, server)
+
+        for name, path in (('sources', sources), ('compiled', compiled)):
+            best, median = measure(python, path, server)
+            print('{:9} best {:.1f}ms, median {:.1f}ms'.format(
+                name + ':', best * 1000, median * 1000))
+
+    server.close()
+
+if __name__ == '__main__':
+    main()
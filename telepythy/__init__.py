@@ -1,3 +1,4 @@
-from .lib import client, server, start_client, start_server
+from .lib import (client, server, start_client, start_server,
+    start_async_client, start_async_server)
 
 __version__ = '0.5.4'
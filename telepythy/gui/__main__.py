@@ -42,7 +42,8 @@ def main():
     if args.debug:
         pack.pack()
 
-    profs = Profiles(cfg.section('profiles'), args.verbose)
+    profs = Profiles(cfg.section('profiles'), args.verbose,
+        cfg['fork_server.enabled'], cfg['fork_server.preload'])
 
     if args.list_profiles:
         list_profiles(profs)
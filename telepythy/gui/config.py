@@ -7,6 +7,8 @@ from qtpy import QtGui, QtWidgets
 from ..lib import logs
 from ..lib import utils
 
+from . import output
+
 log = logs.get(__name__)
 
 def init(path=None):
@@ -30,6 +32,26 @@ def init(path=None):
     sct.define('source_path', get_config_path('startup.py'), 'path')
     sct.define('show_tips', True)
 
+    sct = cfg.section('pool')
+    # service processes started ahead of time for the profile in use and
+    # the listed profiles, 0 to disable
+    sct.define('size', 1)
+    sct.define('profiles', (), 'tuple[str, ...]')
+
+    sct = cfg.section('fork_server')
+    # start sessions by forking a process that imported the preload modules
+    # (not on windows)
+    sct.define('enabled', False)
+    sct.define('preload', (), 'tuple[str, ...]')
+
+    sct = cfg.section('history')
+    # shared by every profile, empty to keep history in memory only
+    sct.define('path', get_config_path('history'), 'path')
+
+    sct = cfg.section('output')
+    # 0 keeps every line
+    sct.define('max_lines', output.MAX_LINES)
+
     sct = cfg.section('style')
     sct.define('theme', 'dark')
     sct.define('syntax', 'gruvbox-dark')
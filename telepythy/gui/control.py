@@ -1,5 +1,6 @@
 import shlex
 import queue
+import asyncio
 import threading
 import subprocess
 import collections
@@ -7,27 +8,81 @@ from importlib import resources
 
 from ..lib import logs
 from ..lib import utils
+from ..lib import aio
+from ..lib import codec
 from ..lib import sockio
 
-TIMEOUT = 0.01
 KILL_TIMEOUT = 5
+HOLD_LIMIT = 1000 # events held by a prepared control
 
 log = logs.get(__name__)
 
 class Control:
-    def __init__(self, address):
+    def __init__(self, address, namespace=None, compress=False):
         self._address = address
+        # the service namespace to use ('shared' or 'private')
+        self._namespace = namespace
+        # compress the link, if the service supports it
+        self._compress = compress
 
         self._handlers = collections.defaultdict(set)
 
         self._cmd_queue = queue.Queue(1)
-        self._stop = threading.Event()
+        self._stop = sockio.StopEvent()
+
+        # evaluated at the start of each session
+        self.startup_path = None
+
+        # events received before `release` (see `prepare`)
+        self._held = None
+        self._hold_lock = threading.Lock()
+        # set by keepalives received before `release`, which aren't held
+        self._held_alive = False
+        # lines of output dropped once `HOLD_LIMIT` events were held
+        self._held_dropped = 0
+
+    @property
+    def prepared(self):
+        """Whether the control was started by `prepare`, and is still
+        holding its events."""
+        return self._held is not None
+
+    def prepare(self):
+        """Starts the control ahead of time.
+
+        The session is started as usual (including the startup source), but
+        events are held until `release` is called. Only the first
+        `HOLD_LIMIT` events are kept, so the `start` event and the startup
+        output are never lost; the lines of any later output are counted
+        and reported as a `dropped` event. Keepalives are not held, only
+        whether one was received.
+        """
+        self._held = []
+        self._held_alive = False
+        self._held_dropped = 0
+        self.start()
+
+    def release(self):
+        """Passes on the events held since `prepare`, and stops holding
+        events."""
+        # held under the lock, so newer events wait for the older ones
+        with self._hold_lock:
+            held, self._held = self._held, None
+            if self._held_alive:
+                self._dispatch(None, self._address)
+            for name, event in held or ():
+                self._dispatch(name, event)
+            if self._held_dropped:
+                self._dispatch('dropped', {'evt': 'dropped',
+                    'data': {'lines': self._held_dropped}})
+            self._held_alive = False
+            self._held_dropped = 0
 
     def start(self):
         self._stop.clear()
 
     def stop(self):
-        self._stop.set()
+        self._stop_handling()
 
     def restart(self):
         log.debug('restarting')
@@ -37,22 +92,39 @@ class Control:
     ## commands ##
 
     def evaluate(self, source, notify=True):
-        try:
-            self._cmd_queue.put(('evaluate', source, notify), block=False)
-        except queue.Full:
-            log.debug('[evaluate] command queue is full')
+        self._put_command('evaluate', source, notify)
 
     def interrupt(self):
-        try:
-            self._cmd_queue.put(('interrupt',), block=False)
-        except queue.Full:
-            log.debug('[interrupt] command queue is full')
+        self._put_command('interrupt')
+
+    def send_eof(self):
+        """Ends the input for code reading from stdin."""
+        self._put_command('send_eof')
 
     def complete(self, prefix):
+        self._put_command('complete', prefix)
+
+    def inspect(self, path):
+        """Requests the details of the object at *path* (`inspection`
+        event).
+        """
+        self._put_command('inspect', path)
+
+    def result(self, id=None, offset=None):
+        """Requests a page of the full text of result *id* (`result`
+        event), the last result if `None`.
+        """
+        self._put_command('result', id, offset)
+
+    def stats(self):
+        """Requests the service event queue counters (`stats` event)."""
+        self._put_command('stats')
+
+    def _put_command(self, *cmd):
         try:
-            self._cmd_queue.put(('complete', prefix), block=False)
+            self._cmd_queue.put(cmd, block=False)
         except queue.Full:
-            log.debug('[complete] command queue is full')
+            log.debug('[%s] command queue is full', cmd[0])
 
     ## events ##
 
@@ -63,6 +135,7 @@ class Control:
 
     def _handle(self, sock):
         self._stop.clear()
+        self._discard_wakeup()
 
         t_evt = utils.start_thread(self._handle_events, sock)
         t_cmd = utils.start_thread(self._handle_commands, sock)
@@ -72,33 +145,42 @@ class Control:
 
     def _handle_events(self, sock):
         stop = self._stop
-        address = self._address
         call_handlers = self._call_handlers
 
         try:
             for event in ServiceProxy(sock).events(stop):
                 if stop.is_set():
                     break
-                if event is None:
-                    call_handlers(None, address)
-                    continue
-                name = event['evt']
-                call_handlers(name, event)
+                self._handle_event(sock, event)
 
         except Exception as e:
             log.debug('_handle_events error: %s', repr(e))
-            stop.set()
+            self._stop_handling()
             call_handlers('exception', repr(e))
 
+    def _handle_event(self, sock, event):
+        call_handlers = self._call_handlers
+
+        if event is None:
+            call_handlers(None, self._address)
+            return
+
+        name = event['evt']
+        if name == 'start':
+            call_handlers(None, self._address)
+            self._negotiate(sock, event['data'])
+            self._run_startup(sock)
+        call_handlers(name, event)
+
     def _handle_commands(self, sock):
         stop = self._stop
         q = self._cmd_queue
 
         try:
             while not stop.is_set():
-                try:
-                    cmd = q.get(timeout=TIMEOUT)
-                except queue.Empty:
+                cmd = q.get()
+                # None is used to wake up the loop
+                if cmd is None:
                     continue
                 cmd_name, *cmd_args = cmd
 
@@ -107,16 +189,86 @@ class Control:
 
         except Exception as e:
             log.debug('_handle_commands error: %s', repr(e))
-            stop.set()
+            self._stop_handling()
             self._call_handlers('exception', repr(e))
 
+    def _stop_handling(self):
+        """Stops the connection handlers, waking them if necessary."""
+        self._stop.set()
+        try:
+            self._cmd_queue.put(None, block=False)
+        except queue.Full:
+            # a pending command will wake up the loop
+            pass
+
+    def _discard_wakeup(self):
+        """Removes a wakeup left in the command queue by a past connection."""
+        q = self._cmd_queue
+        try:
+            cmd = q.get(block=False)
+        except queue.Empty:
+            return
+        if cmd is not None:
+            q.put(cmd, block=False)
+
+    def _negotiate(self, sock, data):
+        """Configures the connection with the options supported by the service.
+
+        Older services do not advertise any codecs, namespaces or
+        compressions, and only speak uncompressed JSON.
+        """
+        options = {}
+
+        name = codec.negotiate(data.get('codecs'))
+        if name != sock.codec:
+            options['codec'] = name
+
+        namespace = self._namespace
+        if namespace is not None:
+            if namespace in data.get('namespaces', ()):
+                options['namespace'] = namespace
+            else:
+                log.warning('namespace not supported: %s', namespace)
+
+        compression = None
+        if self._compress:
+            compression = codec.negotiate_compression(
+                data.get('compressions'))
+            if compression is not None:
+                options['compression'] = compression
+
+        if options:
+            ServiceProxy(sock).configure(**options)
+        if 'codec' in options:
+            sock.codec = name
+        if compression is not None:
+            sock.compression = compression
+
+    def _run_startup(self, sock):
+        source = read_startup_source(self.startup_path)
+        if source:
+            ServiceProxy(sock).evaluate(source, notify=False)
+
     def _call_handlers(self, name, event=None):
+        with self._hold_lock:
+            held = self._held
+            if held is not None:
+                if name is None:
+                    self._held_alive = True
+                elif len(held) < HOLD_LIMIT:
+                    held.append((name, event))
+                elif name in ('stdout', 'stderr'):
+                    self._held_dropped += event['data']['text'].count('\n') or 1
+                return
+        self._dispatch(name, event)
+
+    def _dispatch(self, name, event):
         for handler in self._handlers.get(name, []):
             handler(event)
 
 class ClientControl(Control):
-    def __init__(self, address):
-        super().__init__(address)
+    def __init__(self, address, namespace=None, compress=True):
+        super().__init__(address, namespace, compress)
         self._client_thread = None
 
     def start(self):
@@ -135,8 +287,8 @@ class ClientControl(Control):
             self._address, self._handle)
 
 class ServerControl(Control):
-    def __init__(self, address):
-        super().__init__(address)
+    def __init__(self, address, namespace=None, compress=True):
+        super().__init__(address, namespace, compress)
         self._server_thread = None
 
     def start(self):
@@ -156,10 +308,17 @@ class ServerControl(Control):
             self._address, self._handle)
 
 class ProcessControl(ServerControl):
-    def __init__(self, address, command, verbose=0, kill_timeout=None):
-        super().__init__(address)
+    def __init__(self, address, command, verbose=0, kill_timeout=None,
+            fork_server=None):
+        # compression isn't worth it for a local process
+        super().__init__(address, compress=False)
 
         self._proc = None
+        self._proc_lock = threading.Lock()
+        # forks the service process instead of starting it, if set
+        self._fork_server = fork_server
+        # set to cancel the pending fork (see `stop`)
+        self._fork_cancel = None
 
         self._command = command
         self._verbose = verbose
@@ -168,37 +327,339 @@ class ProcessControl(ServerControl):
     def start(self):
         super().start()
 
-        lib_name = 'telepythy_service.pyz'
-        with resources.path('telepythy', lib_name) as lib_path:
-            python = self._command
-            cmd = shlex.split(python, posix=False) + [lib_path]
-            cmd.extend(['-v'] * self._verbose)
-            cmd.extend(['-c', '{}:{}'.format(*self._address)])
+        if self._fork_server:
+            # the fork server may still be importing its modules
+            self._fork_cancel = cancel = threading.Event()
+            utils.start_thread(self._fork, cancel)
+            return
 
-            kwargs = {}
-            if utils.IS_WINDOWS:
-                kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
-                kwargs['startupinfo'] = sinfo = subprocess.STARTUPINFO()
-                sinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        self._proc = start_service(self._command,
+            ['-c', '{}:{}'.format(*self._address)], self._verbose)
 
-            log.debug('starting process: %s', cmd)
-            self._proc = subprocess.Popen(cmd, **kwargs)
-            log.debug('started process: %s', self._proc.pid)
+    def _fork(self, cancel):
+        try:
+            proc = self._fork_server.fork(self._address)
+        except (OSError, ValueError) as e:
+            with self._proc_lock:
+                if self._fork_cancel is cancel:
+                    self._fork_cancel = None
+            if not cancel.is_set():
+                log.error('fork server error: %s', e)
+                self._call_handlers('exception', repr(e))
+            return
+
+        with self._proc_lock:
+            if not cancel.is_set():
+                self._proc = proc
+                return
+        # stopped while forking
+        log.debug('stopping cancelled process')
+        proc.kill()
+
+    @property
+    def is_running(self):
+        cancel = self._fork_cancel
+        if cancel is not None and self._proc is None:
+            # still forking
+            return True
+        return self._proc is not None and self._proc.poll() is None
 
     def stop(self):
-        proc = self._proc
-        if not proc:
+        # a pending fork isn't waited for, the process is stopped by the
+        # forking thread instead
+        with self._proc_lock:
+            if self._fork_cancel is not None:
+                self._fork_cancel.set()
+                self._fork_cancel = None
+            proc, self._proc = self._proc, None
+
+        if proc:
+            log.debug('stopping process')
+            proc.kill()
+            proc.wait(self._timeout)
+        else:
             log.debug('process not running')
-            return
 
-        log.debug('stopping process')
+        # stop server
+        super().stop()
+
+class ForkServer:
+    """A service process that imports the *preload* modules once, then
+    forks a new service process for each session (not on Windows).
+
+    The server is started by the first `fork`, and restarted if it exits.
+    Its replies are read by a thread, which also records the exits of the
+    forked processes.
+    """
+    def __init__(self, command, preload=(), verbose=0):
+        self._command = command
+        self._preload = preload
+        self._verbose = verbose
 
-        proc.kill()
-        proc.wait(self._timeout)
         self._proc = None
+        # held while forking, which may wait for the imports
+        self._lock = threading.Lock()
+        # held while writing requests
+        self._write_lock = threading.Lock()
+        # the forked processes, until the server reports their exit
+        self._children = {}
+        self._replies = queue.Queue()
+
+    def fork(self, address):
+        """Returns a `ForkedProcess` for a new service connecting to
+        *address*, waiting for the server to import its modules if
+        necessary."""
+        with self._lock:
+            proc = self._proc
+            if proc is None or proc.poll() is not None:
+                self._proc = proc = start_service(self._command,
+                    ['--fork-server', '--preload', ','.join(self._preload)],
+                    self._verbose, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, universal_newlines=True)
+                self._replies = queue.Queue()
+                utils.start_thread(self._read_replies, proc, self._replies)
+
+            self._write(proc, '{}:{}'.format(*address))
+            child = self._replies.get()
+            if child is None:
+                raise OSError('fork server exited')
+
+        log.debug('forked process: %s', child.pid)
+        return child
+
+    def kill(self, pid):
+        """Asks the server to kill the forked process *pid*."""
+        proc = self._proc
+        if proc is not None:
+            self._write(proc, 'kill {}'.format(pid))
 
-        # stop server
-        super().stop()
+    def stop(self):
+        # not under the fork lock, which may be held until the imports
+        # are done
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+
+        # the server exits when its input is closed, but doesn't read it
+        # until the imports are done
+        with self._write_lock:
+            proc.stdin.close()
+        if self._lock.locked():
+            log.debug('stopping fork server while forking')
+            proc.kill()
+        try:
+            proc.wait(KILL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def _write(self, proc, line):
+        with self._write_lock:
+            try:
+                proc.stdin.write(line + '\n')
+                proc.stdin.flush()
+            except (OSError, ValueError) as e:
+                # the server exited, or was stopped
+                log.debug('fork server write error: %s', e)
+
+    def _read_replies(self, proc, replies):
+        children = self._children
+        for line in proc.stdout:
+            name, *args = line.split()
+            if name == 'forked':
+                child = ForkedProcess(int(args[0]), self)
+                children[child.pid] = child
+                replies.put(child)
+            elif name == 'exited':
+                child = children.pop(int(args[0]), None)
+                if child is not None:
+                    child.set_returncode(int(args[1]))
+
+        # the server is gone, along with any way to control its processes
+        log.debug('fork server exited')
+        replies.put(None)
+        for pid in list(children):
+            children.pop(pid).set_returncode(-1)
+
+class ForkedProcess:
+    """A process forked by a `ForkServer`, with the parts of the
+    `subprocess.Popen` interface used by `ProcessControl`.
+
+    The process is a child of the fork server, which reports its exit and
+    kills it, so its pid is never signaled after it may have been reused.
+    """
+    def __init__(self, pid, server):
+        self.pid = pid
+        self.returncode = None
+        self._server = server
+        self._exited = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            self._server.kill(self.pid)
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(str(self.pid), timeout)
+        return self.returncode
+
+    def set_returncode(self, code):
+        self.returncode = code
+        self._exited.set()
+
+def start_service(command, args, verbose=0, **kwargs):
+    """Starts the service package with *command* (a Python executable and
+    its options) and *args*, and returns the `subprocess.Popen`."""
+    lib_name = 'telepythy_service.pyz'
+    with resources.path('telepythy', lib_name) as lib_path:
+        cmd = shlex.split(command, posix=False) + [lib_path]
+        cmd.extend(['-v'] * verbose)
+        cmd.extend(args)
+
+        if utils.IS_WINDOWS:
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+            kwargs['startupinfo'] = sinfo = subprocess.STARTUPINFO()
+            sinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+        log.debug('starting process: %s', cmd)
+        proc = subprocess.Popen(cmd, **kwargs)
+        log.debug('started process: %s', proc.pid)
+        return proc
+
+class AsyncControl(Control):
+    """Base class for controls that handle connections in an asyncio loop.
+
+    A single thread runs the event loop, rather than a thread each for
+    events and commands.
+
+    These are library classes for applications that drive a service
+    themselves; profiles still create the threaded controls.
+    """
+    def __init__(self, address, namespace=None, compress=True):
+        super().__init__(address, namespace, compress)
+        self._loop = None
+        self._thread = None
+        self._task = None
+        self._sock = None
+
+    def start(self):
+        self._loop = loop = asyncio.new_event_loop()
+        self._thread = utils.start_thread(loop.run_forever)
+        asyncio.run_coroutine_threadsafe(self._start(), loop).result()
+
+    def stop(self):
+        loop = self._loop
+        if loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self._stop_task(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+
+        self._loop = None
+        self._thread = None
+
+    async def _start(self):
+        raise NotImplementedError()
+
+    async def _stop_task(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def _put_command(self, *cmd):
+        loop = self._loop
+        if loop is None:
+            log.debug('[%s] not started', cmd[0])
+            return
+        loop.call_soon_threadsafe(self._send_command, cmd)
+
+    def _send_command(self, cmd):
+        sock = self._sock
+        if sock is None:
+            log.debug('[%s] not connected', cmd[0])
+            return
+
+        cmd_name, *cmd_args = cmd
+        try:
+            getattr(ServiceProxy(sock), cmd_name)(*cmd_args)
+        except Exception as e:
+            log.debug('_send_command error: %s', repr(e))
+            self._call_handlers('exception', repr(e))
+
+    async def _handle_streams(self, reader, writer):
+        self._sock = sock = aio.AsyncSockIO(reader, writer)
+        try:
+            while True:
+                event = await sock.recvmsg()
+                log_event(event)
+                self._handle_event(sock, event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug('_handle_streams error: %s', repr(e))
+            # the socket is only unset when stopping
+            if self._sock is sock:
+                self._call_handlers('exception', repr(e))
+        finally:
+            self._sock = None
+            sock.close()
+
+class AsyncClientControl(AsyncControl):
+    async def _start(self):
+        self._task = asyncio.ensure_future(self._connect())
+
+    async def _connect(self):
+        host, port = self._address
+        while True:
+            log.debug('connecting: %s:%s', host, port)
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                log.error('connection error: %s', e)
+            else:
+                log.info('connected: %s:%s', host, port)
+                await self._handle_streams(reader, writer)
+
+            await asyncio.sleep(aio.RETRY_INTERVAL)
+            log.warning('retrying connection')
+
+class AsyncServerControl(AsyncControl):
+    async def _start(self):
+        host, port = self._address
+        lock = asyncio.Lock()
+
+        async def handle(reader, writer):
+            # only one service is controlled at a time
+            async with lock:
+                await self._handle_streams(reader, writer)
+
+        server = await asyncio.start_server(handle, host, port)
+        # replace address in case a port was generated (port=0)
+        self._address = server.sockets[0].getsockname()[:2]
+        log.info('listening: %s:%s', *self._address)
+
+        self._task = asyncio.ensure_future(self._serve(server))
+
+    async def _serve(self, server):
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            await server.wait_closed()
 
 class ServiceProxy(object):
     def __init__(self, sock):
@@ -210,32 +671,32 @@ class ServiceProxy(object):
     def interrupt(self):
         self._sendcmd('interrupt')
 
+    def send_eof(self):
+        self._sendcmd('eof')
+
     def complete(self, prefix):
         self._sendcmd('complete', prefix)
 
+    def configure(self, **options):
+        self._sendcmd('configure', options)
+
+    def inspect(self, path):
+        self._sendcmd('inspect', path)
+
+    def result(self, id=None, offset=None):
+        self._sendcmd('result', {'id': id, 'offset': offset})
+
+    def stats(self):
+        self._sendcmd('stats')
+
     def events(self, stop):
         sock = self._sock
 
         while not stop.is_set():
-            try:
-                event = sock.recvmsg()
-            except sockio.timeout:
+            if not sock.wait(stop):
                 continue
-
-            if event:
-                name = event['evt']
-                if name == 'done':
-                    log.debug('evt: done')
-                elif name == 'stdout':
-                    pass
-                    # log.debug('out: %r', event['data']['text'][:100])
-                elif name == 'stderr':
-                    log.debug('err: %r', event['data']['text'][:100])
-                else:
-                    data = event.get('data', '')
-                    data = data and ': ' + repr(data)[:100]
-                    log.debug('evt: %s%s', event['evt'], data)
-
+            event = sock.recvmsg()
+            log_event(event)
             yield event
 
     def _sendcmd(self, cmd, data=None):
@@ -245,3 +706,34 @@ class ServiceProxy(object):
         data = (data or '') and ': ' + repr(data)
         log.debug('cmd: %s%s', cmd, data)
         self._sock.sendmsg(msg)
+
+def read_startup_source(path):
+    """Returns the source of the startup file at *path*, or `None` if
+    it can't be read."""
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        log.debug('startup file not found: %s', path)
+    except OSError as e:
+        log.error('failed to read startup file: %s', e)
+    return None
+
+def log_event(event):
+    if not event:
+        return
+
+    name = event['evt']
+    if name == 'done':
+        log.debug('evt: done')
+    elif name == 'stdout':
+        pass
+        # log.debug('out: %r', event['data']['text'][:100])
+    elif name == 'stderr':
+        log.debug('err: %r', event['data']['text'][:100])
+    else:
+        data = event.get('data', '')
+        data = data and ': ' + repr(data)[:100]
+        log.debug('evt: %s%s', name, data)
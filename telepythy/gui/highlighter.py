@@ -3,6 +3,7 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+import time
 import enum
 
 from qtpy import QtGui
@@ -19,6 +20,14 @@ class BlockState(enum.IntEnum):
 class BlockData(QtGui.QTextBlockUserData):
     """Storage for the user data associated with each line."""
     syntax_stack = ('root',)
+    # set until the block has been highlighted in document order
+    pending = False
+    # (key, tokens, syntax stack) from the last time the block was lexed,
+    # where the key is the hash of the text, the block state and the
+    # lexer state it was lexed with
+    tokens = None
+    # the style the block was last highlighted with (see `set_style`)
+    style_id = None
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -49,6 +58,11 @@ class Highlighter(QtGui.QSyntaxHighlighter):
         super().__init__(parent)
 
         self._lexer = lexer
+        # at the first deferred block (see `highlight_pending`)
+        self._pending = None
+        # whether `set_style` leaves blocks to be highlighted later
+        self.deferred = False
+        self._style_id = 0
         self.set_style(styles.get_style_by_name('default'))
 
     def reset(self):
@@ -76,28 +90,102 @@ class Highlighter(QtGui.QSyntaxHighlighter):
             fmt.setBackground(QtGui.QBrush(style.highlight_color))
             self.setFormat(0, block.length(), fmt)
 
-            BlockData.update_block(block, state=state)
+            BlockData.update_block(block, state=state,
+                style_id=self._style_id)
+            return
+
+        if doc.context.get('defer'):
+            # lexed later, by `highlight_blocks()` or `highlight_pending()`
+            BlockData.update_block(block, state=state, syntax_stack=None,
+                pending=True)
+            if self._pending is None:
+                self._pending = QtGui.QTextCursor(block)
             return
 
         prev_data = block.previous().userData()
-        self._lexer.stack = prev_data and prev_data.syntax_stack
+        self._lexer.state = prev_data and prev_data.syntax_stack
 
-        # Lex the text using Pygments
+        tokens = self._get_tokens(string, state, data)
         index = 0
-        for token, text in self._lexer.get_tokens(string):
-            length = len(text)
+        for length, token in tokens[1]:
             self.setFormat(index, length, self._get_format(token))
             index += length
 
+        # a block following a deferred one was lexed without knowing the
+        # state it starts in, so it stays pending until it is reached in order
         BlockData.update_block(block, state=state,
-            syntax_stack=self._lexer.stack)
+            syntax_stack=self._lexer.state,
+            pending=bool(prev_data and prev_data.pending),
+            tokens=tokens, style_id=self._style_id)
+
+    def is_pending(self, data):
+        """Returns whether a block with *data* was deferred, or was
+        highlighted with an older style."""
+        return bool(data) and (data.pending or (
+            data.style_id is not None and data.style_id != self._style_id))
+
+    def highlight_blocks(self, blocks):
+        """Highlights the deferred blocks among *blocks*."""
+        for block in blocks:
+            if self.is_pending(block.userData()):
+                self.rehighlightBlock(block)
+
+    def highlight_pending(self, timeout):
+        """Highlights deferred blocks in document order for about *timeout*
+        seconds. Returns whether any remain.
+        """
+        cur = self._pending
+        if cur is None:
+            return False
+
+        deadline = time.perf_counter() + timeout
+        # the cursor follows edits, so the block is still in the document
+        block = cur.block()
+        while block.isValid():
+            if self.is_pending(block.userData()):
+                self.rehighlightBlock(block)
+                if time.perf_counter() > deadline:
+                    cur.setPosition(block.position())
+                    return True
+            block = block.next()
+
+        self._pending = None
+        return False
+
+    def _get_tokens(self, string, state, data):
+        """Returns the tokens of a block of text (see `BlockData.tokens`).
+
+        The tokens are kept in the block *data*, so rehighlighting a block
+        that hasn't changed (e.g. after a style change) doesn't lex it again.
+        """
+        lexer = self._lexer
+        key = (hash(string), state, lexer.state)
+
+        tokens = data and data.tokens
+        if tokens and tokens[0] == key:
+            lexer.state = tokens[2]
+            return tokens
+
+        # Lex the text using Pygments
+        tokens = [(len(text), token)
+            for token, text in lexer.get_tokens(string)]
+        return (key, tokens, lexer.state)
 
     def set_style(self, style):
-        """Sets the style to the specified Pygments style."""
+        """Sets the style to the specified Pygments style.
+
+        Only the formats change, so blocks keep their tokens. If `deferred`,
+        the blocks are left pending for `highlight_blocks()` and
+        `highlight_pending()`, otherwise they are all highlighted again.
+        """
         self._style = style
+        self._style_id += 1
         self._clear_caches()
 
-        self.rehighlight()
+        if self.deferred:
+            self._pending = QtGui.QTextCursor(self.document().firstBlock())
+        else:
+            self.rehighlight()
 
     def _clear_caches(self):
         """Clear caches for brushes and formats."""
@@ -1,59 +1,407 @@
+import os
+import json
+import array
+import bisect
+import threading
+
+from ..lib import logs
+
+log = logs.get(__name__)
+
+SEARCH_LIMIT = 50 # results
+SEARCH_CANDIDATES = 1000 # newest matches ranked by a search
+SEARCH_SCAN = 2000 # newest entries matched without the trigram index
+INDEX_CHUNK = 1000 # entries indexed at a time while building
+
+# fuzzy match scores (see `score`)
+CONSECUTIVE_BONUS = 2 # per character following the previous one
+WORD_BONUS = 3 # per character starting a word
+GAP_PENALTY = 2 # per gap between matched characters
+QUERY_BONUS = 5 # for the whole query, if it has several terms
+RECENCY_WEIGHT = 1 # added to the newest entry, less to older ones
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def find_positions(text, term):
+    """Returns the positions of the first characters of *text* matching
+    those of *term* in order, or `None` if they don't all appear."""
+    positions = []
+    pos = 0
+    for char in term:
+        pos = text.find(char, pos)
+        if pos < 0:
+            return None
+        positions.append(pos)
+        pos += 1
+    return positions
+
+def score(text, term):
+    """Returns how closely *text* matches *term* (both lowercased), or `None`
+    if the characters of the term don't appear in order in the text.
+
+    Each matched character scores 1, with a bonus when it follows the
+    previous one or starts a word, and a penalty for each gap. The term is
+    matched as a whole if it can be, at a word start if possible, otherwise
+    with the first characters found in order (see `find_positions`).
+    """
+    pos = text.find(term)
+    if pos < 0:
+        positions = find_positions(text, term)
+        if positions is None:
+            return None
+        return score_positions(text, positions)
+
+    best = None
+    while pos >= 0:
+        value = score_positions(text, range(pos, pos + len(term)))
+        if best is None or value > best:
+            best = value
+        if is_word_start(text, pos):
+            break
+        pos = text.find(term, pos + 1)
+    return best
+
+def score_positions(text, positions):
+    value = 0
+    last = None
+    for pos in positions:
+        value += 1
+        if last is not None:
+            if pos == last + 1:
+                value += CONSECUTIVE_BONUS
+            else:
+                value -= GAP_PENALTY
+        if is_word_start(text, pos):
+            value += WORD_BONUS
+        last = pos
+    return value
+
+def is_word_start(text, pos):
+    if pos == 0:
+        return True
+    char = text[pos - 1]
+    return not (char.isalnum() or char == '_')
+
+class TrigramIndex:
+    """Maps each trigram (3 lowercased characters) to the indexes of the
+    entries containing it, and keeps the lowercased entries.
+
+    The index is built in a background thread. Until it is `ready`, entries
+    appended to the list are left to the thread, afterwards `update` indexes
+    them.
+    """
+    def __init__(self, entries):
+        self._entries = entries
+        # arrays of entry indexes, in order
+        self._postings = {}
+        # the lowercased entries, up to `_count`
+        self._lower = []
+        self._count = 0
+        self._ready = False
+        self._lock = threading.Lock()
+
+        thread = threading.Thread(target=self._build,
+            name='history-index', daemon=True)
+        thread.start()
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def update(self):
+        """Indexes the entries appended since the index was built."""
+        with self._lock:
+            if self._ready:
+                self._add(self._count, len(self._entries))
+
+    def lower(self, i):
+        """Returns entry *i* lowercased."""
+        if i < self._count:
+            return self._lower[i]
+        return self._entries[i].lower()
+
+    def candidates(self, grams):
+        """Yields the indexes of the entries containing every trigram in
+        *grams*, newest first."""
+        postings = []
+        for gram in grams:
+            indexes = self._postings.get(gram)
+            if indexes is None:
+                return
+            postings.append(indexes)
+        postings.sort(key=len)
+
+        shortest, others = postings[0], postings[1:]
+        for i in reversed(shortest):
+            for indexes in others:
+                pos = bisect.bisect_left(indexes, i)
+                if pos == len(indexes) or indexes[pos] != i:
+                    break
+            else:
+                yield i
+
+    def _build(self):
+        while True:
+            with self._lock:
+                start = self._count
+                end = len(self._entries)
+                if start == end:
+                    self._ready = True
+                    log.debug('history index: %d entries, %d trigrams',
+                        end, len(self._postings))
+                    return
+            self._add(start, min(end, start + INDEX_CHUNK))
+
+    def _add(self, start, end):
+        postings = self._postings
+        entries = self._entries
+        lower = self._lower
+        for i in range(start, end):
+            text = entries[i].lower()
+            lower.append(text)
+            for gram in trigrams(text):
+                indexes = postings.get(gram)
+                if indexes is None:
+                    postings[gram] = indexes = array.array('I')
+                indexes.append(i)
+        self._count = end
+
 class History:
-    def __init__(self):
-        self._history = []
+    """The sources of past cells, oldest first.
+
+    With a *path*, the history is kept in an append-only log file with one
+    JSON string per line. The file is only read the first time the history
+    is navigated or searched, so startup doesn't depend on its size.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._history = None if path else []
         self._index = 0
         self._match = None
+        # indexes of the entries starting with the match, in order
+        self._matches = None
+        # (value, index) of each entry, sorted for prefix searches
+        self._prefixes = None
+        # the last entry appended before the file was read
+        self._last = None
+        # built by the first `find`
+        self._trigrams = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def entries(self):
+        if self._history is None:
+            self._history = self._load()
+            self._index = len(self._history)
+        return self._history
 
     @property
     def index(self):
+        # reading the file resets the index
+        self.entries
         return self._index
 
     @index.setter
     def index(self, value):
-        self._index = min(max(0, value), len(self._history))
+        self._index = min(max(0, value), len(self.entries))
 
     def append(self, value):
-        hist = self._history
         value = value.strip()
-        if value and value != (hist and hist[-1]):
-            hist.append(value)
+        last = self._last if self._history is None else (
+            self._history and self._history[-1])
+        if value and value != last:
+            if self._history is None:
+                self._last = value
+            else:
+                self._add(value)
+            if self._path:
+                self._write(value)
         self.reset()
 
     def first(self):
         self.index = 0
-        return self._history[0]
+        return self.entries[0]
 
     def last(self):
-        self.index = len(self._history) - 1
-        return self._history[-1]
+        self.index = len(self.entries) - 1
+        return self.entries[-1]
 
     def previous(self, match=None):
         self.index -= 1
-        i, value = self._search(match, range(self.index, -1, -1))
-        self.index = i
+        self.index, value = self._search(match, -1)
         return value
 
     def next(self, match=None):
         self.index += 1
-        i, value = self._search(match, range(self.index, len(self._history)))
-        self.index = i
+        self.index, value = self._search(match, 1)
         return value
 
-    def _search(self, match, it):
+    def search(self, text):
+        """Yields the (index, value) of each entry containing *text*, newest
+        first."""
+        hist = self.entries
+        for i in range(len(hist) - 1, -1, -1):
+            if text in hist[i]:
+                yield i, hist[i]
+
+    def find(self, query, limit=SEARCH_LIMIT):
+        """Returns up to *limit* (index, value) pairs of the entries matching
+        *query*, best first (the newest entries for an empty query).
+
+        The characters of each whitespace-separated term of the query must
+        appear in an entry in order, ignoring case. Entries are ranked by how
+        closely they match (see `score`), plus a bonus for containing the
+        whole query and a smaller one for being recent.
+
+        Entries containing the trigrams of the terms are found with the
+        index, once it is built, up to the newest `SEARCH_CANDIDATES`. Only
+        the newest `SEARCH_SCAN` entries are matched without the index, so a
+        search doesn't depend on the size of the history.
+        """
+        hist = self.entries
+        query = ' '.join(query.lower().split())
+        if not query:
+            return [(i, hist[i])
+                for i in range(len(hist) - 1, max(-1, len(hist) - 1 - limit), -1)]
+
+        if self._trigrams is None:
+            self._trigrams = TrigramIndex(hist)
+        index = self._trigrams
+
+        terms = query.split()
+        def match(i):
+            text = index.lower(i)
+            total = 0
+            for term in terms:
+                value = score(text, term)
+                if value is None:
+                    return None
+                total += value
+            if len(terms) > 1 and query in text:
+                total += QUERY_BONUS
+            return total + RECENCY_WEIGHT * (i + 1) / len(hist)
+
+        matches = {}
+        # recent entries, including those that only match fuzzily
+        scanned = max(0, len(hist) - SEARCH_SCAN)
+        for i in range(len(hist) - 1, scanned - 1, -1):
+            value = match(i)
+            if value is not None:
+                matches[i] = value
+
+        # older entries, which may not contain the short terms
+        grams = set().union(*(trigrams(term) for term in terms))
+        if scanned and grams and index.ready:
+            found = examined = 0
+            for i in index.candidates(grams):
+                if i >= scanned:
+                    continue
+                if found >= SEARCH_CANDIDATES or examined >= SEARCH_SCAN:
+                    break
+                examined += 1
+                value = match(i)
+                if value is not None:
+                    matches[i] = value
+                    found += 1
+
+        ranked = sorted(matches.items(), key=lambda m: (m[1], m[0]),
+            reverse=True)
+        return [(i, hist[i]) for i, _ in ranked[:limit]]
+
+    def _search(self, match, step):
+        """Returns the index and value of the nearest entry from the current
+        index, in the direction of *step*, that starts with the match."""
         if self._match is None:
             self._match = match
         match = self._match
 
-        for i in it:
-            value = self._history[i]
-            if not match or value.startswith(match):
-                return i, value
+        hist = self.entries
+        index = self._index
+        if not match:
+            if index < len(hist):
+                return index, hist[index]
+            return index, None
+
+        matches = self._get_matches()
+        if step < 0:
+            i = bisect.bisect_right(matches, index) - 1
+            if i >= 0:
+                return matches[i], hist[matches[i]]
+        else:
+            i = bisect.bisect_left(matches, index)
+            if i < len(matches):
+                return matches[i], hist[matches[i]]
+
+        return index, None
+
+    def _get_matches(self):
+        if self._matches is None:
+            if self._prefixes is None:
+                self._prefixes = sorted(
+                    (value, i) for i, value in enumerate(self.entries))
+
+            prefixes = self._prefixes
+            match = self._match
+            matches = []
+            # entries starting with the match sort together
+            for i in range(bisect.bisect_left(prefixes, (match,)),
+                    len(prefixes)):
+                value, index = prefixes[i]
+                if not value.startswith(match):
+                    break
+                matches.append(index)
+
+            matches.sort()
+            self._matches = matches
+        return self._matches
+
+    def _add(self, value):
+        hist = self._history
+        if self._prefixes is not None:
+            bisect.insort(self._prefixes, (value, len(hist)))
+        hist.append(value)
+        if self._trigrams is not None:
+            self._trigrams.update()
+
+    def _load(self):
+        hist = []
+        try:
+            with open(self._path, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        value = json.loads(line)
+                    except ValueError:
+                        # e.g. a line cut short by a crash
+                        continue
+                    if (isinstance(value, str) and value and
+                            value != (hist and hist[-1])):
+                        hist.append(value)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            log.exception('failed to read history: %s', self._path)
+
+        log.debug('history: %d entries', len(hist))
+        return hist
 
-        return (self.index, None)
+    def _write(self, value):
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            # a single write of a whole line, so the file can be shared
+            with open(self._path, 'a', encoding='utf8') as f:
+                f.write(json.dumps(value) + '\n')
+        except OSError:
+            log.exception('failed to write history: %s', self._path)
 
     def reset(self):
-        self.index = len(self._history)
+        if self._history is not None:
+            self._index = len(self._history)
         self._match = None
+        self._matches = None
 
     def __bool__(self):
-        return bool(self._history)
+        return bool(self.entries)
@@ -8,11 +8,73 @@ from pygments.lexers.python import (
 from pygments.token import Text, Error, Generic, Name, _TokenType
 from pygments.lexer import do_insertions, line_re
 
+# rule patterns that can't be combined into one regex: numbered or named
+# backreferences, and global inline flags after the start
+rx_uncombinable = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+# global inline flags at the start of a pattern, which are already
+# included in the flags of the compiled regex
+rx_global_flags = re.compile(r'^\(\?[aiLmsux]+\)')
+# flags that can be scoped to a part of a regex
+scoped_flags = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'),
+    (re.VERBOSE, 'x'))
+scoped_mask = sum(flag for flag, _ in scoped_flags)
+
+def compile_state(rules):
+    """Combines the rules of a lexer state into a single regex.
+
+    Returns the match function of the combined regex and a list mapping the
+    index of each rule's group to the rule, or `None` if the rules can't be
+    combined. Regex alternation tries each alternative in order, so the
+    match is that of the first rule that matches, as when the rules are
+    tried one by one.
+    """
+    if not rules:
+        return None
+
+    patterns = []
+    dispatch = [None]
+    flags = rules[0][0].__self__.flags
+    for rule in rules:
+        regex = rule[0].__self__
+        pattern = rx_global_flags.sub('', regex.pattern)
+        if ((regex.flags ^ flags) & ~scoped_mask or
+                rx_uncombinable.search(pattern)):
+            return None
+
+        # scope the flags that differ to the rule's pattern
+        added = ''.join(name for flag, name in scoped_flags
+            if regex.flags & flag and not flags & flag)
+        removed = ''.join(name for flag, name in scoped_flags
+            if flags & flag and not regex.flags & flag)
+        if added or removed:
+            pattern = '(?{}{}:{})'.format(added,
+                '-' + removed if removed else '', pattern)
+
+        patterns.append('({})'.format(pattern))
+        # the rule's own groups follow its group
+        dispatch.append(rule)
+        dispatch.extend([None] * regex.groups)
+
+    try:
+        combined = re.compile('|'.join(patterns), flags)
+    except (re.error, OverflowError):
+        return None
+    return combined.match, dispatch
+
 class Lexer(PythonLexer):
+    # combined regex for each state, built once per class (see
+    # `compile_state`)
+    _machines = None
+
     def __init__(self, **options):
         super().__init__(**options)
         self._stack = None
 
+        cls = type(self)
+        if cls._machines is None:
+            cls._machines = dict((state, compile_state(rules))
+                for state, rules in self._tokens.items())
+
     @property
     def stack(self):
         return self._stack
@@ -21,6 +83,16 @@ class Lexer(PythonLexer):
     def stack(self, stack):
         self._stack = stack
 
+    @property
+    def state(self):
+        """The state carried from one call to the next, which determines how
+        the next text is lexed."""
+        return self._stack
+
+    @state.setter
+    def state(self, state):
+        self._stack = state
+
     def reset(self):
         self._stack = None
 
@@ -32,43 +104,58 @@ class Lexer(PythonLexer):
         """
         pos = 0
         tokendefs = self._tokens
+        machines = self._machines
         statestack = list(self._stack or ('root',))
         statetokens = tokendefs[statestack[-1]]
+        machine = machines[statestack[-1]]
         while 1:
-            for rexmatch, action, new_state in statetokens:
-                m = rexmatch(text, pos)
-                if m:
-                    if action is not None:
-                        if type(action) is _TokenType:
-                            yield pos, action, m.group()
-                        else:
-                            yield from action(self, m)
-                    pos = m.end()
-                    if new_state is not None:
-                        # state transition
-                        if isinstance(new_state, tuple):
-                            for state in new_state:
-                                if state == '#pop':
-                                    if len(statestack) > 1:
-                                        statestack.pop()
-                                elif state == '#push':
-                                    statestack.append(statestack[-1])
-                                else:
-                                    statestack.append(state)
-                        elif isinstance(new_state, int):
-                            # pop, but keep at least one state on the stack
-                            # (random code leading to unexpected pops should
-                            # not allow exceptions)
-                            if abs(new_state) >= len(statestack):
-                                del statestack[1:]
+            if machine is not None:
+                m = machine[0](text, pos)
+                rule = m and machine[1][m.lastindex]
+            else:
+                # try each rule in turn
+                m = rule = None
+                for rule in statetokens:
+                    m = rule[0](text, pos)
+                    if m:
+                        break
+
+            if m:
+                rexmatch, action, new_state = rule
+                if action is not None:
+                    if type(action) is _TokenType:
+                        yield pos, action, m.group()
+                    else:
+                        # the action expects the rule's own groups
+                        if machine is not None:
+                            m = rexmatch(text, pos)
+                        yield from action(self, m)
+                pos = m.end()
+                if new_state is not None:
+                    # state transition
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
                             else:
-                                del statestack[new_state:]
-                        elif new_state == '#push':
-                            statestack.append(statestack[-1])
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        # pop, but keep at least one state on the stack
+                        # (random code leading to unexpected pops should
+                        # not allow exceptions)
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
                         else:
-                            assert False, "wrong state def: %r" % new_state
-                        statetokens = tokendefs[statestack[-1]]
-                    break
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    statetokens = tokendefs[statestack[-1]]
+                    machine = machines[statestack[-1]]
             else:
                 # We are here only if all state tokens have been considered
                 # and there was not a match on any of them.
@@ -77,6 +164,7 @@ class Lexer(PythonLexer):
                         # at EOL, reset state to "root"
                         statestack = ['root']
                         statetokens = tokendefs['root']
+                        machine = machines['root']
                         yield pos, Text, '\n'
                         pos += 1
                         continue
@@ -93,6 +181,15 @@ class ConsoleLexer(PythonConsoleLexer):
         self._pylexer = Lexer(**options)
         self._tblexer = PythonTracebackLexer(**options)
 
+    @property
+    def state(self):
+        """The state carried from one call to the next (see `Lexer.state`)."""
+        return self._pylexer.state
+
+    @state.setter
+    def state(self, state):
+        self._pylexer.state = state
+
     def reset(self):
         self._pylexer._stack = None
 
@@ -107,6 +204,9 @@ class ConsoleLexer(PythonConsoleLexer):
         tb = 0
         for match in line_re.finditer(text):
             line = match.group()
+            if line.startswith('>>> ') and not curcode:
+                # a new prompt doesn't continue earlier source
+                pylexer.reset()
             if line.startswith('>>> ') or line.startswith('... '):
                 tb = 0
                 insertions.append((len(curcode),
@@ -1,4 +1,6 @@
 import re
+import time
+import bisect
 import itertools
 import collections
 
@@ -7,12 +9,17 @@ from qtpy import QtCore, QtGui, QtWidgets
 
 from . import lexer
 from . import textedit
-from .highlighter import BlockState
+from .highlighter import BlockData, BlockState
 
 PS1 = '>>> '
 PS2 = '... '
-BUFFER_TIMEOUT = 50 # ms
-BUFFER_CHUNK_SIZE = 1000 # lines
+BUFFER_TIMEOUT = 16 # ms, about a frame
+FLUSH_BUDGET = 0.008 # seconds of work for each flush
+FLUSH_MIN_SIZE = 1024 # characters
+FLUSH_RATE = 500000 # characters per second, until it has been measured
+MAX_LINES = 100000 # lines of scrollback
+HIGHLIGHT_BUDGET = 0.004 # seconds of idle highlighting at a time
+HIGHLIGHT_MARGIN = 50 # lines around the viewport highlighted right away
 
 # regex to remove prompts
 rx_ps = re.compile('^({}|{})'.format(PS1, PS2))
@@ -41,6 +48,10 @@ class BlockChain:
     def is_folded(self):
         return bool(self._fold_block)
 
+    @property
+    def fold_block(self):
+        return self._fold_block
+
     @property
     def start_block(self):
         return self._start_block
@@ -72,6 +83,45 @@ class BlockChain:
     def blocks(self):
         yield from self._doc.blocks(self._start_block, self._end_block)
 
+    def line_count(self):
+        """Returns the number of blocks used by the chain, including the fold
+        info block (which is between the start and end blocks)."""
+        return self.count()
+
+    def remove(self):
+        """Removes the blocks of the chain from the document."""
+        cur = QtGui.QTextCursor(self._start_block)
+        end_block = self._end_block
+        if end_block.next().isValid():
+            cur.setPosition(end_block.next().position(), cur.MoveMode.KeepAnchor)
+        else:
+            cur.movePosition(cur.MoveOperation.End, cur.MoveMode.KeepAnchor)
+        cur.removeSelectedText()
+
+    def remove_start(self, count):
+        """Removes the first *count* blocks of the chain, which must be
+        shorter than the chain."""
+        self.unfold()
+
+        block = self._start_block
+        for _ in range(count):
+            block = block.next()
+
+        cur = QtGui.QTextCursor(self._start_block)
+        cur.setPosition(block.position(), cur.MoveMode.KeepAnchor)
+        cur.removeSelectedText()
+
+    def reset_start(self, block):
+        """Makes *block* the first block of the chain.
+
+        Removing text merges blocks, so the first remaining block may still
+        have the state of the removed one.
+        """
+        self._start_block = block
+        block.setUserState(self.id)
+        block.setVisible(True)
+        BlockData.update_block(block, state=self._state)
+
     def fold(self):
         if self.is_folded or self.count() < 3:
             return
@@ -107,23 +157,125 @@ class BlockChain:
 
         self._fold_block = None
 
+class ChainIndex:
+    """The chains of a document, in document order.
+
+    Chain ids increase in document order, so chains are found by bisecting
+    their ids. The foldable and folded chains are indexed the same way for
+    the "last block" actions, and must be updated with `update` when a
+    chain changes.
+    """
+    def __init__(self):
+        self._chains = {}
+        # ids in document order, from `_head` (see `remove_first`)
+        self._ids = []
+        self._head = 0
+        # ids of unfolded chains that are long enough to be folded
+        self._foldable = []
+        self._folded = []
+
+    def __len__(self):
+        return len(self._ids) - self._head
+
+    def get(self, chain_id):
+        return self._chains[chain_id]
+
+    def first(self):
+        return self._chains[self._ids[self._head]]
+
+    def last(self):
+        return self._chains[self._ids[-1]]
+
+    def add(self, chain):
+        self._chains[chain.id] = chain
+        self._ids.append(chain.id)
+        self.update(chain)
+
+    def remove_first(self):
+        ids = self._ids
+        chain = self._chains.pop(ids[self._head])
+        # removed ids are skipped, and only dropped once they are the
+        # larger part of the list
+        self._head += 1
+        if self._head * 2 > len(ids):
+            del ids[:self._head]
+            self._head = 0
+        _discard(self._foldable, chain.id)
+        _discard(self._folded, chain.id)
+        return chain
+
+    def update(self, chain):
+        """Updates the indexes after *chain* has grown, or been folded or
+        unfolded."""
+        if chain.is_folded:
+            _discard(self._foldable, chain.id)
+            _insert(self._folded, chain.id)
+        else:
+            _discard(self._folded, chain.id)
+            if chain.count() > 2:
+                _insert(self._foldable, chain.id)
+            else:
+                # e.g. after its first blocks were removed
+                _discard(self._foldable, chain.id)
+
+    def between(self, first, last):
+        """Yields the chains from *first* to *last*, inclusive."""
+        ids = self._ids
+        start = bisect.bisect_left(ids, first.id, self._head)
+        end = bisect.bisect_right(ids, last.id, self._head)
+        for i in range(start, end):
+            yield self._chains[ids[i]]
+
+    def last_foldable(self):
+        return self._chains[self._foldable[-1]] if self._foldable else None
+
+    def last_folded(self):
+        return self._chains[self._folded[-1]] if self._folded else None
+
+def _insert(ids, chain_id):
+    i = bisect.bisect_left(ids, chain_id)
+    if i == len(ids) or ids[i] != chain_id:
+        ids.insert(i, chain_id)
+
+def _discard(ids, chain_id):
+    i = bisect.bisect_left(ids, chain_id)
+    if i < len(ids) and ids[i] == chain_id:
+        del ids[i]
+
 class OutputEdit(textedit.TextEdit):
     def __init__(self, parent=None):
         super().__init__(lexer.ConsoleLexer(), parent)
 
-        self._buffer = []
-        # timer used to flush the buffer at regular intervals
-        # (see timerEvent)
-        self.startTimer(BUFFER_TIMEOUT)
+        self._buffer = collections.deque()
+        # flushes the buffer while it has items (see `_flush_buffer`)
+        self._flush_timer = timer = QtCore.QTimer(self)
+        timer.setInterval(BUFFER_TIMEOUT)
+        timer.timeout.connect(self._flush_buffer)
+        # measured speed of insertions, used to size flushes
+        self._flush_rate = FLUSH_RATE
+
+        # highlights deferred blocks while idle (see `_insert_buffer`)
+        self._highlight_timer = timer = QtCore.QTimer(self)
+        timer.setInterval(0)
+        timer.timeout.connect(self._highlight_pending)
+        self.verticalScrollBar().valueChanged.connect(self._highlight_visible)
+        # style changes are highlighted the same way (see `set_style`)
+        self.highlighter.deferred = True
+
+        # lines of scrollback kept in the document (see `_trim`)
+        self._max_lines = MAX_LINES
 
         self.setReadOnly(True)
+        # the undo stack would keep every insertion and eviction
+        self.setUndoRedoEnabled(False)
         self.setTextInteractionFlags(
             Qt.TextSelectableByMouse | Qt.TextSelectableByKeyboard)
 
         # tracks the cursor for the context menu
         self._context_cursor = None
 
-        self._chains = collections.OrderedDict()
+        self._chains = ChainIndex()
+        self._chain_ids = itertools.count()
         self._last_state = None
 
         self.setup_actions()
@@ -154,9 +306,6 @@ class OutputEdit(textedit.TextEdit):
 
     ## events ##
 
-    def timerEvent(self, event):
-        self._flush_buffer()
-
     def contextMenuEvent(self, event):
         menu = self.createStandardContextMenu()
         before = menu.actions()[-2]
@@ -194,6 +343,8 @@ class OutputEdit(textedit.TextEdit):
     def append(self, text='\n', state=None):
         state = BlockState.output if state is None else state
         self._buffer.append((text, state))
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
 
     @QtCore.Slot(str)
     def append_error(self, text):
@@ -216,6 +367,14 @@ class OutputEdit(textedit.TextEdit):
 
         self.append(''.join(text), BlockState.source)
 
+    def append_page(self, text):
+        """Appends *text* as its own output chain, followed by a new
+        prompt."""
+        # end the current prompt line, as for an empty cell
+        self.append('\n', BlockState.source)
+        self.append(text + '\n')
+        self.append_prompt()
+
     def append_session(self, version):
         if self.blockCount() > 1:
             self.append()
@@ -224,13 +383,47 @@ class OutputEdit(textedit.TextEdit):
         self.append_prompt()
 
     def _flush_buffer(self):
-        """Transfers the contents of the output buffer to the widget."""
+        """Transfers the contents of the output buffer to the widget.
+
+        Each flush inserts about as much text as can be inserted within
+        `FLUSH_BUDGET`, going by the speed of earlier flushes, so the UI
+        stays responsive while output is arriving faster than it can be
+        shown. The timer is stopped once the buffer is empty.
+        """
+        if not self._buffer:
+            self._flush_timer.stop()
+            return
 
-        buf = self._buffer
-        if not buf: return
-        # pull a chunk to prevent long rendering delays
-        buf, self._buffer = buf[:BUFFER_CHUNK_SIZE], buf[BUFFER_CHUNK_SIZE:]
+        buf = self._take_buffer(
+            max(FLUSH_MIN_SIZE, int(self._flush_rate * FLUSH_BUDGET)))
+        size = sum(len(item[0]) for item in buf)
+
+        start = time.perf_counter()
+        self._insert_buffer(buf)
+        elapsed = time.perf_counter() - start
 
+        if elapsed > 0:
+            # smooth out the measurements
+            self._flush_rate = 0.5 * self._flush_rate + 0.5 * size / elapsed
+
+        if not self._buffer:
+            self._flush_timer.stop()
+
+    def _take_buffer(self, size):
+        """Removes about *size* characters of items from the buffer."""
+        buf = self._buffer
+        items = []
+        while buf and size > 0:
+            text, state = buf.popleft()
+            if len(text) > size:
+                # put the rest back for the next flush
+                buf.appendleft((text[size:], state))
+                text = text[:size]
+            items.append((text, state))
+            size -= len(text)
+        return items
+
+    def _insert_buffer(self, buf):
         doc = self.document()
         cur = self.textCursor()
         cur.movePosition(cur.MoveOperation.End)
@@ -242,8 +435,9 @@ class OutputEdit(textedit.TextEdit):
             start_block = cur.block()
 
             text = ''.join(item[0] for item in items)
-            # set state context for the highlighter
-            with doc.using_context(state=state):
+            # set state context for the highlighter, which defers lexing
+            # until the visible blocks are known
+            with doc.using_context(state=state, defer=True):
                 cur.insertText(text)
 
             # register the block chain for this insertion
@@ -254,17 +448,97 @@ class OutputEdit(textedit.TextEdit):
 
             if state != self._last_state or is_prompt(state, text):
                 # new chain
-                chain = BlockChain(len(self._chains), doc, state, start_block)
-                self._chains[chain.id] = chain
+                chain = BlockChain(next(self._chain_ids), doc, state,
+                    start_block)
+                self._chains.add(chain)
             else:
                 # last chain
-                chain = next(reversed(self._chains.values()))
+                chain = self._chains.last()
 
             chain.add_blocks(start_block, end_block)
+            self._chains.update(chain)
             self._last_state = state
 
+        self._trim()
         self.scroll_to_bottom()
 
+        self._highlight_deferred()
+
+    ## highlighting ##
+
+    def set_style(self, style):
+        super().set_style(style)
+        self._highlight_deferred()
+
+    def _highlight_deferred(self):
+        """Highlights the deferred blocks in view, and the rest while
+        idle."""
+        self._highlight_visible()
+        if not self._highlight_timer.isActive():
+            self._highlight_timer.start()
+
+    def _highlight_visible(self):
+        """Highlights the deferred blocks in and around the viewport."""
+        block = self.firstVisibleBlock()
+        for _ in range(HIGHLIGHT_MARGIN):
+            if not block.previous().isValid():
+                break
+            block = block.previous()
+
+        lines = self.viewport().height() // self.fontMetrics().lineSpacing()
+        last = self.document().findBlockByNumber(
+            block.blockNumber() + lines + 2 * HIGHLIGHT_MARGIN)
+        if not last.isValid():
+            last = self.document().lastBlock()
+
+        self.highlighter.highlight_blocks(self.document().blocks(block, last))
+
+    def _highlight_pending(self):
+        """Highlights the rest of the deferred blocks, a little at a time."""
+        if not self.highlighter.highlight_pending(HIGHLIGHT_BUDGET):
+            self._highlight_timer.stop()
+
+    ## scrollback ##
+
+    def set_max_lines(self, count):
+        """Sets the number of lines of scrollback to keep (0 for no
+        limit)."""
+        self._max_lines = count
+        self._trim()
+
+    def _trim(self):
+        """Evicts the oldest chains while the document has more lines than
+        the scrollback limit.
+
+        Chains are evicted whole, so chain lookups stay valid. The last chain
+        is still being appended to, so it is only shortened.
+        """
+        if not self._max_lines:
+            return
+
+        doc = self.document()
+        chains = self._chains
+        excess = doc.blockCount() - self._max_lines
+        while excess > 0 and chains:
+            chain = chains.first()
+            count = chain.line_count()
+            if count <= excess and len(chains) > 1:
+                chain.remove()
+                chains.remove_first()
+                chain = chains.first()
+            else:
+                # shorten a long chain instead of removing it
+                count = min(excess, chain.count() - 1)
+                if count <= 0:
+                    break
+                chain.remove_start(count)
+                chains.update(chain)
+
+            block = doc.firstBlock()
+            chain.reset_start(block)
+            self.highlighter.rehighlightBlock(block)
+            excess -= count
+
     ## blocks ##
 
     def copy_source(self):
@@ -282,14 +556,28 @@ class OutputEdit(textedit.TextEdit):
         cur.movePosition(cur.MoveOperation.Right, cur.MoveMode.KeepAnchor, end - cur.position())
         end_block = cur.block()
 
-        # find source blocks
-        # XXX: should be something more efficient here using chains
+        # find source blocks, skipping over chains of other output
         # XXX: should only copy selected text
+        start_number = start_block.blockNumber()
+        end_number = end_block.blockNumber()
+
         text = []
-        for block in doc.blocks(start_block, end_block):
-            chain = self._get_chain(block)
-            if chain.state == BlockState.source:
-                text.append(self._source_line(block.text()))
+        chains = self._chains.between(
+            self._get_chain(start_block), self._get_chain(end_block))
+        for chain in chains:
+            if chain.state != BlockState.source:
+                continue
+
+            first = chain.start_block
+            if first.blockNumber() < start_number:
+                first = start_block
+            last = chain.end_block
+            if last.blockNumber() > end_number:
+                last = end_block
+
+            for block in doc.blocks(first, last):
+                if block != chain.fold_block:
+                    text.append(self._source_line(block.text()))
 
         clip.setText('\n'.join(text))
 
@@ -297,30 +585,28 @@ class OutputEdit(textedit.TextEdit):
 
     def fold_block(self, last=False):
         if last:
-            # find last unfolded chain
-            for chain in reversed(self._chains.values()):
-                if not chain.is_folded and chain.count() > 2:
-                    break
-            else:
+            chain = self._chains.last_foldable()
+            if chain is None:
                 return
         else:
             cur = self._get_context_cursor()
             chain = self._get_chain(cur.block())
 
         chain.fold()
+        self._chains.update(chain)
         self.reset()
 
     def unfold_block(self, last=False):
         if last:
-            # find last folded chain
-            for chain in reversed(self._chains.values()):
-                if chain.is_folded:
-                    break
+            chain = self._chains.last_folded()
+            if chain is None:
+                return
         else:
             cur = self._get_context_cursor()
             chain = self._get_chain(cur.block())
 
         chain.unfold()
+        self._chains.update(chain)
         self.reset()
         self.scroll_to_block(chain.end_block)
 
@@ -337,11 +623,12 @@ class OutputEdit(textedit.TextEdit):
         return cur or self.textCursor()
 
     def _get_chain(self, block):
-        return self._chains[block.userState()]
+        # blocks are tagged with the id of their chain
+        return self._chains.get(block.userState())
 
     def _is_fold_block(self, block):
         chain = self._get_chain(block)
-        return chain._fold_block == block
+        return chain.fold_block == block
 
     def _source_line(self, line):
         return rx_ps.sub('', line).rstrip()
@@ -1,12 +1,24 @@
+import collections
+
+from ..lib import logs
 from ..lib import utils
 
 from . import control
 from .utils import virtualenvs
 
+log = logs.get(__name__)
+
 class Profiles:
-    def __init__(self, profiles, verbose=0):
+    def __init__(self, profiles, verbose=0, fork_server=False, preload=()):
         self._profiles = dict(self._parse_profiles(profiles))
         self._verbose = verbose
+        # controls prepared ahead of time for each profile (see `prepare`)
+        self._standby = collections.defaultdict(collections.deque)
+
+        # fork servers for each command, if enabled (see `ForkServer`)
+        self._fork_server = fork_server and not utils.IS_WINDOWS
+        self._preload = preload
+        self._fork_servers = {}
 
     @property
     def _venvs(self):
@@ -25,12 +37,70 @@ class Profiles:
             sec = self._venvs[name]
         return next(iter(sec.items()))
 
-    def get_control(self, profile_name):
+    def get_control(self, profile_name, startup_path=None):
+        """Returns a control for the profile, preferring one prepared ahead
+        of time. A prepared control must be released rather than started.
+        """
+        standby = self._standby.get(profile_name)
+        while standby:
+            ctl = standby.popleft()
+            if ctl.is_running:
+                log.debug('using prepared control: %s', profile_name)
+                return ctl
+            ctl.stop()
+
+        ctl = self._create_control(profile_name)
+        ctl.startup_path = startup_path
+        return ctl
+
+    def prepare(self, names, size, startup_path=None):
+        """Keeps *size* processes started ahead of time for each of the
+        command profiles in *names*, and stops those of other profiles.
+        """
+        for name in list(self._standby):
+            if name not in names:
+                self._stop_standby(name)
+
+        for name in names:
+            try:
+                type, _ = self.get_profile(name)
+            except KeyError:
+                log.warning('unknown profile: %s', name)
+                continue
+            if type != 'command':
+                continue
+
+            standby = self._standby[name]
+            while len(standby) < size:
+                log.debug('preparing control: %s', name)
+                ctl = self._create_control(name)
+                ctl.startup_path = startup_path
+                ctl.prepare()
+                standby.append(ctl)
+
+    def stop_standby(self):
+        """Stops every control prepared ahead of time."""
+        for name in list(self._standby):
+            self._stop_standby(name)
+
+    def close(self):
+        """Stops the prepared controls and the fork servers."""
+        self.stop_standby()
+        for server in self._fork_servers.values():
+            server.stop()
+        self._fork_servers.clear()
+
+    def _stop_standby(self, name):
+        for ctl in self._standby.pop(name):
+            ctl.stop()
+
+    def _create_control(self, profile_name):
         type, value = self.get_profile(profile_name)
 
         if type == 'command':
             cmd = value or utils.DEFAULT_COMMAND
-            return control.ProcessControl(('localhost', 0), cmd, self._verbose)
+            return control.ProcessControl(('localhost', 0), cmd, self._verbose,
+                fork_server=self._get_fork_server(cmd))
 
         elif type == 'connect':
             addr = utils.parse_address(value or utils.DEFAULT_ADDR)
@@ -42,6 +112,15 @@ class Profiles:
 
         assert False, 'invalid control init'
 
+    def _get_fork_server(self, command):
+        if not self._fork_server:
+            return None
+        server = self._fork_servers.get(command)
+        if server is None:
+            server = control.ForkServer(command, self._preload, self._verbose)
+            self._fork_servers[command] = server
+        return server
+
     def _parse_profiles(self, profiles):
         for profile, value in profiles.items():
             name, type = profile.split('.')
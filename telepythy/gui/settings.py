@@ -128,8 +128,6 @@ class SettingsWidget(QtWidgets.QWidget):
                     log.error('unknown theme: %s', name)
 
             app.setStyleSheet(stylesheet)
-            win.output_edit.highlighter.rehighlight()
-            win.source_edit.highlighter.rehighlight()
 
             self.theme_combo.setCurrentText(name)
 
@@ -151,6 +149,12 @@ class SettingsWidget(QtWidgets.QWidget):
             self.font_combo.setCurrentFont(font)
             self.font_size_box.setValue(font.pointSize())
 
+            # output
+            win.output_edit.set_max_lines(cfg['output.max_lines'])
+
+            # history
+            win.source_edit.set_history_path(cfg['history.path'])
+
             # startup
             sct = cfg.section('startup')
             self.tips_checkbox.setChecked(sct['show_tips'])
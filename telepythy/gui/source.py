@@ -11,14 +11,156 @@ from .history import History
 COMPLETER_KEYS = frozenset([
     Qt.Key_Return, Qt.Key_Enter, Qt.Key_Escape, Qt.Key_Tab, Qt.Key_Backtab])
 
+# holds the kind of a completion match
+KIND_ROLE = Qt.UserRole + 1
+
 _rx_context = re.compile(r'[_A-Za-z0-9.()"\'\[\]]+$')
 def get_completion_context(line):
     match = _rx_context.search(line)
     return (match and match.group()) or ''
 
+def format_details(name, details):
+    text = '{} {}{}'.format(details['kind'], name, details.get('signature', ''))
+    doc = details.get('doc')
+    if doc:
+        text += '\n\n' + doc
+    return text
+
+class CompletionModel(QtCore.QAbstractListModel):
+    """The completion matches, with their kinds and details.
+
+    Details are fetched on demand, and cached by the id of the object (or
+    namespace) the names belong to, until `clear_details` is called.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._matches = []
+        self._kinds = []
+        self._parent_id = None
+        self._details = {}
+
+    def set_matches(self, matches, kinds=None, parent_id=None):
+        self.beginResetModel()
+        self._matches = matches
+        self._kinds = kinds or [None] * len(matches)
+        self._parent_id = parent_id
+        self.endResetModel()
+
+    def get_details(self, name):
+        return self._details.get((self._parent_id, name))
+
+    def set_details(self, name, details):
+        self._details[(self._parent_id, name)] = details
+        try:
+            row = self._matches.index(name)
+        except ValueError:
+            return
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ToolTipRole])
+
+    def clear_details(self):
+        self._details.clear()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._matches)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = index.row()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self._matches[row]
+        elif role == KIND_ROLE:
+            return self._kinds[row]
+        elif role == Qt.ToolTipRole:
+            name = self._matches[row]
+            details = self.get_details(name)
+            if details is None:
+                return self._kinds[row]
+            return format_details(name, details)
+        return None
+
+class HistorySearch(QtWidgets.QFrame):
+    """A popup that searches the history as the query is typed.
+
+    Up/Down (or Ctrl+R) select a result, Return accepts it and Escape
+    closes the popup.
+    """
+    accepted = QtCore.Signal(str)
+
+    def __init__(self, parent):
+        super().__init__(parent, Qt.Popup)
+        self.setFrameShape(self.Shape.StyledPanel)
+        self._history = None
+
+        self._list = QtWidgets.QListWidget(self)
+        self._list.setFocusPolicy(Qt.NoFocus)
+        self._list.itemActivated.connect(self._accept_item)
+
+        self._edit = QtWidgets.QLineEdit(self)
+        self._edit.setPlaceholderText('Search history')
+        self._edit.textChanged.connect(self.refresh)
+        self._edit.installEventFilter(self)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(0)
+        layout.addWidget(self._list)
+        layout.addWidget(self._edit)
+
+    def search(self, history, rect):
+        """Shows the popup over *rect* (in global coordinates)."""
+        self._history = history
+        self._edit.clear()
+        self.refresh()
+
+        self.setGeometry(rect)
+        self.show()
+        self._edit.setFocus()
+
+    def refresh(self):
+        lst = self._list
+        lst.clear()
+        for _, value in self._history.find(self._edit.text()):
+            lines = value.splitlines()
+            item = QtWidgets.QListWidgetItem(
+                lines[0] + (' ...' if len(lines) > 1 else ''))
+            item.setData(Qt.UserRole, value)
+            item.setToolTip(value)
+            lst.addItem(item)
+        lst.setCurrentRow(0)
+
+    def eventFilter(self, obj, event):
+        if event.type() != QtCore.QEvent.KeyPress:
+            return False
+
+        key = event.key()
+        ctrl = event.modifiers() & Qt.ControlModifier
+        lst = self._list
+        if key == Qt.Key_Up:
+            lst.setCurrentRow(max(0, lst.currentRow() - 1))
+        elif key == Qt.Key_Down or (ctrl and key == Qt.Key_R):
+            lst.setCurrentRow(min(lst.count() - 1, lst.currentRow() + 1))
+        elif key in (Qt.Key_Return, Qt.Key_Enter):
+            item = lst.currentItem()
+            if item:
+                self._accept_item(item)
+            else:
+                self.hide()
+        else:
+            return False
+        return True
+
+    def _accept_item(self, item):
+        self.hide()
+        self.accepted.emit(item.data(Qt.UserRole))
+
 class SourceEdit(textedit.TextEdit):
     evaluation_requested = QtCore.Signal(str)
     completion_requested = QtCore.Signal(str)
+    inspection_requested = QtCore.Signal(str)
+    eof_requested = QtCore.Signal()
 
     def __init__(self, parent=None):
         super().__init__(lexer.Lexer(), parent)
@@ -29,27 +171,39 @@ class SourceEdit(textedit.TextEdit):
 
         self.setLineWrapMode(self.LineWrapMode.NoWrap)
 
-        self.completer_model = QtGui.QStandardItemModel()
+        self.completer_model = CompletionModel(self)
         self.completer = QtWidgets.QCompleter(self.completer_model, self)
         self.completer.setWidget(self)
         self.completer.setCompletionMode(self.completer.CompletionMode.PopupCompletion)
         self.completer.activated[str].connect(self.complete)
+        self.completer.highlighted[str].connect(self.inspect_completion)
+        # the matches are ranked by the service
+        self.completer.setModelSorting(
+            self.completer.ModelSorting.UnsortedModel)
+        # set if the service left out some matches
+        self._completion_truncated = False
+        # the path of the object the matches are attributes of
+        self._completion_parent = ''
 
         self.textChanged.connect(self.refresh_completer)
 
-    def show_completer(self, matches):
+        self.history_search = HistorySearch(self)
+        self.history_search.accepted.connect(self.load_history)
+
+    def show_completer(self, completion):
+        matches = completion['matches']
         if not matches:
             return
 
         completer = self.completer
         completer.setCompletionPrefix('')
 
-        model = self.completer_model
-        model.clear()
+        self.completer_model.set_matches(matches,
+            completion.get('kinds'), completion.get('id'))
+        self._completion_truncated = completion.get('truncated', False)
 
-        for match in matches:
-            item = QtGui.QStandardItem(match)
-            model.appendRow(item)
+        ctx = self.completion_context()
+        self._completion_parent = ctx.rsplit('.', 1)[0] if '.' in ctx else ''
 
         # refresh first to ensure correct completion count
         self.refresh_completer(force=True)
@@ -73,24 +227,69 @@ class SourceEdit(textedit.TextEdit):
         completer = self.completer
         popup = completer.popup()
 
-        ident = self.completion_context().split('.')[-1]
+        ctx = self.completion_context()
+        ident = ctx.split('.')[-1]
         if not ident.strip():
             popup.hide()
 
+        if (not force and self._completion_truncated and
+                ident.startswith(completer.completionPrefix())):
+            # matches for the narrower prefix may have been left out, so
+            # they are requested again
+            self._completion_truncated = False
+            self.completion_requested.emit(ctx)
+
         self.completer.setCompletionPrefix(ident)
         if completer.completionCount() == 0:
             popup.hide()
 
-        item = self.completer_model.item(0)
-        if item:
-            popup.setCurrentIndex(item.index())
+        index = completer.completionModel().index(0, 0)
+        if index.isValid():
+            popup.setCurrentIndex(index)
 
     def complete(self, match):
         ident = self.completion_context().split('.')[-1]
         text = match[len(ident):]
 
         self.insertPlainText(text)
-        self.completer_model.clear()
+        self.completer_model.set_matches([])
+
+    def inspect_completion(self, name):
+        """Shows the details of a match, requesting them if necessary."""
+        details = self.completer_model.get_details(name)
+        if details is None:
+            self.inspection_requested.emit(self._completion_path(name))
+        else:
+            self._show_details(name, details)
+
+    def show_inspection(self, inspection):
+        parent, _, name = inspection['path'].rpartition('.')
+        if parent != self._completion_parent or 'kind' not in inspection:
+            # stale, or not found
+            return
+
+        details = dict(inspection)
+        del details['path']
+        self.completer_model.set_details(name, details)
+
+        popup = self.completer.popup()
+        index = popup.currentIndex()
+        if popup.isVisible() and index.data() == name:
+            self._show_details(name, details)
+
+    def clear_inspections(self):
+        """Forgets fetched details, since the namespace may have changed."""
+        self.completer_model.clear_details()
+
+    def _show_details(self, name, details):
+        popup = self.completer.popup()
+        rect = popup.visualRect(popup.currentIndex())
+        pos = popup.viewport().mapToGlobal(rect.topRight())
+        QtWidgets.QToolTip.showText(pos, format_details(name, details), popup)
+
+    def _completion_path(self, name):
+        parent = self._completion_parent
+        return '{}.{}'.format(parent, name) if parent else name
 
     def completion_context(self):
         cur = self.textCursor()
@@ -99,6 +298,13 @@ class SourceEdit(textedit.TextEdit):
 
         return get_completion_context(sel)
 
+    def set_history_path(self, path):
+        """Keeps the history in the file at *path* (in memory if empty)."""
+        path = path or None
+        if path != self._history.path:
+            self._history = History(path)
+            self._user_source = None
+
     def history_previous(self):
         """Loads previous history state."""
         if not self._history:
@@ -126,6 +332,19 @@ class SourceEdit(textedit.TextEdit):
             self.setPlainText(self._user_source)
         self.move_cursor(QtGui.QTextCursor.End)
 
+    def search_history(self):
+        """Shows the history search above the source editor."""
+        height = self.fontMetrics().lineSpacing() * 16
+        pos = self.mapToGlobal(QtCore.QPoint(0, 0))
+        rect = QtCore.QRect(pos.x(), pos.y() - height, self.width(), height)
+        self.history_search.search(self._history, rect)
+
+    def load_history(self, source):
+        """Replaces the source with a history entry."""
+        self.history_reset()
+        self.setPlainText(source)
+        self.move_cursor(QtGui.QTextCursor.End)
+
     def history_reset(self):
         """Clears history state."""
         self._history.reset()
@@ -228,6 +447,15 @@ class SourceEdit(textedit.TextEdit):
             self.history_next()
             return
 
+        elif ctrl and key == Qt.Key_R:
+            self.search_history()
+            return
+
+        elif ctrl and key == Qt.Key_D and not self.toPlainText():
+            # ends the input of code reading from stdin
+            self.eof_requested.emit()
+            return
+
         elif key == Qt.Key_Backspace:
             cursor = self.textCursor()
             text = cursor.block().text()[:cursor.positionInBlock()]
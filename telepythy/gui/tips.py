@@ -22,5 +22,6 @@ _tips = [
 'Save a copy of `telepythy_service.pyz`, and copy it anywhere. It can be run directly using `python telepythy_service.pyz`.',
 '`Ctrl+Return` or `Enter` (on the keypad) will always execute your code. If there is only one line, just `Return` is enough. Add a `space` to the end of the line to avoid executing.',
 'Hit `F12` to popup the settings pane.',
+'`Ctrl+R` searches the history of your code. The letters of every word you type must appear in a result in the same order, but not always side by side, so `nz` finds `numpy.zeros`.',
 'You can run a startup script for every new session. Just add your code to `<config-dir>/startup.py`. This is convenient for common imports and utility functions.',
 ]
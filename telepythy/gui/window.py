@@ -23,7 +23,9 @@ class Window(QtWidgets.QMainWindow):
     error_received = QtCore.Signal(str)
     stdout_received = QtCore.Signal(str)
     stderr_received = QtCore.Signal(str)
-    completion_received = QtCore.Signal(list)
+    completion_received = QtCore.Signal(dict)
+    inspection_received = QtCore.Signal(dict)
+    result_received = QtCore.Signal(dict)
     status_connected = QtCore.Signal(tuple)
     status_disconnected = QtCore.Signal(str)
 
@@ -43,6 +45,9 @@ class Window(QtWidgets.QMainWindow):
 
         self._connected = None
         self._history_result = collections.OrderedDict()
+        # the next page of a result to request (id, offset), or None once
+        # the last page has been shown
+        self._result_page = (None, None)
 
         self._debug = debug
         self._debug_server = None
@@ -90,6 +95,10 @@ class Window(QtWidgets.QMainWindow):
         self.action_restart.setShortcut('Ctrl+F6')
         self.addAction(self.action_restart)
 
+        self.action_more_result = QtWidgets.QAction('Show More of Result')
+        self.action_more_result.setShortcut('Ctrl+Shift+m')
+        self.addAction(self.action_more_result)
+
         self.action_toggle_menu = QtWidgets.QAction('Menu')
         self.action_toggle_menu.setCheckable(True)
         self.action_toggle_menu.setChecked(True)
@@ -138,6 +147,8 @@ class Window(QtWidgets.QMainWindow):
         self.output_menu = menu = QtWidgets.QMenu('Output', self)
         menu.addAction(self.output_edit.action_fold_last_block)
         menu.addAction(self.output_edit.action_unfold_last_block)
+        menu.addSeparator()
+        menu.addAction(self.action_more_result)
 
         self.view_menu = menu = QtWidgets.QMenu('View', self)
         menu.addAction(self.action_toggle_menu)
@@ -234,6 +245,7 @@ class Window(QtWidgets.QMainWindow):
         self.action_quit.triggered.connect(self.close)
         self.action_interrupt.triggered.connect(self.check_interrupt)
         self.action_restart.triggered.connect(self.restart)
+        self.action_more_result.triggered.connect(self.request_result)
 
         self.action_toggle_menu.toggled.connect(self.menuBar().setVisible)
 
@@ -254,14 +266,19 @@ class Window(QtWidgets.QMainWindow):
 
         self.source_edit.evaluation_requested.connect(self.evaluate)
         self.source_edit.completion_requested.connect(self.complete)
+        self.source_edit.inspection_requested.connect(self.inspect)
+        self.source_edit.eof_requested.connect(self.send_eof)
 
         self.output_started.connect(self.start_session)
         self.output_stopped.connect(self.output_edit.append_prompt)
+        self.output_stopped.connect(self.source_edit.clear_inspections)
         self.error_received.connect(self.output_edit.append_error)
         self.stdout_received.connect(self.output_edit.append)
         self.stderr_received.connect(self.output_edit.append)
+        self.result_received.connect(self.show_result)
 
         self.completion_received.connect(self.source_edit.show_completer)
+        self.inspection_received.connect(self.source_edit.show_inspection)
 
         self.status_connected.connect(self._set_connected)
         self.status_disconnected.connect(self._set_disconnected)
@@ -278,6 +295,7 @@ class Window(QtWidgets.QMainWindow):
 
     def closeEvent(self, event):
         self._control.stop()
+        self._profiles.close()
 
     ## actions ##
 
@@ -326,7 +344,8 @@ class Window(QtWidgets.QMainWindow):
             self._control = None
         self._set_disconnected(force=True)
 
-        self._control = ctl = self._profiles.get_control(name)
+        self._control = ctl = self._profiles.get_control(name,
+            self._config['startup.source_path'])
 
         ctl.register(None, lambda address: self.status_connected.emit(address))
         def start(event):
@@ -350,25 +369,43 @@ class Window(QtWidgets.QMainWindow):
             self.stderr_received.emit(text)
         ctl.register('stderr', stderr)
 
+        def dropped(event):
+            lines = event['data']['lines']
+            self.stderr_received.emit(
+                '[{} lines of output dropped]\n'.format(lines))
+        ctl.register('dropped', dropped)
+
         def completion(event):
-            matches = event['data']['matches']
-            self.completion_received.emit(matches)
+            self.completion_received.emit(event['data'])
         ctl.register('completion', completion)
 
+        def inspection(event):
+            self.inspection_received.emit(event['data'])
+        ctl.register('inspection', inspection)
+
+        def result(event):
+            self.result_received.emit(event['data'])
+        ctl.register('result', result)
+
         def exception(err):
             log.debug('totally normal events error: %s', err)
             self.status_disconnected.emit(err)
         ctl.register('exception', exception)
 
-        ctl.start()
-
+        # set first, since releasing a prepared control starts the session,
+        # which prepares the next controls for the current profile
         self.profile_button.setText(name)
-
         self._profile = name
 
+        if ctl.prepared:
+            # already started, with the startup source evaluated
+            ctl.release()
+        else:
+            ctl.start()
+
     def restart(self):
-        self._control.restart()
-        self._set_disconnected(force=True)
+        # a new control, which may have been prepared ahead of time
+        self.set_profile(self._profile)
 
     def check_interrupt(self):
         try:
@@ -381,17 +418,13 @@ class Window(QtWidgets.QMainWindow):
     def start_session(self, version):
         self.output_edit.append_session(version)
 
-        path = self._config['startup.source_path']
-        try:
-            with open(path) as f:
-                source = f.read()
-        except FileNotFoundError:
-            log.debug('startup file not found: %s', path)
-        except OSError as e:
-            log.error('failed to read startup file: %s', e)
-        else:
-            if source:
-                self._control.evaluate(source, notify=False)
+        # the control evaluates the startup source, and the next session
+        # is started in the background
+        cfg = self._config
+        names = [self._profile]
+        names.extend(n for n in cfg['pool.profiles'] if n != self._profile)
+        self._profiles.prepare(names, cfg['pool.size'],
+            cfg['startup.source_path'])
 
     def evaluate(self, source):
         try:
@@ -402,6 +435,37 @@ class Window(QtWidgets.QMainWindow):
         else:
             self.output_edit.append_source(source)
             self.source_edit.next_cell()
+            # pages continue from the preview of the new result
+            self._result_page = (None, None)
+
+    def request_result(self):
+        """Requests the next page of the last result that was truncated."""
+        if self._result_page is None:
+            return
+        try:
+            self._control.result(*self._result_page)
+        except Exception as e:
+            log.debug('totally normal result error: %s', e)
+            self.status_disconnected.emit(str(e))
+
+    def show_result(self, page):
+        text = page['text']
+        if not text:
+            return
+
+        if page['more']:
+            self._result_page = (page['id'], page['offset'] + len(text))
+            text += '...'
+        else:
+            self._result_page = None
+        self.output_edit.append_page(text)
+
+    def send_eof(self):
+        try:
+            self._control.send_eof()
+        except Exception as e:
+            log.debug('totally normal eof error: %s', e)
+            self.status_disconnected.emit(str(e))
 
     def interrupt(self):
         try:
@@ -417,6 +481,13 @@ class Window(QtWidgets.QMainWindow):
             log.debug('totally normal complete error: %s', e)
             self.status_disconnected.emit(str(e))
 
+    def inspect(self, path):
+        try:
+            self._control.inspect(path)
+        except Exception as e:
+            log.debug('totally normal inspect error: %s', e)
+            self.status_disconnected.emit(str(e))
+
     ## status ##
 
     def _set_connected(self, address):
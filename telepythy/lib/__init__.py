@@ -50,3 +50,27 @@ def start_server(locals=None, address=None, init_shell=False):
     svc = Server(locals, init_shell=init_shell)
     svc.start(address or utils.DEFAULT_ADDR)
     return svc
+
+def start_async_client(locals=None, address=None, init_shell=False):
+    """Starts a client as a task in the running asyncio event loop.
+
+    Arguments are the same as those for `client`.
+
+    Returns an `AsyncClient` instance.
+    """
+    from .aio import AsyncClient
+    svc = AsyncClient(locals, init_shell=init_shell)
+    svc.start(address or utils.DEFAULT_ADDR)
+    return svc
+
+def start_async_server(locals=None, address=None, init_shell=False):
+    """Starts a server as a task in the running asyncio event loop.
+
+    Arguments are the same as those for `server`.
+
+    Returns an `AsyncServer` instance.
+    """
+    from .aio import AsyncServer
+    svc = AsyncServer(locals, init_shell=init_shell)
+    svc.start(address or utils.DEFAULT_ADDR)
+    return svc
@@ -19,6 +19,13 @@ def main():
     group.add_argument('-c', '--connect', nargs='?', default=False,
         help='<host>:<port> to connect to (default: {})'.format(
             utils.DEFAULT_ADDR))
+    group.add_argument('--fork-server', action='store_true',
+        help='fork a client for each <host>:<port> line read from stdin, '
+            'writing its pid to stdout (not on windows)')
+
+    parser.add_argument('--preload', default='',
+        help='comma-separated modules for the fork server to import '
+            'before forking')
 
     parser.add_argument('--log-file', help='output logs to the specified file')
     parser.add_argument('-v', '--verbose', action='count',
@@ -36,7 +43,11 @@ def main():
     utils.set_console_ctrl_handler()
 
     # serve unless connect is set
-    if args.connect is not False:
+    if args.fork_server:
+        from . import forkserver
+        forkserver.serve([n.strip() for n in args.preload.split(',')
+            if n.strip()])
+    elif args.connect is not False:
         client(address=args.connect, init_shell=True)
     else:
         server(address=args.serve, init_shell=True)
@@ -0,0 +1,257 @@
+import sys
+import queue
+import asyncio
+import threading
+
+from . import logs
+from . import utils
+from . import codec
+from .service import NAMESPACES
+from .service import Service, ServiceError, EventQueue, FLUSH_LATENCY
+
+RETRY_INTERVAL = 1 # seconds
+
+log = logs.get(__name__)
+
+class AsyncSockIO(object):
+    """The `sockio.SockIO` protocol over a pair of asyncio streams.
+
+    Messages are buffered by `sendmsg`, and flushed with `drain`.
+    """
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._codec = codec.JSONCodec
+        self._framing = codec.Framing()
+
+    @property
+    def codec(self):
+        return self._codec.name
+
+    @codec.setter
+    def codec(self, name):
+        self._codec = codec.get(name)
+        log.debug('codec: %s', name)
+
+    @property
+    def compression(self):
+        return self._framing.compression
+
+    @compression.setter
+    def compression(self, name):
+        self._framing.compression = name
+        log.debug('compression: %s', name)
+
+    def get_stats(self):
+        return self._framing.get_stats()
+
+    @property
+    def address(self):
+        return self._writer.get_extra_info('peername')[:2]
+
+    def sendmsg(self, msg):
+        self._writer.write(self._framing.frame(self._codec.encode(msg)))
+
+    async def recvmsg(self):
+        reader = self._reader
+        framing = self._framing
+        size, compressed = framing.read_header(await reader.readexactly(4))
+        data = framing.read(await reader.readexactly(size), compressed)
+        return codec.decode(data)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def close(self):
+        self._writer.close()
+
+class AsyncService(Service):
+    """Base class for asyncio client/server services.
+
+    Connections are handled by tasks in the running event loop. Code is
+    evaluated in *executor* (the loop's default executor if `None`), so
+    long-running evaluations do not block the loop.
+    """
+    def __init__(self, *args, executor=None, **kwargs):
+        self._loop = None
+        self._sessions_ready = set()
+        self._handlers = set()
+
+        super(AsyncService, self).__init__(*args, **kwargs)
+
+        self._executor = executor
+        self._task = None
+        self._eval_thread = None
+
+    def start(self, address):
+        """Starts the service as a task in the running event loop."""
+        if self._task is not None:
+            raise ServiceError('task already running')
+        self._task = asyncio.ensure_future(self._main(address))
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _main(self, address):
+        raise NotImplementedError()
+
+    ## execution ##
+
+    def _setup(self):
+        """Creates the loop primitives. Called from the running loop."""
+        self._loop = asyncio.get_event_loop()
+        self._code_queue = asyncio.Queue()
+
+    def _create_event_queue(self):
+        # output is coalesced by waiting in `_handle_events` instead
+        return EventQueue(0, self._flush_size, self._notify_events,
+            self._max_events, self._max_size, self._overflow)
+
+    async def run(self):
+        loop = self._loop
+
+        with self._inter.hooked():
+            while True:
+                func = await self._code_queue.get()
+                await loop.run_in_executor(self._executor,
+                    self._evaluate_in_thread, func)
+
+    def _evaluate_in_thread(self, func):
+        self._eval_thread = threading.current_thread().ident
+        try:
+            func()
+        finally:
+            self._eval_thread = None
+
+    def _interrupt_shared(self):
+        # a signal would be delivered to the event loop's thread
+        ident = self._eval_thread
+        if ident is not None:
+            utils.interrupt_thread(ident)
+
+    ## handlers ##
+
+    def _notify_events(self):
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wake_sessions)
+
+    def _wake_sessions(self):
+        for ready in self._sessions_ready:
+            ready.set()
+
+    async def _handle(self, reader, writer):
+        sock = AsyncSockIO(reader, writer)
+        log.info('connected: %s:%s', *sock.address)
+
+        session = self._sessions.open(sock)
+        ready = asyncio.Event()
+        self._sessions_ready.add(ready)
+        # events may have been held for this session
+        ready.set()
+
+        self._handlers.add(asyncio.current_task())
+        try:
+            session.add_event('start', version=sys.version,
+                codecs=codec.CODECS, namespaces=NAMESPACES,
+                compressions=codec.COMPRESSIONS)
+
+            tasks = [
+                asyncio.ensure_future(self._handle_events(session, ready)),
+                asyncio.ensure_future(self._handle_commands(session)),
+                ]
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            self._sessions_ready.discard(ready)
+            self._sessions.remove(session)
+            sock.close()
+
+    async def _handle_events(self, session, ready):
+        sock = session.sock
+        events = session.events
+
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(ready.wait(), self._keepalive)
+                except asyncio.TimeoutError:
+                    # the link has been idle, so send a keepalive
+                    sock.sendmsg(None)
+                    await sock.drain()
+                    continue
+
+                ready.clear()
+                # give the output a chance to accumulate more writes
+                await asyncio.sleep(self._flush_latency
+                    if self._flush_latency is not None else FLUSH_LATENCY)
+
+                while True:
+                    try:
+                        event = events.get(timeout=0)
+                    except queue.Empty:
+                        break
+                    sock.sendmsg(event)
+                    await sock.drain()
+        except (OSError, EOFError) as e:
+            log.error('handle_events error: %s', repr(e))
+
+    async def _handle_commands(self, session):
+        sock = session.sock
+        try:
+            while True:
+                self._handle_command(session, await sock.recvmsg())
+        except (OSError, EOFError) as e:
+            log.error('handle_commands error: %s', repr(e))
+
+class AsyncClient(AsyncService):
+    async def _main(self, address):
+        await self.connect(address)
+
+    async def connect(self, address, retry_interval=RETRY_INTERVAL):
+        host, port = utils.parse_address(address)
+
+        self._setup()
+        runner = asyncio.ensure_future(self.run())
+        try:
+            while True:
+                log.debug('connecting: %s:%s', host, port)
+                try:
+                    reader, writer = await asyncio.open_connection(host, port)
+                except OSError as e:
+                    log.error('connection error: %s', e)
+                else:
+                    await self._handle(reader, writer)
+
+                await asyncio.sleep(retry_interval)
+                log.warning('retrying connection')
+        finally:
+            runner.cancel()
+
+class AsyncServer(AsyncService):
+    async def _main(self, address):
+        await self.serve(address)
+
+    async def serve(self, address):
+        host, port = utils.parse_address(address)
+
+        self._setup()
+        runner = asyncio.ensure_future(self.run())
+
+        server = await asyncio.start_server(self._handle, host, port)
+        log.info('listening: %s:%s', *server.sockets[0].getsockname()[:2])
+        try:
+            await runner
+        finally:
+            runner.cancel()
+            server.close()
+            for handler in list(self._handlers):
+                handler.cancel()
+            await server.wait_closed()
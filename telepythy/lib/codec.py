@@ -0,0 +1,369 @@
+# Message codecs for the wire protocol.
+#
+# Binary frames start with MAGIC, which can never start a JSON document, so
+# every frame identifies its own codec. This lets each peer switch its
+# sending codec independently once the other side has advertised support.
+#
+# The same goes for compression: compressed frames are flagged in the length
+# prefix, and each direction of a connection is a single zlib stream.
+
+import json
+import zlib
+import struct
+
+JSON = 'json'
+BINARY = 'binary'
+
+# codecs in order of preference
+CODECS = (BINARY, JSON)
+
+# 0xc1 is never used by msgpack, and is not valid UTF-8
+MAGIC = b'\xc1'
+
+# message type codes
+MSG_NONE = 0x00
+MSG_OBJECT = 0x01
+MSG_STDOUT = 0x02
+MSG_STDERR = 0x03
+MSG_DONE = 0x04
+MSG_COMPLETION = 0x05
+
+# events with a single text field that is sent as raw UTF-8
+TEXT_EVENTS = {
+    'stdout': MSG_STDOUT,
+    'stderr': MSG_STDERR,
+    }
+# events with a dedicated code and a packed data payload
+DATA_EVENTS = {
+    'done': MSG_DONE,
+    'completion': MSG_COMPLETION,
+    }
+EVENT_NAMES = dict((code, name) for name, code in
+    list(TEXT_EVENTS.items()) + list(DATA_EVENTS.items()))
+
+ZLIB = 'zlib'
+
+# compressions in order of preference
+COMPRESSIONS = (ZLIB,)
+
+# set in the length prefix of compressed frames
+COMPRESSED = 0x80000000
+# smaller frames are not worth compressing
+COMPRESS_THRESHOLD = 256 # bytes
+
+_byte = struct.Struct('>B').pack
+_header = struct.Struct('>I')
+
+try:
+    # python 2: native strings are treated as text
+    text_types = (unicode, str)
+    int_types = (int, long)
+except NameError:
+    text_types = (str,)
+    int_types = (int,)
+
+def get(name):
+    """Returns the codec registered as *name*."""
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise CodecError('unknown codec: {}'.format(name))
+
+def negotiate(offered):
+    """Returns the preferred codec name from *offered*, or `JSON`."""
+    for name in CODECS:
+        if name in (offered or ()):
+            return name
+    return JSON
+
+def negotiate_compression(offered):
+    """Returns the preferred compression name from *offered*, or `None`."""
+    for name in COMPRESSIONS:
+        if name in (offered or ()):
+            return name
+    return None
+
+def decode(data):
+    """Decodes a frame encoded by any known codec."""
+    if data[:1] == MAGIC:
+        return BinaryCodec.decode(data)
+    return JSONCodec.decode(data)
+
+class JSONCodec(object):
+    name = JSON
+
+    @staticmethod
+    def encode(msg):
+        return json.dumps(msg).encode('utf8')
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data.decode('utf8'))
+
+class BinaryCodec(object):
+    name = BINARY
+
+    @staticmethod
+    def encode(msg):
+        if msg is None:
+            return MAGIC + _byte(MSG_NONE)
+
+        name = msg.get('evt')
+        data = msg.get('data')
+
+        code = TEXT_EVENTS.get(name)
+        if code is not None and data and list(data) == ['text']:
+            return MAGIC + _byte(code) + data['text'].encode('utf8')
+
+        code = DATA_EVENTS.get(name)
+        if code is not None and set(msg) <= set(['evt', 'data']):
+            return MAGIC + _byte(code) + pack(data or {})
+
+        return MAGIC + _byte(MSG_OBJECT) + pack(msg)
+
+    @staticmethod
+    def decode(data):
+        code = bytearray(data[1:2])[0]
+        payload = data[2:]
+
+        if code == MSG_NONE:
+            return None
+        elif code == MSG_OBJECT:
+            return unpack(payload)
+        elif code in (MSG_STDOUT, MSG_STDERR):
+            text = payload.decode('utf8')
+            return {'evt': EVENT_NAMES[code], 'data': {'text': text}}
+        elif code in EVENT_NAMES:
+            return {'evt': EVENT_NAMES[code], 'data': unpack(payload)}
+
+        raise CodecError('unknown message type: 0x{:02x}'.format(code))
+
+_codecs = {
+    JSON: JSONCodec,
+    BINARY: BinaryCodec,
+    }
+
+## framing ##
+
+class Framing(object):
+    """Frames messages sent over a connection, and tracks link counters.
+
+    Frames have a 4-byte length prefix. If *compression* is set, frames of
+    at least *threshold* bytes are compressed with a stream that is shared
+    by every frame sent, so text repeated across frames compresses well.
+    Received frames are decompressed according to their prefix.
+    """
+    def __init__(self, threshold=None):
+        self._threshold = (COMPRESS_THRESHOLD
+            if threshold is None else threshold)
+        self._compression = None
+        self._compressor = None
+        self._decompressor = None
+
+        self._stats = dict.fromkeys(('sent_frames', 'sent_size',
+            'sent_wire_size', 'recv_frames', 'recv_size', 'recv_wire_size'), 0)
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @compression.setter
+    def compression(self, name):
+        if name not in COMPRESSIONS + (None,):
+            raise CodecError('unknown compression: {}'.format(name))
+        if name != self._compression:
+            self._compressor = zlib.compressobj() if name else None
+        self._compression = name
+
+    def frame(self, data):
+        """Returns the frame for *data*. Frames must be sent in order."""
+        stats = self._stats
+        stats['sent_frames'] += 1
+        stats['sent_size'] += len(data)
+
+        compressor = self._compressor
+        if compressor is not None and len(data) >= self._threshold:
+            data = (compressor.compress(data) +
+                compressor.flush(zlib.Z_SYNC_FLUSH))
+            header = _header.pack(len(data) | COMPRESSED)
+        else:
+            header = _header.pack(len(data))
+
+        stats['sent_wire_size'] += len(header) + len(data)
+        return header + data
+
+    def read_header(self, header):
+        """Returns the payload size and compression flag of a frame."""
+        value = _header.unpack(header)[0]
+        self._stats['recv_frames'] += 1
+        self._stats['recv_wire_size'] += len(header)
+        return (value & ~COMPRESSED, bool(value & COMPRESSED))
+
+    def read(self, data, compressed):
+        """Returns the payload for a (partial) frame. Frames must be read in
+        order.
+        """
+        self._stats['recv_wire_size'] += len(data)
+        if compressed:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj()
+            data = self._decompressor.decompress(data)
+        self._stats['recv_size'] += len(data)
+        return data
+
+    def get_stats(self):
+        stats = dict(self._stats, compression=self._compression)
+        for prefix in ('sent', 'recv'):
+            wire_size = stats[prefix + '_wire_size']
+            stats[prefix + '_ratio'] = (
+                float(stats[prefix + '_size']) / wire_size if wire_size else 1.0)
+        return stats
+
+## msgpack-style encoding ##
+
+def pack(obj):
+    """Packs *obj* using a subset of the msgpack format.
+
+    Supported types are `None`, `bool`, `int`, `float`, `str`, `bytes`,
+    `list`, `tuple` and `dict`.
+    """
+    buf = []
+    _pack(obj, buf.append)
+    return b''.join(buf)
+
+def _pack(obj, write):
+    if obj is None:
+        write(b'\xc0')
+    elif obj is True:
+        write(b'\xc3')
+    elif obj is False:
+        write(b'\xc2')
+    elif isinstance(obj, int_types):
+        if 0 <= obj < 0x80:
+            write(_byte(obj))
+        elif -0x20 <= obj < 0:
+            write(struct.pack('>b', obj))
+        elif -0x8000000000000000 <= obj < 0x8000000000000000:
+            write(b'\xd3' + struct.pack('>q', obj))
+        elif 0 <= obj < 0x10000000000000000:
+            write(b'\xcf' + struct.pack('>Q', obj))
+        else:
+            raise CodecError('integer out of range: {}'.format(obj))
+    elif isinstance(obj, float):
+        write(b'\xcb' + struct.pack('>d', obj))
+    elif isinstance(obj, text_types):
+        data = obj if isinstance(obj, bytes) else obj.encode('utf8')
+        size = len(data)
+        if size < 0x20:
+            write(_byte(0xa0 | size))
+        else:
+            write(b'\xdb' + struct.pack('>I', size))
+        write(data)
+    elif isinstance(obj, bytes):
+        write(b'\xc6' + struct.pack('>I', len(obj)))
+        write(obj)
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 0x10:
+            write(_byte(0x90 | size))
+        else:
+            write(b'\xdd' + struct.pack('>I', size))
+        for item in obj:
+            _pack(item, write)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 0x10:
+            write(_byte(0x80 | size))
+        else:
+            write(b'\xdf' + struct.pack('>I', size))
+        for key, value in obj.items():
+            _pack(key, write)
+            _pack(value, write)
+    else:
+        raise CodecError('unsupported type: {}'.format(type(obj).__name__))
+
+def unpack(data):
+    """Unpacks a single object packed with `pack`."""
+    data = bytes(data)
+    try:
+        obj, pos = _unpack(data, bytearray(data), 0)
+    except struct.error:
+        # a fixed-width value or size was cut short
+        raise CodecError('truncated data')
+    if pos != len(data):
+        raise CodecError('trailing data: {} bytes'.format(len(data) - pos))
+    return obj
+
+def _unpack(data, octets, pos):
+    try:
+        tag = octets[pos]
+    except IndexError:
+        raise CodecError('truncated data')
+    pos += 1
+
+    if tag < 0x80:
+        return tag, pos
+    elif tag >= 0xe0:
+        return tag - 0x100, pos
+    elif tag & 0xe0 == 0xa0:
+        return _unpack_str(data, pos, tag & 0x1f)
+    elif tag & 0xf0 == 0x90:
+        return _unpack_array(data, octets, pos, tag & 0x0f)
+    elif tag & 0xf0 == 0x80:
+        return _unpack_map(data, octets, pos, tag & 0x0f)
+    elif tag == 0xc0:
+        return None, pos
+    elif tag == 0xc2:
+        return False, pos
+    elif tag == 0xc3:
+        return True, pos
+    elif tag == 0xd3:
+        return struct.unpack_from('>q', data, pos)[0], pos + 8
+    elif tag == 0xcf:
+        return struct.unpack_from('>Q', data, pos)[0], pos + 8
+    elif tag == 0xcb:
+        return struct.unpack_from('>d', data, pos)[0], pos + 8
+    elif tag == 0xdb:
+        size = struct.unpack_from('>I', data, pos)[0]
+        return _unpack_str(data, pos + 4, size)
+    elif tag == 0xc6:
+        size = struct.unpack_from('>I', data, pos)[0]
+        pos += 4
+        if pos + size > len(data):
+            raise CodecError('truncated data')
+        return data[pos:pos+size], pos + size
+    elif tag == 0xdd:
+        size = struct.unpack_from('>I', data, pos)[0]
+        return _unpack_array(data, octets, pos + 4, size)
+    elif tag == 0xdf:
+        size = struct.unpack_from('>I', data, pos)[0]
+        return _unpack_map(data, octets, pos + 4, size)
+
+    raise CodecError('unknown tag: 0x{:02x}'.format(tag))
+
+def _unpack_str(data, pos, size):
+    end = pos + size
+    if end > len(data):
+        raise CodecError('truncated data')
+    try:
+        return data[pos:end].decode('utf8'), end
+    except UnicodeDecodeError as e:
+        raise CodecError('invalid string: {}'.format(e))
+
+def _unpack_array(data, octets, pos, size):
+    items = []
+    for _ in range(size):
+        item, pos = _unpack(data, octets, pos)
+        items.append(item)
+    return items, pos
+
+def _unpack_map(data, octets, pos, size):
+    obj = {}
+    for _ in range(size):
+        key, pos = _unpack(data, octets, pos)
+        value, pos = _unpack(data, octets, pos)
+        obj[key] = value
+    return obj, pos
+
+class CodecError(ValueError):
+    """Raised for invalid or unsupported data."""
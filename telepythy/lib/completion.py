@@ -0,0 +1,283 @@
+# Completion of names and attributes without evaluating code.
+#
+# Dotted paths are resolved with static attribute lookups, so completing
+# `obj.attr.` never runs property getters, `__getattr__` hooks or calls
+# made in the path. Paths that can't be resolved this way have no matches.
+
+import ast
+import time
+import types
+import bisect
+import inspect
+import keyword
+import weakref
+
+getattr_static = getattr(inspect, 'getattr_static', None)
+
+# kinds of completions
+KEYWORD = 'keyword'
+MODULE = 'module'
+CLASS = 'class'
+FUNCTION = 'function'
+PROPERTY = 'property'
+ATTRIBUTE = 'attribute'
+
+DOC_LIMIT = 4000 # characters
+
+# descriptors implemented in C that only read a slot or a field
+_safe_descriptors = (types.GetSetDescriptorType, types.MemberDescriptorType)
+# functions and methods are completed as found on the class
+_function_types = (types.FunctionType, types.BuiltinFunctionType,
+    type(str.upper), type(object.__init__))
+
+_missing = object()
+
+# names that let a class run code when its instances' attributes are looked
+# up
+_attribute_hooks = ('__getattr__', '__getattribute__', '__signature__')
+_slot = object.__getattribute__
+_slot_type = type(_slot)
+
+_type_dict = type.__dict__['__dict__'].__get__
+_type_mro = type.__dict__['__mro__'].__get__
+
+# attribute names for each type
+_type_names = weakref.WeakKeyDictionary()
+
+def clear_cache():
+    """Forgets the cached attribute names, since classes may have changed."""
+    _type_names.clear()
+
+def resolve(path, namespaces, deadline=None):
+    """Returns the object for the dotted *path* from *namespaces*.
+
+    The path starts with a name, or a literal (e.g. `'text'.`). Raises
+    `LookupError` if the path can't be resolved without evaluating code.
+    """
+    try:
+        node = ast.parse(path, mode='eval').body
+    except SyntaxError:
+        raise LookupError(path)
+
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+
+    if isinstance(node, ast.Name):
+        obj = _lookup(node.id, namespaces)
+    else:
+        try:
+            obj = ast.literal_eval(node)
+        except ValueError:
+            # calls, subscripts, etc.
+            raise LookupError(path)
+
+    for name in reversed(names):
+        _check_deadline(deadline)
+        obj = get_attribute(obj, name)
+    return obj
+
+def _lookup(name, namespaces):
+    for namespace in namespaces:
+        try:
+            return namespace[name]
+        except KeyError:
+            pass
+    raise LookupError(name)
+
+def get_attribute(obj, name):
+    """Returns the attribute *name* of *obj* without running any code.
+
+    Raises `LookupError` if the attribute doesn't exist, or if its value
+    can only be found by running a descriptor (e.g. a property).
+    """
+    try:
+        attr = _getattr_static(obj, name)
+    except AttributeError:
+        raise LookupError(name)
+
+    if isinstance(attr, (staticmethod, classmethod)):
+        return attr.__func__
+    if isinstance(obj, type) or isinstance(attr, _function_types):
+        # class attributes and methods are useful as is
+        return attr
+    if isinstance(attr, _safe_descriptors):
+        return attr.__get__(obj, type(obj))
+    if (hasattr(type(attr), '__get__') and
+            _instance_dict(obj).get(name, _missing) is not attr):
+        # e.g. a property, which would have to be run
+        raise LookupError(name)
+    return attr
+
+def attribute_names(obj, deadline=None):
+    """Returns the attribute names of *obj*, like `dir`, without calling
+    `__dir__`.
+    """
+    if isinstance(obj, type):
+        names = set(_class_names(obj, deadline))
+    else:
+        names = set(_class_names(type(obj), deadline))
+        names.update(name for name in _instance_dict(obj)
+            if isinstance(name, str))
+    return names
+
+def _class_names(cls, deadline):
+    try:
+        return _type_names[cls]
+    except KeyError:
+        pass
+
+    names = set()
+    for base in _type_mro(cls):
+        _check_deadline(deadline)
+        names.update(_type_dict(base))
+
+    _type_names[cls] = names
+    return names
+
+def _instance_dict(obj):
+    if isinstance(obj, types.ModuleType):
+        return obj.__dict__
+
+    try:
+        attr = _type_lookup(type(obj), '__dict__')
+    except AttributeError:
+        return {}
+    if isinstance(attr, _safe_descriptors):
+        attr = attr.__get__(obj, type(obj))
+    return attr if isinstance(attr, dict) else {}
+
+def _type_lookup(cls, name):
+    for base in _type_mro(cls):
+        try:
+            return _type_dict(base)[name]
+        except KeyError:
+            pass
+    raise AttributeError(name)
+
+if getattr_static is not None:
+    _getattr_static = getattr_static
+else:
+    def _getattr_static(obj, name):
+        """A simplified `inspect.getattr_static` for python 2."""
+        if not isinstance(obj, type):
+            try:
+                return _instance_dict(obj)[name]
+            except KeyError:
+                pass
+        return _type_lookup(obj if isinstance(obj, type) else type(obj), name)
+
+def get_kind(obj):
+    if isinstance(obj, types.ModuleType):
+        return MODULE
+    elif isinstance(obj, type):
+        return CLASS
+    elif callable(obj):
+        return FUNCTION
+    return ATTRIBUTE
+
+def attribute_kind(obj, name):
+    """Returns the kind of the attribute *name* of *obj*."""
+    try:
+        return get_kind(get_attribute(obj, name))
+    except LookupError:
+        pass
+
+    try:
+        attr = _getattr_static(obj, name)
+    except AttributeError:
+        return ATTRIBUTE
+    return PROPERTY if isinstance(attr, property) else ATTRIBUTE
+
+def describe_path(path, namespaces):
+    """Returns the details of the object at the dotted *path* (see
+    `describe`).
+
+    Raises `LookupError` if the path can't be resolved without evaluating
+    code.
+    """
+    if keyword.iskeyword(path):
+        return {'kind': KEYWORD}
+    if '.' not in path:
+        return describe(resolve(path, namespaces))
+
+    ctx, name = path.rsplit('.', 1)
+    parent = resolve(ctx, namespaces)
+    try:
+        attr = _getattr_static(parent, name)
+    except AttributeError:
+        raise LookupError(path)
+    if isinstance(attr, property):
+        # the property itself has the documentation
+        return describe(attr, PROPERTY)
+    return describe(get_attribute(parent, name))
+
+def describe(obj, kind=None):
+    """Returns the kind of *obj*, and its signature and docstring if it has
+    them.
+    """
+    kind = kind or get_kind(obj)
+    details = {'kind': kind}
+
+    if (isinstance(obj, _function_types + (type,)) and
+            hasattr(inspect, 'signature') and not _hooks_attributes(obj)):
+        try:
+            details['signature'] = str(inspect.signature(obj))
+        except (TypeError, ValueError):
+            # not supported for some builtins
+            pass
+
+    if kind != ATTRIBUTE:
+        try:
+            doc = get_attribute(obj, '__doc__')
+        except LookupError:
+            doc = None
+        if isinstance(doc, str) and doc:
+            details['doc'] = inspect.cleandoc(doc)[:DOC_LIMIT]
+
+    return details
+
+def _hooks_attributes(obj):
+    """Returns `True` if looking up attributes of *obj*, or of the objects
+    it wraps, could run code.
+
+    `inspect.signature` uses ordinary attribute lookups (e.g. for
+    `__wrapped__` and `__signature__`), which would run these hooks.
+    """
+    seen = set()
+    while id(obj) not in seen:
+        seen.add(id(obj))
+        for base in _type_mro(type(obj)):
+            names = _type_dict(base)
+            for name in _attribute_hooks:
+                # hooks implemented in C are safe
+                if not isinstance(names.get(name, _slot), _slot_type):
+                    return True
+        obj = _instance_dict(obj).get('__wrapped__', obj)
+    return False
+
+def _check_deadline(deadline):
+    if deadline is not None and time.time() > deadline:
+        raise Timeout()
+
+class Timeout(Exception):
+    """Raised when a completion takes longer than its budget."""
+
+class CompletionIndex(object):
+    """A sorted set of names that are matched by prefix."""
+    def __init__(self, names, key=None):
+        self._names = sorted(set(names))
+        # identifies the state the index was built from
+        self.key = key
+
+    def match(self, prefix):
+        names = self._names
+        i = bisect.bisect_left(names, prefix)
+        j = i
+        while j < len(names) and names[j].startswith(prefix):
+            j += 1
+        return names[i:j]
+
+def match_sort_key(match):
+    return (match.startswith('_'), match)
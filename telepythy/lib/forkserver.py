@@ -0,0 +1,143 @@
+# A parent process that imports modules once and forks a new service for
+# each session.
+#
+# Importing large libraries can take much longer than starting Python. The
+# fork server imports them once, then each forked client starts with the
+# modules already imported and a clean namespace.
+#
+# The controller writes a '<host>:<port>' line to the server's stdin for each
+# client to start, and reads back a 'forked <pid>' line. A 'kill <pid>' line
+# kills a client. The server writes an 'exited <pid> <returncode>' line when
+# a client exits, so the controller never has to signal a pid that may have
+# been reused. The server exits when its stdin is closed. Only available
+# where `os.fork` is (not on Windows).
+
+import os
+import sys
+import signal
+import select
+import importlib
+import traceback
+
+from . import logs
+
+REAP_INTERVAL = 1 # seconds
+
+log = logs.get(__name__)
+
+def serve(preload=()):
+    """Runs the fork server, after importing the *preload* modules."""
+    if not hasattr(os, 'fork'):
+        raise SystemExit('the fork server is not supported on this platform')
+
+    preload_modules(preload)
+
+    # replies use a copy of stdout, and everything else written to stdout
+    # (including by the clients) goes to stderr
+    reply = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    log.info('fork server ready')
+    # the pids of the clients that haven't been collected
+    children = set()
+    buf = b''
+    while True:
+        ready, _, _ = select.select([0], [], [], REAP_INTERVAL)
+        reap(children, reply)
+        if not ready:
+            continue
+
+        data = os.read(0, 4096)
+        if not data:
+            # the controller is gone
+            break
+
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            line = line.decode('utf8').strip()
+            if line.startswith('kill '):
+                kill_client(int(line[5:]), children, reply)
+            elif line:
+                pid = fork_client(line, reply)
+                children.add(pid)
+                send(reply, 'forked', pid)
+
+    log.info('fork server stopped')
+
+def preload_modules(names):
+    for name in names:
+        log.debug('preloading: %s', name)
+        try:
+            importlib.import_module(name)
+        except Exception:
+            log.exception('failed to preload module: %s', name)
+
+def fork_client(address, reply):
+    """Forks a client connecting to *address*, and returns its pid."""
+    # buffered output would be written by both processes
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid:
+        log.debug('forked client: %s (%s)', pid, address)
+        return pid
+
+    code = 0
+    try:
+        reply.close()
+        # the controller's requests are for the server only
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+
+        # don't repeat the random numbers of other clients
+        random = sys.modules.get('random')
+        if random is not None:
+            random.seed()
+
+        from . import client
+        client(address=address, init_shell=True)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+def kill_client(pid, children, reply):
+    """Kills the client *pid*, unless it has already been collected (and its
+    pid may have been reused)."""
+    if pid not in children:
+        return
+    os.kill(pid, signal.SIGKILL)
+    _, status = os.waitpid(pid, 0)
+    exited(pid, status, children, reply)
+
+def reap(children, reply):
+    """Collects the exit status of finished clients."""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            # no children
+            return
+        if not pid:
+            return
+        exited(pid, status, children, reply)
+
+def exited(pid, status, children, reply):
+    children.discard(pid)
+    # as `subprocess.Popen.returncode`
+    if os.WIFSIGNALED(status):
+        code = -os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    log.debug('client exited: %s (%s)', pid, code)
+    send(reply, 'exited', pid, code)
+
+def send(reply, *args):
+    reply.write(' '.join(map(str, args)) + '\n')
+    reply.flush()
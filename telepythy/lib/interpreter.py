@@ -1,6 +1,7 @@
+import io
 import ast
 import sys
-import pprint
+import time
 import keyword
 import itertools
 import linecache
@@ -15,40 +16,78 @@ except ImportError:
 _builtins = builtins.__dict__
 
 from . import logs
+from . import results
+from . import completion
+from .completion import CompletionIndex, match_sort_key
+
+DEFAULT_FILENAME = 'telepythy'
+COMPLETION_LIMIT = 200
+COMPLETION_BUDGET = 0.05 # seconds
+INPUT_WAIT = 0.1 # seconds
 
 log = logs.get(__name__)
 
+Completion = collections.namedtuple('Completion',
+    ('matches', 'kinds', 'truncated', 'parent_id'))
+
 try:
     range = xrange
 except NameError:
     pass
 
+# tracks the interpreter evaluating code in each thread
+_local = threading.local()
+# the interpreter that hooked the standard streams
+_hooked = None
+
+def current():
+    """Returns the interpreter that owns the standard streams in this thread.
+
+    This is the interpreter evaluating code in the current thread, if any,
+    otherwise the interpreter that hooked the standard streams.
+    """
+    return getattr(_local, 'interpreter', None) or _hooked
+
 class Interpreter(object):
     def __init__(self, locals=None, filename=None,
-            stdout_callback=None, stderr_callback=None):
+            stdout_callback=None, stderr_callback=None,
+            preview_size=None, preview_time=None):
 
         self.locals = {}
         self._init_locals = locals or {}
 
-        self.filename = filename or 'telepythy'
+        self.filename = filename or DEFAULT_FILENAME
 
         self._run_lock = threading.Lock()
-        self._result_count = 0
-        self._result_limit = 30
+        # results are bound to `_N` names (see `results.ResultStore`)
+        self._results = results.ResultStore(self.locals,
+            preview_size=preview_size, preview_time=preview_time)
 
         self._block_counter = itertools.count()
+        # bumped whenever code may have rebound names in the namespace
+        self._namespace_version = 0
+        self._global_index = None
 
         self._last_result = None
-        self._stdout_callback = stdout_callback
-        self._stderr_callback = stderr_callback
+        self._stdin = InputIO()
+        self._stdout = OutputIO(stdout_callback)
+        self._stderr = OutputIO(stderr_callback)
+
+        self._evaluating = False
+        self._unhook_state = None
 
         self.reset()
 
+    @property
+    def is_evaluating(self):
+        return self._evaluating
+
     def reset(self):
         self.locals.clear()
         exec('', self.locals)
         self.locals.update(self._init_locals)
-        self._result_count = 0
+        self._results.clear()
+        self._namespace_version += 1
 
     ## commands ##
 
@@ -61,84 +100,113 @@ class Interpreter(object):
         linecache.cache[fname] = (
             len(source), None, source.splitlines(True), fname)
 
-        with self._run_lock:
-            mod = compile(source, fname, 'exec', ast.PyCF_ONLY_AST)
-            inter = ast.Interactive(mod.body)
-            codeob = compile(inter, fname, 'single')
-            exec(codeob, self.locals)
-
-            self._store_result()
-
-    def complete(self, prefix):
-        matches = []
-        # log.error('prefix: %s', prefix)
-
-        if '.' not in prefix:
-            # return global matches
-            for kw in keyword.kwlist:
-                matches.append(kw)
-
-            for name in self.locals.keys():
-                matches.append(name)
-
-            for name in _builtins.keys():
-                matches.append(name)
-        else:
-            ctx = prefix.rsplit('.', 1)[0]
+        with self._run_lock, self._activated():
             try:
-                obj = eval(ctx, self.locals)
-            except Exception:
-                # log.error('ctx failed to resolve: %r', ctx)
-                pass
-            else:
-                # log.error('obj: %s', obj)
+                mod = compile(source, fname, 'exec', ast.PyCF_ONLY_AST)
+                inter = ast.Interactive(mod.body)
+                codeob = compile(inter, fname, 'single')
+                exec(codeob, self.locals)
 
-                for name in dir(obj):
-                    matches.append(name)
+                self._store_result()
+            finally:
+                # the namespace and classes may have changed
+                self._namespace_version += 1
+                completion.clear_cache()
 
-        return matches
-
-    def complete_x(self, prefix):
-        matches = []
-
-        if '.' not in prefix:
-            prefix_0 = prefix and prefix[0]
+    @contextlib.contextmanager
+    def _activated(self):
+        """Routes the standard streams to this interpreter in this thread."""
+        prev = getattr(_local, 'interpreter', None)
+        _local.interpreter = self
+        self._evaluating = True
+        try:
+            yield
+        finally:
+            self._evaluating = False
+            _local.interpreter = prev
 
-            for kw in keyword.kwlist:
-                if kw.startswith(prefix_0):
-                    matches.append(kw)
+    def complete(self, prefix, limit=None):
+        """Returns the names that complete *prefix*, best matches first.
 
-            for name in self.locals.keys():
-                if name.startswith(prefix_0):
-                    matches.append(name)
+        At most *limit* matches are returned. *truncated* is set in the
+        returned `Completion` if some matches were left out. *parent_id*
+        identifies the namespace or object the names belong to.
 
-            for name in _builtins.keys():
-                if name.startswith(prefix_0):
-                    matches.append(name)
+        Attributes are found with static lookups (see `completion`), so no
+        code in the namespace is run.
+        """
+        limit = COMPLETION_LIMIT if limit is None else limit
 
+        if '.' not in prefix:
+            index = self._get_global_index()
+            get_kind = self._global_kind
+            parent = self.locals
         else:
-            idents = prefix.split('.')
-            parents, prefix = idents[:-1], idents[-1]
-
-            obj = self.locals.get(parents[0])
-            if not obj:
-                obj = _builtins.get(parents[0])
-                if not obj:
-                    return []
-
-            for ident in parents[1:]:
-                try:
-                    obj = getattr(obj, ident)
-                except AttributeError:
-                    return []
-
-            prefix_0 = prefix and prefix[0]
-
-            for name in dir(obj):
-                if name.startswith(prefix_0):
-                    matches.append(name)
+            ctx, prefix = prefix.rsplit('.', 1)
+            deadline = time.time() + COMPLETION_BUDGET
+            try:
+                parent = completion.resolve(ctx, (self.locals, _builtins),
+                    deadline)
+                index = CompletionIndex(
+                    completion.attribute_names(parent, deadline))
+            except LookupError:
+                return Completion([], [], False, None)
+            except completion.Timeout:
+                log.warning('completion timed out: %s', ctx)
+                return Completion([], [], True, None)
+            get_kind = lambda name: completion.attribute_kind(parent, name)
+
+        matches = index.match(prefix)
+        matches.sort(key=match_sort_key)
+        truncated = len(matches) > limit
+        matches = matches[:limit]
+
+        kinds = [get_kind(name) for name in matches]
+        return Completion(matches, kinds, truncated, id(parent))
+
+    def _global_kind(self, name):
+        for namespace in (self.locals, _builtins):
+            try:
+                return completion.get_kind(namespace[name])
+            except KeyError:
+                pass
+        return completion.KEYWORD
 
-        return sorted(matches, key=match_sort_key)
+    def inspect(self, path):
+        """Returns the details of the object at the dotted *path*, or `None`
+        if it can't be found without evaluating code.
+        """
+        try:
+            return completion.describe_path(path, (self.locals, _builtins))
+        except LookupError:
+            return None
+
+    def get_result(self, number=None, offset=None, size=None):
+        """Returns a page of the full text of result *number* (see
+        `results.ResultStore.page`), or `None` if it is no longer stored.
+
+        The result's repr may run any code, so the page is formatted like an
+        evaluation, and can be interrupted the same way.
+        """
+        with self._run_lock, self._activated():
+            try:
+                return self._results.page(number, offset, size)
+            except KeyError:
+                return None
+
+    def _get_global_index(self):
+        """Returns the index of global names, which is cached until the
+        namespace changes.
+        """
+        index = self._global_index
+        # names may also be added without evaluating code (e.g. from other
+        # threads), which the length catches
+        key = (self._namespace_version, len(self.locals))
+        if index is None or index.key != key:
+            index = self._global_index = CompletionIndex(
+                itertools.chain(keyword.kwlist, list(self.locals), _builtins),
+                key)
+        return index
 
     ## io control ##
 
@@ -151,21 +219,35 @@ class Interpreter(object):
             self.unhook()
 
     def hook(self):
-        sys.stdin = InputIO()
-        sys.stdout = OutputIO(self._stdout_callback)
-        sys.stderr = OutputIO(self._stderr_callback)
+        """Routes the standard streams to interpreters.
+
+        Threads evaluating code in an interpreter are routed to that
+        interpreter. All other threads are routed to this one.
+        """
+        global _hooked
+
+        self._unhook_state = (_hooked,
+            sys.stdin, sys.stdout, sys.stderr, sys.displayhook)
+        _hooked = self
+
+        sys.stdin = StreamRouter('_stdin')
+        sys.stdout = StreamRouter('_stdout')
+        sys.stderr = StreamRouter('_stderr')
 
-        sys.displayhook = self.displayhook
+        sys.displayhook = route_displayhook
 
     def unhook(self):
-        sys.stdin = sys.__stdin__
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
+        global _hooked
 
-        sys.displayhook = sys.__displayhook__
+        (_hooked, sys.stdin, sys.stdout, sys.stderr,
+            sys.displayhook) = self._unhook_state
+        self._unhook_state = None
 
     def recv_input(self, text):
-        sys.stdin.write(text)
+        self._stdin.feed(text)
+
+    def recv_eof(self):
+        self._stdin.feed_eof()
 
     def displayhook(self, value):
         self._last_result = value
@@ -176,46 +258,189 @@ class Interpreter(object):
 
         # pop
         result, self._last_result = self._last_result, None
+        print(self._results.add(result))
+
+def route_displayhook(value):
+    current().displayhook(value)
 
-        self.locals['_'] = result
-        self.locals['_{}'.format(self._result_count)] = result
+class StreamRouter(object):
+    """Forwards to a stream of the current interpreter (see `current`)."""
+    def __init__(self, name):
+        self._name = name
 
-        print('{}: {}'.format(self._result_count, pprint.pformat(result)))
+    def __getattr__(self, name):
+        return getattr(getattr(current(), self._name), name)
 
-        self._result_count += 1
+class InputIO(io.TextIOBase):
+    """The standard input of an interpreter, fed by the controller.
 
-        # remove old results
-        for i in range(max(0, self._result_count-self._result_limit)):
-            self.locals.pop('_{}'.format(i), None)
+    Text is held in the chunks it was received in, so reads and line
+    searches don't touch each character in Python. Reads block until
+    enough text is available, or until `feed_eof` is called. EOF is
+    consumed by `read()`, or by the first read that returns nothing because
+    of it, so input can continue for later reads.
+    """
+    encoding = 'utf8'
 
-class InputIO:
     def __init__(self):
-        self._buffer = collections.deque()
-        self._ready = threading.Event()
-
-    def read(self, size):
-        buf = self._buffer
-        ready = self._ready
-
-        while True:
-            if len(buf) < size:
-                ready.wait()
-                ready.clear()
-                continue
-            return ''.join(buf.popleft() for _ in range(size))
-
-    def readline(self):
-        buf = []
-        while True:
-            c = self.read(1)
-            if c == '\n':
-                return ''.join(buf)
-            else:
-                buf.append(c)
-
-    def write(self, data):
-        self._buffer.extend(data)
-        self._ready.set()
+        self._cond = threading.Condition()
+        self._chunks = collections.deque()
+        # read position in the first chunk
+        self._pos = 0
+        # characters available
+        self._size = 0
+        # characters known not to contain a newline
+        self._scanned = 0
+        self._eof = False
+
+        self.buffer = InputBuffer(self)
+
+    def readable(self):
+        return True
+
+    def feed(self, text):
+        if not text:
+            return
+        with self._cond:
+            self._chunks.append(text)
+            self._size += len(text)
+            self._cond.notify_all()
+
+    def feed_eof(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def read(self, size=-1):
+        if size == 0:
+            return ''
+        with self._cond:
+            if size is None or size < 0:
+                self._wait(lambda: self._eof)
+                self._eof = False
+                return self._take(self._size)
+
+            self._wait(lambda: self._size >= size or self._eof)
+            return self._take(min(size, self._size))
+
+    def read1(self, size=-1):
+        """Reads up to *size* characters, waiting only until some text (or
+        EOF) is available.
+        """
+        if size == 0:
+            return ''
+        with self._cond:
+            self._wait(lambda: self._size or self._eof)
+            return self._take(self._size if size < 0 else
+                min(size, self._size))
+
+    def readline(self, size=-1):
+        if size == 0:
+            return ''
+        with self._cond:
+            limited = size is not None and size >= 0
+            pos = -1
+            while True:
+                pos = self._find_newline()
+                if pos >= 0 or self._eof or (limited and self._size >= size):
+                    break
+                self._wait_once()
+
+            count = pos + 1 if pos >= 0 else self._size
+            if limited:
+                count = min(count, size)
+            return self._take(count)
+
+    def _wait(self, predicate):
+        while not predicate():
+            self._wait_once()
+
+    def _wait_once(self):
+        # a timeout gives async exceptions (interrupts) a chance to be
+        # raised in this thread
+        self._cond.wait(INPUT_WAIT)
+
+    def _find_newline(self):
+        """Returns the position of the first newline, or -1."""
+        offset = 0
+        start = self._scanned
+        for i, chunk in enumerate(self._chunks):
+            begin = self._pos if i == 0 else 0
+            length = len(chunk) - begin
+            if offset + length > start:
+                pos = chunk.find('\n', begin + max(0, start - offset))
+                if pos >= 0:
+                    return offset + pos - begin
+            offset += length
+        self._scanned = offset
+        return -1
+
+    def _take(self, count):
+        chunks = self._chunks
+        parts = []
+        self._size -= count
+        self._scanned = max(0, self._scanned - count)
+
+        while count:
+            chunk = chunks[0]
+            end = self._pos + count
+            if end < len(chunk):
+                parts.append(chunk[self._pos:end])
+                self._pos = end
+                break
+
+            parts.append(chunk[self._pos:] if self._pos else chunk)
+            count -= len(chunk) - self._pos
+            chunks.popleft()
+            self._pos = 0
+
+        if not parts:
+            # zero-length reads return early, so this read is returning
+            # because of EOF
+            self._eof = False
+        return ''.join(parts)
+
+class InputBuffer(io.BufferedIOBase):
+    """A binary view of an `InputIO` stream, encoded as UTF-8."""
+    def __init__(self, text):
+        self._text = text
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._pending + self._text.read().encode('utf8')
+            self._pending = b''
+            return data
+
+        while len(self._pending) < size:
+            # each character is at least one byte
+            text = self._text.read(size - len(self._pending))
+            if not text:
+                break
+            self._pending += text.encode('utf8')
+        return self._take(size)
+
+    def read1(self, size=-1):
+        if not self._pending:
+            self._pending = self._text.read1(size).encode('utf8')
+        return self._take(len(self._pending) if size < 0 else size)
+
+    def readline(self, size=-1):
+        if b'\n' not in self._pending:
+            self._pending += self._text.readline().encode('utf8')
+
+        pos = self._pending.find(b'\n')
+        count = pos + 1 if pos >= 0 else len(self._pending)
+        if size is not None and size >= 0:
+            count = min(count, size)
+        return self._take(count)
+
+    def _take(self, count):
+        data, self._pending = self._pending[:count], self._pending[count:]
+        return data
 
 class OutputIO(object):
     def __init__(self, callback, mirror=None):
@@ -236,6 +461,3 @@ class OutputIO(object):
     def flush(self):
         if self._mirror is not None:
             self._mirror.flush()
-
-def match_sort_key(match):
-    return (match.startswith('_'), match)
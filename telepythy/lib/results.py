@@ -0,0 +1,207 @@
+# Storage and formatting of expression results.
+#
+# Results are shown as a preview whose size and formatting time are
+# bounded, so evaluating a huge object doesn't stall the service or flood
+# the output. The full text can be requested a page at a time.
+
+import sys
+import time
+import collections
+try:
+    import reprlib
+except ImportError:
+    import repr as reprlib
+
+RESULT_LIMIT = 30 # `_N` names kept in the namespace
+PREVIEW_SIZE = 16 * 1024 # characters
+PREVIEW_TIME = 0.1 # seconds
+PAGE_SIZE = 64 * 1024 # characters
+
+TRUNCATED = '...'
+
+# sorting a large dict could take longer than the whole preview budget, so
+# dicts are printed in insertion order (where supported)
+_pprint_options = {'sort_dicts': False} if sys.version_info >= (3, 8) else {}
+
+# *offset* is the number of characters of the full text in *text*
+Preview = collections.namedtuple('Preview', ('text', 'truncated', 'offset'))
+
+class ResultStore(object):
+    """Holds the most recent results of an interpreter.
+
+    Each result is bound to `_` and `_N` in *namespace*. Only the last
+    *limit* results are kept, older `_N` names are removed as new results
+    are added.
+    """
+    def __init__(self, namespace, limit=None, preview_size=None,
+            preview_time=None):
+        self._namespace = namespace
+        self._limit = RESULT_LIMIT if limit is None else limit
+        self.preview_size = (PREVIEW_SIZE
+            if preview_size is None else preview_size)
+        self.preview_time = (PREVIEW_TIME
+            if preview_time is None else preview_time)
+
+        # (number, result, preview offset) for each result, oldest first
+        self._results = collections.deque()
+        self._count = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    def clear(self):
+        """Forgets every result. The namespace is expected to be cleared
+        separately.
+        """
+        self._results.clear()
+        self._count = 0
+
+    def add(self, result):
+        """Stores *result* and returns the text of its preview."""
+        number = self._count
+        self._count += 1
+
+        preview = format_preview(result, self.preview_size, self.preview_time)
+
+        results = self._results
+        results.append((number, result, preview.offset))
+        self._namespace['_'] = result
+        self._namespace['_{}'.format(number)] = result
+
+        while len(results) > self._limit:
+            old_number, old_result, _ = results.popleft()
+            name = '_{}'.format(old_number)
+            # the name may have been reused
+            if self._namespace.get(name) is old_result:
+                del self._namespace[name]
+
+        text = preview.text + (TRUNCATED if preview.truncated else '')
+        return '{}: {}'.format(number, text)
+
+    def page(self, number=None, offset=None, size=None):
+        """Returns a page of the full text of result *number* (the last
+        result if `None`), as a dictionary with *id*, *text*, *offset* and
+        *more*.
+
+        The page starts at *offset*, or after the preview if `None`. Only
+        the text up to the end of the page is formatted, so a page of a huge
+        result doesn't build its whole text. Formatting isn't limited in
+        time, so the page is expected to be requested where it can be
+        interrupted. Raises `KeyError` if the result is no longer stored.
+        """
+        number, result, preview = self._get(number)
+        offset = preview if offset is None else offset
+        size = PAGE_SIZE if size is None else size
+
+        text, more = _format(result, offset + size)
+        return {'id': number, 'text': text[offset:], 'offset': offset,
+            'more': more}
+
+    def _get(self, number):
+        if not self._results:
+            raise KeyError(number)
+        if number is None:
+            return self._results[-1]
+
+        first = self._results[0][0]
+        if number < first:
+            raise KeyError(number)
+        # numbers are consecutive
+        try:
+            return self._results[number - first]
+        except IndexError:
+            raise KeyError(number)
+
+def format_preview(obj, size=None, timeout=None):
+    """Returns a `Preview` of the pretty-printed text of *obj*.
+
+    Formatting stops once the text reaches *size* characters, or after
+    *timeout* seconds. If nothing could be formatted in time, an abbreviated
+    repr is used instead.
+    """
+    size = PREVIEW_SIZE if size is None else size
+    deadline = time.time() + (PREVIEW_TIME if timeout is None else timeout)
+
+    text, truncated = _format(obj, size, deadline)
+    if truncated and not text:
+        return Preview(reprlib.repr(obj)[:size], True, 0)
+    return Preview(text, truncated, len(text))
+
+def _format(obj, size, deadline=None):
+    """Returns the first *size* characters of the pretty-printed text of
+    *obj*, and whether it was truncated (by the size, or by the *deadline*).
+    """
+    # pprint ends the text with a newline
+    stream = _LimitedWriter(size + 1)
+    try:
+        printer = _get_printer_type()(deadline, stream=stream,
+            **_pprint_options)
+        printer.pprint(obj)
+    except _Truncated:
+        return stream.getvalue()[:size], True
+    return stream.getvalue()[:-1], False
+
+class _Truncated(Exception):
+    pass
+
+_printer_type = None
+
+def _get_printer_type():
+    """Returns the `_PreviewPrinter` class, which is defined on first use
+    so that `pprint` isn't imported until a result is formatted."""
+    global _printer_type
+    if _printer_type is not None:
+        return _printer_type
+
+    import pprint
+
+    class _PreviewPrinter(pprint.PrettyPrinter):
+        """A pretty printer that gives up after a deadline (if any), and that
+        doesn't build the repr of large containers.
+        """
+        # types printed item by item when their repr doesn't fit on a line
+        _split_types = getattr(pprint.PrettyPrinter, '_dispatch', {})
+
+        def __init__(self, deadline, width=80, **kwargs):
+            pprint.PrettyPrinter.__init__(self, width=width, **kwargs)
+            self._deadline = deadline
+            self._line_width = width
+
+        def format(self, obj, context, maxlevels, level):
+            # called for every object formatted, including nested ones
+            if self._deadline is not None and time.time() > self._deadline:
+                raise _Truncated()
+
+            if type(obj).__repr__ in self._split_types:
+                try:
+                    large = len(obj) > self._line_width
+                except TypeError:
+                    large = False
+                if large:
+                    # the repr would be longer than a line, so it would only
+                    # be used to decide to print the container item by item.
+                    # the item writes can then be stopped by the size limit.
+                    return ('<large>' * self._line_width, True, False)
+
+            return pprint.PrettyPrinter.format(self, obj, context, maxlevels,
+                level)
+
+    _printer_type = _PreviewPrinter
+    return _printer_type
+
+class _LimitedWriter(object):
+    """A text stream that stops accepting writes after *size* characters."""
+    def __init__(self, size):
+        self._parts = []
+        self._size = 0
+        self._limit = size
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size > self._limit:
+            raise _Truncated()
+
+    def getvalue(self):
+        return ''.join(self._parts)
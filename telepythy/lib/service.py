@@ -1,8 +1,11 @@
 from __future__ import print_function
 
 import sys
+import time
+import codecs
+import itertools
 import threading
-import traceback
+import collections
 try:
     import queue
 except ImportError:
@@ -10,30 +13,69 @@ except ImportError:
 
 from . import logs
 from . import utils
+from . import codec
 from . import sockio
 from . import interpreter
 from . import event_handlers
 
 Q_TIMEOUT = 0.1
+KEEPALIVE_INTERVAL = 1.0 # seconds
+FLUSH_LATENCY = 0.005 # seconds
+FLUSH_SIZE = 64 * 1024 # characters
+WORKERS = 4 # threads evaluating private interpreters
+
+# event queue limits
+MAX_EVENTS = 10000
+MAX_SIZE = 16 * 1024 * 1024 # characters
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP = 'drop'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_SPILL)
+OVERFLOW = OVERFLOW_DROP
+
+# event queue counters
+STATS = ('events', 'size', 'dropped_events', 'dropped_lines', 'dropped_size',
+    'spilled_size', 'blocked_time')
+
+OUTPUT_EVENTS = frozenset(['stdout', 'stderr'])
+# other events with a text field that may be sent in chunks
+STREAM_EVENTS = frozenset(['error'])
+CHUNK_SIZE = 64 * 1024 # characters
+
+SHARED_NAMESPACE = 'shared'
+PRIVATE_NAMESPACE = 'private'
+NAMESPACES = (SHARED_NAMESPACE, PRIVATE_NAMESPACE)
 
 log = logs.get(__name__)
 
 class Service(object):
     """Base class for client/server services."""
-    def __init__(self, locals=None, filename=None, init_shell=False):
+    def __init__(self, locals=None, filename=None, init_shell=False,
+            flush_latency=None, flush_size=None, workers=None,
+            max_events=None, max_size=None, overflow=None,
+            preview_size=None, preview_time=None):
         self._timeout = Q_TIMEOUT
+        self._keepalive = KEEPALIVE_INTERVAL
+        self._flush_latency = flush_latency
+        self._flush_size = flush_size
+        # event queue limits for each session (see `EventQueue`)
+        self._max_events = max_events
+        self._max_size = max_size
+        self._overflow = overflow
+        # limits for the previews of results (see `results.format_preview`)
+        self._preview_size = preview_size
+        self._preview_time = preview_time
 
         self._thread = None
-        self._stop = threading.Event()
         self._shutdown = threading.Event()
 
-        self._events = queue.Queue()
         self._code_queue = queue.Queue()
+        self._sessions = SessionManager(self._create_event_queue,
+            self._create_interpreter, workers)
 
         self._event_handlers = event_handlers.default_handlers()
 
-        self._is_evaluating = False
-
         if init_shell:
             # set up a shell environment
             locals = locals or {}
@@ -43,18 +85,24 @@ class Service(object):
             if not sys.path or sys.path[0] != '':
                 sys.path.insert(0, '')
 
+        self._init_locals = locals
+        self._filename = filename
+
         self._inter = interpreter.Interpreter(locals, filename,
             lambda text: self.add_event('stdout', text=text),
             lambda text: self.add_event('stderr', text=text),
+            preview_size, preview_time,
             )
 
     ## threading ##
 
     def join(self, timeout=None):
-        if self._thread is None:
+        # the thread clears the attribute when it finishes
+        thread = self._thread
+        if thread is None:
             raise ServiceError('thread is not running')
-        self._thread.join(timeout)
-        if self._thread.is_alive():
+        thread.join(timeout)
+        if thread.is_alive():
             raise Timeout()
 
     ## execution ##
@@ -73,17 +121,20 @@ class Service(object):
                         handler()
 
                     try:
-                        data = q.get(timeout=timeout)
+                        item = q.get(timeout=timeout)
                     except queue.Empty:
                         continue
 
-                    self.evaluate(**data)
+                    # None is used to wake up the loop
+                    if item is not None:
+                        item()
         finally:
             self._thread = None
 
     def stop(self):
-        self._stop.set()
         self._shutdown.set()
+        self._code_queue.put(None)
+        self._sessions.close()
 
     ## interpreter ##
 
@@ -91,40 +142,127 @@ class Service(object):
     def locals(self):
         return self._inter.locals
 
-    def evaluate(self, source, notify=True):
-        self._is_evaluating = True
+    def evaluate(self, source, notify=True, session=None):
+        """Evaluates *source* in the interpreter for *session*.
+
+        Events are sent to *session* if it has a private interpreter,
+        otherwise to every session sharing the service interpreter.
+        """
+        inter, add_event = self._get_target(session)
+
         try:
-            self._inter.evaluate(source)
+            inter.evaluate(source)
         except (Exception, KeyboardInterrupt):
-            self.add_event('error', text=traceback.format_exc())
+            # imported when needed, to start faster
+            import traceback
+            add_event('error', text=traceback.format_exc())
         finally:
-            self._is_evaluating = False
             if notify:
-                self.add_event('done')
+                add_event('done')
 
-    def interrupt(self):
-        if self._is_evaluating:
-            utils.interrupt()
+    def interrupt(self, session=None):
+        inter, _ = self._get_target(session)
+        if not inter.is_evaluating:
+            return
 
-    def complete(self, prefix):
-        matches = self._inter.complete(prefix)
-        self.add_event('completion', matches=matches)
+        if inter is self._inter:
+            self._interrupt_shared()
+        else:
+            self._sessions.interrupt(inter)
+
+    def _interrupt_shared(self):
+        # the service interpreter is evaluated by the main thread if the
+        # service is blocking, so it is interrupted with a signal
+        utils.interrupt()
+
+    def complete(self, prefix, session=None):
+        inter, add_event = self._get_target(session)
+        if session is not None:
+            # only the requesting session needs the matches
+            add_event = session.add_event
+
+        result = inter.complete(prefix)
+        add_event('completion', matches=result.matches, kinds=result.kinds,
+            truncated=result.truncated, id=result.parent_id)
+
+    def inspect(self, path, session=None):
+        """Sends the details (kind, signature and docstring) of the object at
+        *path*.
+        """
+        inter, add_event = self._get_target(session)
+        if session is not None:
+            add_event = session.add_event
+
+        details = inter.inspect(path) or {}
+        add_event('inspection', path=path, **details)
+
+    def result(self, session, id=None, offset=None, size=None):
+        """Sends a page of the full text of a result (the last one if *id*
+        is `None`), continuing after its preview by default.
+
+        Called where code is evaluated for *session* (see `_schedule`).
+        """
+        inter, _ = self._get_target(session)
+        try:
+            page = inter.get_result(id, offset, size)
+        except KeyboardInterrupt:
+            log.debug('result interrupted: %s', id)
+            page = None
+        except Exception:
+            # the repr of the result failed
+            log.exception('result error: %s', id)
+            page = None
+        if page is None:
+            page = {'id': id, 'text': '', 'offset': offset or 0, 'more': False}
+        session.add_event('result', **page)
+
+    def stats(self, session):
+        """Sends the event queue and link counters for *session*."""
+        stats = session.events.get_stats()
+        stats.update(session.sock.get_stats())
+        session.add_event('stats', **stats)
 
     def reset(self):
         self._inter.reset()
 
+    def _schedule(self, session, func):
+        """Runs *func* where code is evaluated for *session*: the service
+        thread for the service interpreter, the worker pool for a private
+        one. Commands are then free while it runs, and it can be
+        interrupted."""
+        inter, _ = self._get_target(session)
+        if inter is self._inter:
+            self._code_queue.put_nowait(func)
+        else:
+            self._sessions.submit(inter, func)
+
+    def _get_target(self, session):
+        """Returns the interpreter and event function for *session*."""
+        if session is None or session.interpreter is None:
+            return (self._inter, self.add_event)
+        return (session.interpreter, session.add_event)
+
+    ## sessions ##
+
+    def _create_interpreter(self, session):
+        filename = '{}-{}'.format(
+            self._filename or interpreter.DEFAULT_FILENAME, session.id)
+        return interpreter.Interpreter(self._init_locals, filename,
+            lambda text: session.add_event('stdout', text=text),
+            lambda text: session.add_event('stderr', text=text),
+            self._preview_size, self._preview_time,
+            )
+
+    def _create_event_queue(self):
+        return EventQueue(self._flush_latency, self._flush_size, None,
+            self._max_events, self._max_size, self._overflow)
+
     ## handlers ##
 
     def add_event(self, name, **data):
-        if name == 'stdout':
-            log.debug('out: %r', data['text'][:100])
-        elif name == 'stderr':
-            log.debug('err: %r', data['text'][:100])
-        else:
-            log.debug('evt: %s%s', name, (data or '') and ': ' + repr(data))
-
-        event = {'evt': name, 'data': data}
-        self._events.put(event)
+        """Adds an event for every session sharing the service interpreter."""
+        log_event(name, data)
+        self._sessions.broadcast(name, data)
 
     def register_event_handler(self, handler):
         """Registers a handler for an external event loop.
@@ -133,63 +271,683 @@ class Service(object):
         handler."""
         self._event_handlers.append(handler)
 
-    def _handle(self, sock):
-        self._stop.clear()
+    def configure(self, session, codec=None, namespace=None,
+            compression=None, **options):
+        """Applies connection options requested by the controller."""
+        try:
+            if codec is not None:
+                session.sock.codec = codec
+            if compression is not None:
+                session.sock.compression = compression
+            if namespace is not None:
+                self._sessions.set_namespace(session, namespace)
+        except ValueError as e:
+            log.error('configure error: %s', e)
+
+        for name in options:
+            log.warning('unknown option: %s', name)
 
-        self.add_event('start', version=sys.version)
+    def _handle(self, sock):
+        session = self._sessions.open(sock)
+        try:
+            session.add_event('start', version=sys.version,
+                codecs=codec.CODECS, namespaces=NAMESPACES,
+                compressions=codec.COMPRESSIONS)
 
-        t_evt = utils.start_thread(self._handle_events, sock)
-        t_cmd = utils.start_thread(self._handle_commands, sock)
+            t_evt = utils.start_thread(self._handle_events, session)
+            t_cmd = utils.start_thread(self._handle_commands, session)
 
-        t_evt.join()
-        t_cmd.join()
+            t_evt.join()
+            t_cmd.join()
+        finally:
+            self._sessions.remove(session)
 
-    def _handle_events(self, sock):
-        stop = self._stop
-        events = self._events
-        timeout = self._timeout
+    def _handle_events(self, session):
+        sock = session.sock
+        stop = session.stop
+        events = session.events
+        keepalive = self._keepalive
 
         try:
             while not stop.is_set():
                 try:
-                    event = events.get(timeout=timeout)
+                    event = events.get(timeout=keepalive)
                 except queue.Empty:
-                    sock.sendmsg(None)
-                else:
-                    sock.sendmsg(event)
+                    if stop.is_set():
+                        break
+                    # the link has been idle, so send a keepalive
+                    event = None
+                sock.sendmsg(event)
         except sockio.error as e:
             log.error('handle_events error: %s', repr(e))
-            stop.set()
+            session.close()
 
-    def _handle_commands(self, sock):
-        stop = self._stop
+    def _handle_commands(self, session):
+        sock = session.sock
+        stop = session.stop
 
         try:
             while not stop.is_set():
-                try:
-                    msg = sock.recvmsg()
-                except sockio.timeout:
+                if not sock.wait(stop):
                     continue
-
-                cmd = msg['cmd']
-                data = msg.get('data')
-                log.debug('cmd: %s%s', cmd, ': ' + repr(data) if data else '')
-
-                if cmd == 'evaluate':
-                    if self._is_evaluating:
-                        self._inter.recv_input(data['source'] + '\n')
-                    else:
-                        self._code_queue.put(data)
-                elif cmd == 'interrupt':
-                    self.interrupt()
-                elif cmd == 'complete':
-                    self.complete(data)
-                else:
-                    log.error('unknown command: %s', cmd)
+                self._handle_command(session, sock.recvmsg())
 
         except sockio.error as e:
             log.error('handle_commands error: %s', repr(e))
-            stop.set()
+            session.close()
+
+    def _handle_command(self, session, msg):
+        # a bad command must not stop the session's command loop
+        try:
+            self._run_command(session, msg)
+        except Exception:
+            log.exception('command error: %r', msg)
+
+    def _run_command(self, session, msg):
+        cmd = msg['cmd']
+        data = msg.get('data')
+        log.debug('cmd: %s%s', cmd, ': ' + repr(data) if data else '')
+
+        if cmd == 'evaluate':
+            inter, _ = self._get_target(session)
+            if inter.is_evaluating:
+                inter.recv_input(data['source'] + '\n')
+            else:
+                self._schedule(session,
+                    lambda: self.evaluate(session=session, **data))
+        elif cmd == 'interrupt':
+            self.interrupt(session)
+        elif cmd == 'eof':
+            inter, _ = self._get_target(session)
+            # EOF is only meaningful to code that is running
+            if inter.is_evaluating:
+                inter.recv_eof()
+        elif cmd == 'complete':
+            self.complete(data, session)
+        elif cmd == 'inspect':
+            self.inspect(data, session)
+        elif cmd == 'configure':
+            self.configure(session, **data)
+        elif cmd == 'result':
+            self._schedule(session,
+                lambda: self.result(session, **(data or {})))
+        elif cmd == 'stats':
+            self.stats(session)
+        else:
+            log.error('unknown command: %s', cmd)
+
+class SessionManager(object):
+    """Tracks the sessions connected to a service.
+
+    Sessions share the service interpreter by default. Sessions with a
+    private namespace get their own interpreter, which is evaluated by a pool
+    of *workers* threads, so long-running code in one private interpreter
+    doesn't block the others.
+    """
+    def __init__(self, create_event_queue, create_interpreter, workers=None):
+        self._create_event_queue = create_event_queue
+        self._create_interpreter = create_interpreter
+
+        self._lock = threading.Lock()
+        self._sessions = set()
+        # sessions sharing the service interpreter (copied on write)
+        self._shared = ()
+        self._ids = itertools.count(1)
+
+        # events are held here until a session sharing the service
+        # interpreter connects
+        self._events = self._create_backlog()
+
+        self._pool = WorkerPool(WORKERS if workers is None else workers)
+
+    def open(self, sock):
+        with self._lock:
+            # the first session sharing the service interpreter receives the
+            # events that were held while no sessions were connected
+            events, self._events = self._events, self._create_backlog()
+            events.attach()
+
+            session = Session(next(self._ids), sock, events)
+            self._sessions.add(session)
+            self._shared += (session,)
+
+        log.debug('session opened: %s', session.id)
+        return session
+
+    def _create_backlog(self):
+        events = self._create_event_queue()
+        # nothing consumes the backlog, so writers must never block on it
+        events.detach()
+        return events
+
+    def remove(self, session):
+        session.close()
+
+        with self._lock:
+            self._sessions.discard(session)
+            self._shared = tuple(s for s in self._shared if s is not session)
+
+        log.debug('session closed: %s', session.id)
+
+    def close(self):
+        """Closes every session and stops the worker pool."""
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            session.close()
+        self._pool.stop()
+
+    def set_namespace(self, session, namespace):
+        if namespace not in NAMESPACES:
+            raise ValueError('unknown namespace: {}'.format(namespace))
+
+        with self._lock:
+            shared = tuple(s for s in self._shared if s is not session)
+
+            if namespace == SHARED_NAMESPACE:
+                session.interpreter = None
+                shared += (session,)
+            elif session.interpreter is None:
+                session.interpreter = self._create_interpreter(session)
+
+            self._shared = shared
+
+        log.debug('session %s namespace: %s', session.id, namespace)
+
+    def broadcast(self, name, data):
+        """Adds an event for every session sharing the service interpreter."""
+        with self._lock:
+            sessions = self._shared
+            if not sessions:
+                self._events.put(name, data)
+                return
+
+        for session in sessions:
+            session.events.put(name, data)
+
+    def submit(self, inter, func):
+        """Schedules *func* to evaluate code in the private *inter*."""
+        self._pool.submit(inter, func)
+
+    def interrupt(self, inter):
+        self._pool.interrupt(inter)
+
+class WorkerPool(object):
+    """A pool of threads that runs jobs in order for each key.
+
+    Jobs with the same key are run one at a time, in the order they were
+    submitted. Jobs with different keys may run concurrently. Threads are
+    started on demand, up to *size*.
+    """
+    def __init__(self, size):
+        self._size = max(1, size)
+        self._threads = []
+
+        self._lock = threading.Lock()
+        # pending jobs for each scheduled key
+        self._jobs = {}
+        # keys that have a job ready to run
+        self._ready = queue.Queue()
+        # the thread running a job for each key
+        self._running = {}
+
+    def submit(self, key, func):
+        with self._lock:
+            jobs = self._jobs.get(key)
+            if jobs is not None:
+                # the key is already scheduled
+                jobs.append(func)
+                return
+
+            self._jobs[key] = collections.deque([func])
+            if len(self._threads) < min(self._size, len(self._jobs)):
+                self._threads.append(utils.start_thread(self._work))
+        self._ready.put(key)
+
+    def interrupt(self, key):
+        """Raises `KeyboardInterrupt` in the job running for *key*, if any."""
+        # raised while holding the lock, so the job can't finish and the
+        # worker can't start a job for another key in between
+        with self._lock:
+            ident = self._running.get(key)
+            if ident is not None:
+                utils.interrupt_thread(ident)
+
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._ready.put(None)
+
+    def _work(self):
+        ident = threading.current_thread().ident
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            self._run(key, ident)
+
+    def _run(self, key, ident):
+        """Runs the next job for *key*, and schedules the one after it.
+
+        An interrupt may be delivered after the job returns, at any point
+        until it is marked as finished, so that part is retried until it
+        completes. Interrupts are only raised while the job is marked as
+        running (see `interrupt`), and a pending one is dropped when it is
+        marked as finished, so the rest can't be interrupted.
+        """
+        ran = finished = False
+        while not finished:
+            try:
+                if not ran:
+                    ran = True
+                    with self._lock:
+                        func = self._jobs[key].popleft()
+                        self._running[key] = ident
+                    try:
+                        func()
+                    except Exception:
+                        log.exception('worker error')
+
+                with self._lock:
+                    self._running.pop(key, None)
+                    utils.clear_interrupt_thread(ident)
+                finished = True
+            except KeyboardInterrupt:
+                log.debug('job interrupted')
+
+        with self._lock:
+            if self._jobs[key]:
+                self._ready.put(key)
+            else:
+                del self._jobs[key]
+
+class Session(object):
+    """A connection from a controller.
+
+    Each session has its own event queue. Sessions share the service
+    interpreter, unless a private namespace has been configured, in which
+    case *interpreter* is set to an interpreter owned by the session.
+    """
+    def __init__(self, session_id, sock, events):
+        self.id = session_id
+        self.sock = sock
+        self.events = events
+        self.stop = sockio.StopEvent()
+        self.interpreter = None
+
+    def add_event(self, name, **data):
+        log_event(name, data)
+        self.events.put(name, data)
+
+    def close(self):
+        """Stops the connection handlers, waking them if necessary."""
+        self.stop.set()
+        self.events.detach()
+
+class EventQueue(object):
+    """A queue of events that coalesces consecutive output writes.
+
+    Writes to the same output stream are merged into a single event until it
+    holds *flush_size* characters, or until it has waited *flush_latency*
+    seconds to be sent. Any other event closes the pending output event, so
+    ordering is preserved.
+
+    The queue holds at most *max_events* events and *max_size* characters of
+    output. Output that doesn't fit is handled by the *overflow* policy:
+
+    - `OVERFLOW_BLOCK` blocks the writer until the consumer catches up
+    - `OVERFLOW_DROP` drops the oldest output, and a `dropped` event reports
+      what was lost
+    - `OVERFLOW_SPILL` writes output to a temporary file until the queue
+      has been drained
+
+    Other events are never dropped or spilled. Writers are never blocked
+    while the queue is detached from its consumer; output is dropped
+    instead.
+
+    Text longer than *chunk_size* characters is returned as a series of
+    events, so that a single large write never has to be encoded and sent
+    as a single message. Output chunks are plain output events. Chunks of
+    other text events (`STREAM_EVENTS`) are flagged with `more` until the
+    last one.
+
+    Only a single consumer is supported.
+    """
+    def __init__(self, flush_latency=None, flush_size=None, on_put=None,
+            max_events=None, max_size=None, overflow=None, chunk_size=None):
+        self._flush_latency = (FLUSH_LATENCY
+            if flush_latency is None else flush_latency)
+        self._flush_size = FLUSH_SIZE if flush_size is None else flush_size
+        self._chunk_size = CHUNK_SIZE if chunk_size is None else chunk_size
+        # called (from any thread) when an item is added to the queue
+        self._on_put = on_put
+
+        self._max_events = MAX_EVENTS if max_events is None else max_events
+        self._max_size = MAX_SIZE if max_size is None else max_size
+        self._overflow = OVERFLOW if overflow is None else overflow
+        if self._overflow not in OVERFLOW_POLICIES:
+            raise ServiceError('unknown overflow policy: {}'.format(overflow))
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        # the output event that is still accepting writes
+        self._pending = None
+        # characters of output held in memory
+        self._size = 0
+        self._attached = True
+
+        # output is written here while spilling
+        self._spill = None
+        self._spilling = False
+
+        # output dropped since the last `dropped` event
+        self._dropped = None
+        self._stats = dict.fromkeys(STATS, 0)
+
+    def put(self, name, data):
+        with self._cond:
+            self._stats['events'] += 1
+
+            if name in OUTPUT_EVENTS:
+                if not self._put_output(name, data['text']):
+                    return
+            else:
+                self._pending = None
+                if (name in STREAM_EVENTS and
+                        len(data.get('text', '')) > self._chunk_size):
+                    item = StreamEvent(name, data)
+                else:
+                    item = {'evt': name, 'data': data}
+                self._queue.append(item)
+
+            # writers may be blocked on the condition too
+            self._cond.notify_all()
+
+            if self._on_put is not None:
+                self._on_put()
+
+    def _put_output(self, name, text):
+        """Adds output to the queue. Returns `True` if an event was added."""
+        size = len(text)
+        self._stats['size'] += size
+
+        if not self._spilling and self._overflows(name, size):
+            if self._overflow == OVERFLOW_SPILL:
+                self._start_spilling()
+            elif self._overflow == OVERFLOW_BLOCK and self._attached:
+                self._wait_for_space(name, size)
+            else:
+                self._drop_oldest(name, size)
+
+        pending = self._pending
+        if self._can_append(name, size):
+            pending.append(text)
+            added = False
+        else:
+            self._pending = pending = OutputEvent(name, text,
+                self._spill if self._spilling else None)
+            self._queue.append(pending)
+            added = True
+
+        if pending.spilled:
+            self._stats['spilled_size'] += size
+        else:
+            self._size += size
+        return added
+
+    def _can_append(self, name, size):
+        """Returns `True` if output can be added to the pending event."""
+        pending = self._pending
+        return (pending is not None and pending.name == name and
+            pending.size + size <= self._flush_size)
+
+    def _overflows(self, name, size, count=None):
+        count = len(self._queue) if count is None else count
+        if not count:
+            return False
+        if self._size + size > self._max_size:
+            return True
+        return count >= self._max_events and not self._can_append(name, size)
+
+    def _start_spilling(self):
+        if self._spill is None:
+            import tempfile
+            self._spill = tempfile.TemporaryFile()
+        self._spilling = True
+        # the pending event is held in memory
+        self._pending = None
+        log.debug('spilling output')
+
+    def _wait_for_space(self, name, size):
+        start = time.time()
+        while self._attached and self._overflows(name, size):
+            self._cond.wait()
+        self._stats['blocked_time'] += time.time() - start
+
+    def _drop_oldest(self, name, size):
+        q = self._queue
+        # other events are kept in order at the front of the queue
+        kept = []
+        while q and self._overflows(name, size, len(q) + len(kept)):
+            item = q.popleft()
+            if not isinstance(item, OutputEvent):
+                kept.append(item)
+                continue
+
+            if item is self._pending:
+                self._pending = None
+            self._size -= item.size
+
+            lines = item.text().count('\n')
+            if self._dropped is None:
+                self._dropped = dict.fromkeys(('events', 'lines', 'size'), 0)
+            for stats, prefix in ((self._dropped, ''), (self._stats, 'dropped_')):
+                stats[prefix + 'events'] += 1
+                stats[prefix + 'lines'] += lines
+                stats[prefix + 'size'] += item.size
+
+        q.extendleft(reversed(kept))
+
+    def get(self, timeout=None):
+        """Returns the next event.
+
+        Raises `queue.Empty` if no event is available within *timeout*
+        seconds.
+        """
+        q = self._queue
+        cond = self._cond
+
+        with cond:
+            while True:
+                if self._dropped is not None:
+                    # report dropped output before the output that followed
+                    dropped, self._dropped = self._dropped, None
+                    return {'evt': 'dropped', 'data': dropped}
+
+                if not q:
+                    cond.wait(timeout)
+                    if not q:
+                        raise queue.Empty()
+                    continue
+
+                item = q[0]
+                if not isinstance(item, OutputEvent):
+                    break
+
+                # give the output a chance to accumulate more writes
+                deadline = item.time + self._flush_latency
+                while item is self._pending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+
+                # the event may have been dropped while waiting
+                if q and q[0] is item:
+                    break
+
+            # large events are returned in chunks, and stay in the queue
+            # until the last one
+            if isinstance(item, OutputEvent):
+                if item is self._pending:
+                    self._pending = None
+                text, more = item.read(self._chunk_size)
+                if not item.spilled:
+                    self._size -= len(text)
+                event = {'evt': item.name, 'data': {'text': text}}
+            elif isinstance(item, StreamEvent):
+                event, more = item.read(self._chunk_size)
+            else:
+                event, more = item, False
+
+            if not more:
+                q.popleft()
+
+            if not q and self._spilling:
+                self._stop_spilling()
+
+            # wake blocked writers
+            cond.notify_all()
+
+        return event
+
+    def _stop_spilling(self):
+        self._spilling = False
+        self._spill.seek(0)
+        self._spill.truncate()
+        log.debug('stopped spilling output')
+
+    def attach(self):
+        """Allows writers to be blocked by the overflow policy."""
+        with self._cond:
+            self._attached = True
+
+    def detach(self):
+        """Marks the queue as having no consumer, waking blocked writers."""
+        with self._cond:
+            self._attached = False
+            self._cond.notify_all()
+
+    def get_stats(self):
+        """Returns the queue counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                queued=len(self._queue),
+                queued_size=self._size,
+                overflow=self._overflow,
+                max_events=self._max_events,
+                max_size=self._max_size,
+                )
+        return stats
+
+    def __len__(self):
+        return len(self._queue)
+
+class OutputEvent(object):
+    """An output event that is still accumulating text.
+
+    The text is held in memory, or appended to the *spill* file if set. Once
+    it has been closed, the text is consumed with `read`.
+    """
+    __slots__ = ('name', 'size', 'time', '_parts', '_spill', '_offset',
+        '_length', '_pos', '_decoder')
+
+    def __init__(self, name, text, spill=None):
+        self.name = name
+        # characters that have not been read
+        self.size = 0
+        self.time = time.time()
+        self._parts = []
+
+        self._spill = spill
+        self._offset = spill.tell() if spill is not None else None
+        self._length = 0
+
+        # characters (in memory) or bytes (spilled) that have been read
+        self._pos = 0
+        self._decoder = None
+
+        self.append(text)
+
+    @property
+    def spilled(self):
+        return self._spill is not None
+
+    def append(self, text):
+        self.size += len(text)
+        if self._spill is None:
+            self._parts.append(text)
+        else:
+            data = text.encode('utf8')
+            self._spill.write(data)
+            self._length += len(data)
+
+    def read(self, size):
+        """Returns up to *size* characters, and whether any text remains."""
+        if self._spill is None:
+            text = self._joined()[self._pos:self._pos+size]
+            self._pos += len(text)
+        else:
+            text = self._read_spill(size)
+        self.size -= len(text)
+        return text, self.size > 0
+
+    def text(self):
+        """Returns the text that has not been read."""
+        if self._spill is None:
+            return self._joined()[self._pos:]
+        return self._read_spill(self._length)
+
+    def _joined(self):
+        parts = self._parts
+        if len(parts) != 1:
+            self._parts = parts = [''.join(parts)]
+        return parts[0]
+
+    def _read_spill(self, size):
+        spill = self._spill
+        if self._decoder is None:
+            self._decoder = codecs.getincrementaldecoder('utf8')()
+
+        spill.seek(self._offset + self._pos)
+        # a character is encoded in one to four bytes
+        data = spill.read(min(max(size, 4), self._length - self._pos))
+        # new output is appended at the end
+        spill.seek(0, 2)
+
+        self._pos += len(data)
+        return self._decoder.decode(data, self._pos == self._length)
+
+class StreamEvent(object):
+    """An event with a large text field that is sent in chunks."""
+    __slots__ = ('name', 'data', '_pos')
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self._pos = 0
+
+    def read(self, size):
+        """Returns the next chunk event, and whether any text remains."""
+        text = self.data['text']
+        chunk = text[self._pos:self._pos+size]
+        self._pos += len(chunk)
+
+        data = dict(self.data, text=chunk)
+        more = self._pos < len(text)
+        if more:
+            data['more'] = True
+        return {'evt': self.name, 'data': data}, more
+
+def log_event(name, data):
+    if name == 'stdout':
+        log.debug('out: %r', data['text'][:100])
+    elif name == 'stderr':
+        log.debug('err: %r', data['text'][:100])
+    else:
+        log.debug('evt: %s%s', name, (data or '') and ': ' + repr(data))
 
 class Client(Service):
     def start(self, addr):
@@ -214,7 +972,8 @@ class Server(Service):
 
     def serve(self, address):
         address = utils.parse_address(address)
-        server, _addr = sockio.start_server(address, self._handle)
+        server, _addr = sockio.start_server(address, self._handle,
+            concurrent=True)
         try:
             self.run()
         finally:
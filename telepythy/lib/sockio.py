@@ -1,13 +1,16 @@
 import io
-import json
-import time
 import errno
 import socket
-import struct
+import select
 import threading
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 from . import logs
 from . import utils
+from . import codec
 
 TIMEOUT = 0.1
 BACKLOG = socket.SOMAXCONN
@@ -19,7 +22,7 @@ timeout = socket.timeout
 log = logs.get(__name__)
 
 def start_client(address, handler, stop=None, retry_limit=-1, retry_interval=1):
-    stop = stop or threading.Event()
+    stop = stop or StopEvent()
 
     t = utils.start_thread(client_loop,
         address, handler, stop, retry_limit, retry_interval)
@@ -42,11 +45,12 @@ def client_loop(address, handler, stop, retry_limit, retry_interval):
         if retry_limit != -1 and count > retry_limit:
             log.warning('retry limit reached (attempt #%s)', count)
             break
-        time.sleep(retry_interval)
+        if stop.wait(retry_interval):
+            break
         log.warning('retrying connection (attempt #%s)', count)
 
-def start_server(address, handler, stop=None, backlog=None):
-    stop = stop or threading.Event()
+def start_server(address, handler, stop=None, backlog=None, concurrent=False):
+    stop = stop or StopEvent()
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -56,27 +60,52 @@ def start_server(address, handler, stop=None, backlog=None):
     host, port = sock.getsockname()
     log.info('listening: %s:%s', host, port)
 
-    t = utils.start_thread(server_loop, sock, handler, stop)
+    t = utils.start_thread(server_loop, sock, handler, stop, concurrent)
     return (StoppableThread(t, stop), (host, port))
 
-def server_loop(server_sock, handler, stop):
-    timeout = TIMEOUT
-    server_sock.settimeout(timeout)
-
-    while not stop.is_set():
-        try:
-            s, addr = server_sock.accept()
-        except socket.timeout:
-            continue
+def server_loop(server_sock, handler, stop, concurrent=False):
+    """Accepts connections and passes them to *handler*.
+
+    If *concurrent* is `True`, each connection is handled in its own thread.
+    Otherwise, connections are handled one at a time.
+    """
+    server_sock.setblocking(False)
+    waiter = Waiter(server_sock, stop)
+
+    try:
+        while not stop.is_set():
+            if not waiter.wait():
+                continue
+
+            try:
+                s, addr = server_sock.accept()
+            except socket.error as e:
+                # the connection was dropped before it could be accepted
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
 
-        log.info('connected: %s:%s', *addr)
-        with SockIO(s) as sock:
-            sock.settimeout(timeout)
-            handler(sock)
+            if concurrent:
+                utils.start_thread(handle_connection, s, addr, handler)
+            else:
+                handle_connection(s, addr, handler)
+    finally:
+        waiter.close()
+        server_sock.close()
+
+def handle_connection(s, addr, handler):
+    log.info('connected: %s:%s', *addr)
+    with SockIO(s) as sock:
+        sock.settimeout(None)
+        handler(sock)
+    log.info('disconnected: %s:%s', *addr)
 
 def connect(address, timeout=None):
     log.debug('connecting: %s:%s', *address)
     sock = socket.create_connection(address, timeout)
+    # the timeout only applies to connecting. waits for data are done with
+    # `SockIO.wait`
+    sock.settimeout(None)
     log.info('connected: %s:%s', *address)
     return SockIO(sock)
 
@@ -85,28 +114,58 @@ class SockIO(object):
         self._sock = sock
         self._chunk_size = chunk_size or CHUNK_SIZE
 
+        # messages are always sent as JSON until the peer has advertised
+        # support for another codec. received messages are decoded according
+        # to their own frame format.
+        self._codec = codec.JSONCodec
+        # the same goes for compression
+        self._framing = codec.Framing()
+        self._send_lock = threading.Lock()
+
+        self._waiter = None
+
+    @property
+    def codec(self):
+        return self._codec.name
+
+    @codec.setter
+    def codec(self, name):
+        self._codec = codec.get(name)
+        log.debug('codec: %s', name)
+
+    @property
+    def compression(self):
+        return self._framing.compression
+
+    @compression.setter
+    def compression(self, name):
+        with self._send_lock:
+            self._framing.compression = name
+        log.debug('compression: %s', name)
+
+    def get_stats(self):
+        """Returns the link counters."""
+        with self._send_lock:
+            return self._framing.get_stats()
+
     def sendmsg(self, msg):
-        data = json.dumps(msg).encode('utf8')
-        self.send(data)
+        self.send(self._codec.encode(msg))
 
     def recvmsg(self):
-        data = self.recv()
-        return json.loads(data.decode('utf8'))
+        return codec.decode(self.recv())
 
     def send(self, data):
-        data_len = len(data)
-        size = struct.pack('>I', data_len)
-        self._sock.sendall(size)
-        self._sock.sendall(data)
+        with self._send_lock:
+            self._sock.sendall(self._framing.frame(data))
 
     def recv(self):
         return b''.join(self.recviter())
 
     def recviter(self):
-        buf = b''.join(self.recvsize(4))
-        data_len = struct.unpack('>I', buf)[0]
-        for chunk in self.recvsize(data_len):
-            yield chunk
+        framing = self._framing
+        size, compressed = framing.read_header(b''.join(self.recvsize(4)))
+        for chunk in self.recvsize(size):
+            yield framing.read(chunk, compressed)
 
     def recvsize(self, size):
         sock = self._sock
@@ -120,10 +179,26 @@ class SockIO(object):
             pos += len(chunk)
             yield chunk
 
+    def wait(self, stop, timeout=None):
+        """Waits until a message can be received, or until *stop* is set.
+
+        Returns `True` if the socket is readable.
+        """
+        waiter = self._waiter
+        if waiter is None or waiter.stop is not stop:
+            if waiter is not None:
+                waiter.close()
+            self._waiter = waiter = Waiter(self._sock, stop)
+        return waiter.wait(timeout)
+
     def settimeout(self, t):
         self._sock.settimeout(t)
 
     def close(self):
+        if self._waiter is not None:
+            self._waiter.close()
+            self._waiter = None
+
         try:
             self._sock.shutdown(socket.SHUT_RDWR)
         except (OSError, socket.error) as e:
@@ -138,6 +213,96 @@ class SockIO(object):
     def __exit__(self, etype, evalue, etb):
         self.close()
 
+class Waiter(object):
+    """Waits for a socket to become readable, or for a `StopEvent`.
+
+    Uses the best selector available for the platform, so waiting costs
+    nothing until there is something to do.
+    """
+    def __init__(self, sock, stop):
+        self.sock = sock
+        self.stop = stop
+
+        if selectors is None:
+            self._selector = None
+        else:
+            self._selector = sel = selectors.DefaultSelector()
+            sel.register(sock, selectors.EVENT_READ, True)
+            sel.register(stop, selectors.EVENT_READ, False)
+
+    def wait(self, timeout=None):
+        """Returns `True` if the socket is readable and *stop* is not set."""
+        stop = self.stop
+        if stop.is_set():
+            return False
+
+        try:
+            if self._selector is None:
+                ready, _, _ = select.select([self.sock, stop], [], [], timeout)
+                readable = self.sock in ready
+            else:
+                ready = self._selector.select(timeout)
+                readable = any(key.data for key, _ in ready)
+        except (select.error, OSError) as e:
+            # python 2 does not retry on signals
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+
+        return readable and not stop.is_set()
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+
+class StopEvent(object):
+    """A `threading.Event` that can also wake up a `Waiter`."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._rsock, self._wsock = socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def set(self):
+        self._event.set()
+        try:
+            self._wsock.send(b'\0')
+        except socket.error:
+            # the buffer is full, so waiters are already awake
+            pass
+
+    def clear(self):
+        self._event.clear()
+        try:
+            while self._rsock.recv(CHUNK_SIZE):
+                pass
+        except socket.error:
+            pass
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def fileno(self):
+        return self._rsock.fileno()
+
+def socketpair():
+    try:
+        return socket.socketpair()
+    except (AttributeError, OSError):
+        # not available on windows before python 3.5
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            wsock = socket.create_connection(server.getsockname())
+            rsock, _addr = server.accept()
+        finally:
+            server.close()
+        return rsock, wsock
+
 class StoppableThread(object):
     def __init__(self, thread, stop):
         self._thread = thread
@@ -48,6 +48,27 @@ def interrupt(pid=None):
     log.debug('interrupting process: %s', pid)
     os.kill(pid, signal.CTRL_C_EVENT if IS_WINDOWS else signal.SIGINT)
 
+def interrupt_thread(ident):
+    """Raises `KeyboardInterrupt` in the thread identified by *ident*.
+
+    The exception is raised the next time the thread executes Python code,
+    so a thread blocked in a system call is not interrupted until it returns.
+    """
+    import ctypes
+
+    log.debug('interrupting thread: %s', ident)
+    count = ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(ident), ctypes.py_object(KeyboardInterrupt))
+    if count == 0:
+        log.warning('thread not found: %s', ident)
+
+def clear_interrupt_thread(ident):
+    """Drops a `KeyboardInterrupt` raised by `interrupt_thread` in the thread
+    identified by *ident* that hasn't been delivered yet."""
+    import ctypes
+
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), None)
+
 if IS_WINDOWS:
     # Handling Ctrl+C cleanly on Windows for child processes is tricky.
     # Dreampie uses a commonly recommended technique that calls
@@ -3,8 +3,10 @@
 import os
 import sys
 import glob
+import marshal
 import zipfile
 import argparse
+import importlib.util
 
 from .lib import utils
 from .lib import logs
@@ -13,6 +15,21 @@ MAIN = 'from telepythy.__main__ import run; run()'
 
 log = logs.get('telepythy.pack')
 
+# hash-based pyc that is never checked against its source (PEP 552)
+PYC_UNCHECKED = (1).to_bytes(4, 'little')
+
+def compile_pyc(source, path):
+    """Returns the contents of a pyc file for *source*.
+
+    zipimport loads the pyc next to a module in the package before its source,
+    and falls back to the source when the pyc was compiled by another version
+    of Python (e.g. the service is started with a different Python than the
+    GUI).
+    """
+    code = compile(source, path, 'exec', dont_inherit=True)
+    return (importlib.util.MAGIC_NUMBER + PYC_UNCHECKED +
+        importlib.util.source_hash(source) + marshal.dumps(code))
+
 def pack(dst_path=None):
     # don't run if frozen
     if getattr(sys, 'frozen', False):
@@ -24,13 +41,17 @@ def pack(dst_path=None):
     with open(dst_path, 'wb') as f:
         f.write(b'#! /usr/bin/env python\n')
 
-        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED,
+        # stored uncompressed, so imports don't have to decompress each module
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED,
                 allowZip64=False) as zip:
             for path in glob.iglob(src_path, recursive=True):
                 if 'gui' in path: continue
-                dst = os.path.relpath(path)
+                dst = os.path.relpath(path, utils.get_path())
                 log.debug('+ %s', dst)
-                zip.write(path, dst)
+                with open(path, 'rb') as src:
+                    source = src.read()
+                zip.writestr(dst, source)
+                zip.writestr(dst + 'c', compile_pyc(source, dst))
             zip.writestr('__main__.py', MAIN)
 
     os.chmod(dst_path, 0o755)
@@ -0,0 +1,36 @@
+import socket
+import asyncio
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def recv_until(sock, name):
+    """Returns the events received on *sock* up to and including *name*."""
+    events = []
+    while True:
+        msg = sock.recvmsg()
+        # skip keepalives
+        if msg is None:
+            continue
+        events.append(msg)
+        if msg['evt'] == name:
+            return events
+
+async def recv_until_async(sock, name):
+    """Like `recv_until`, for an `aio.AsyncSockIO`."""
+    events = []
+    while True:
+        msg = await asyncio.wait_for(sock.recvmsg(), 5)
+        # skip keepalives
+        if msg is None:
+            continue
+        events.append(msg)
+        if msg['evt'] == name:
+            return events
+
+def output(events):
+    return ''.join(e['data']['text'] for e in events if e['evt'] == 'stdout')
@@ -0,0 +1,85 @@
+import queue
+import asyncio
+
+import pytest
+
+from telepythy.lib import aio
+from telepythy.gui import control
+
+from .conftest import free_port, recv_until_async, output
+
+async def connect(port):
+    for _ in range(50):
+        try:
+            reader, writer = await asyncio.open_connection('localhost', port)
+        except OSError:
+            # the server hasn't started listening yet
+            await asyncio.sleep(0.02)
+        else:
+            return aio.AsyncSockIO(reader, writer)
+    raise AssertionError('server did not start')
+
+def test_server():
+    async def main():
+        port = free_port()
+        svc = aio.AsyncServer({}, flush_latency=0)
+        task = svc.start('localhost:{}'.format(port))
+
+        sock = await connect(port)
+        start = await recv_until_async(sock, 'start')
+        assert 'compressions' in start[-1]['data']
+
+        sock.sendmsg({'cmd': 'evaluate', 'data': {'source': 'print(1 + 1)'}})
+        await sock.drain()
+        assert output(await recv_until_async(sock, 'done')) == '2\n'
+
+        sock.sendmsg({'cmd': 'stats'})
+        await sock.drain()
+        stats = (await recv_until_async(sock, 'stats'))[-1]['data']
+        assert stats['events'] >= 2
+        assert stats['sent_frames'] >= 2
+
+        svc.stop()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # the connection was closed by the service
+        with pytest.raises(EOFError):
+            await recv_until_async(sock, 'done')
+        sock.close()
+
+    asyncio.run(main())
+
+def test_client_control():
+    async def main():
+        port = free_port()
+        svc = aio.AsyncServer({}, flush_latency=0)
+        task = svc.start('localhost:{}'.format(port))
+
+        events = queue.Queue()
+        ctl = control.AsyncClientControl(('localhost', port))
+        for name in ('start', 'stdout', 'done', 'stats'):
+            ctl.register(name, events.put)
+        # the control runs its own loop in a thread
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, ctl.start)
+
+        async def recv(name):
+            while True:
+                event = await loop.run_in_executor(None, events.get, True, 5)
+                if event['evt'] == name:
+                    return event
+
+        await recv('start')
+        ctl.evaluate('print("hello")')
+        assert (await recv('stdout'))['data']['text'] == 'hello\n'
+        await recv('done')
+
+        ctl.stats()
+        assert (await recv('stats'))['data']['recv_frames'] >= 1
+
+        await loop.run_in_executor(None, ctl.stop)
+        svc.stop()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
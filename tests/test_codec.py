@@ -0,0 +1,90 @@
+import pytest
+
+from telepythy.lib import codec
+
+MESSAGES = [
+    None,
+    {'evt': 'stdout', 'data': {'text': 'hello\n'}},
+    {'evt': 'stderr', 'data': {'text': 'café\n'}},
+    {'evt': 'done', 'data': {}},
+    {'evt': 'completion', 'data': {'matches': ['print', 'property']}},
+    {'evt': 'start', 'data': {'version': '3.x', 'codecs': ['binary']}},
+    {'cmd': 'evaluate', 'data': {'source': 'x = 1', 'notify': True}},
+    ]
+
+@pytest.mark.parametrize('msg', MESSAGES)
+def test_binary_roundtrip(msg):
+    data = codec.BinaryCodec.encode(msg)
+    assert data[:1] == codec.MAGIC
+    assert codec.decode(data) == msg
+
+@pytest.mark.parametrize('msg', MESSAGES)
+def test_json_roundtrip(msg):
+    data = codec.JSONCodec.encode(msg)
+    assert codec.decode(data) == msg
+
+def test_binary_is_compact():
+    msg = {'evt': 'stdout', 'data': {'text': 'x'}}
+    assert len(codec.BinaryCodec.encode(msg)) == 3
+    assert len(codec.BinaryCodec.encode(None)) == 2
+
+@pytest.mark.parametrize('obj', [
+    0, 127, 128, -1, -32, -33, 2**63 - 1, -2**63, 2**64 - 1,
+    1.5, '', 'a' * 31, 'a' * 32, b'\x00\xff',
+    list(range(20)), dict((str(i), i) for i in range(20)),
+    [True, False, None, {'nested': [1, 'two']}],
+    ])
+def test_pack_roundtrip(obj):
+    assert codec.unpack(codec.pack(obj)) == obj
+
+def test_pack_unsupported():
+    with pytest.raises(codec.CodecError):
+        codec.pack(object())
+    with pytest.raises(codec.CodecError):
+        codec.pack(2**64)
+
+def test_unpack_truncated():
+    with pytest.raises(codec.CodecError):
+        codec.unpack(codec.pack('hello')[:-1])
+    # fixed-width values and sizes
+    for obj in (1.5, 2**40, -2**40, 'x' * 100, b'bytes', list(range(20)),
+            dict.fromkeys(range(20))):
+        data = codec.pack(obj)
+        for end in range(len(data)):
+            with pytest.raises(codec.CodecError):
+                codec.unpack(data[:end])
+
+def test_unpack_invalid():
+    with pytest.raises(codec.CodecError):
+        codec.unpack(b'\xa2\xff\xfe')
+
+def test_negotiate():
+    assert codec.negotiate(['json', 'binary']) == 'binary'
+    assert codec.negotiate(['json']) == 'json'
+    assert codec.negotiate(None) == 'json'
+
+def test_framing_compression():
+    sender = codec.Framing(threshold=16)
+    sender.compression = codec.ZLIB
+    receiver = codec.Framing()
+
+    payloads = [b'small', b'repeated text ' * 100, b'repeated text ' * 100]
+    frames = [sender.frame(data) for data in payloads]
+    assert len(frames[0]) == 4 + 5
+    # the second frame benefits from the first
+    assert len(frames[2]) < len(frames[1]) < len(payloads[1])
+
+    for data, frame in zip(payloads, frames):
+        size, compressed = receiver.read_header(frame[:4])
+        assert size == len(frame) - 4
+        assert compressed == (len(data) >= 16)
+        assert receiver.read(frame[4:], compressed) == data
+
+    stats = sender.get_stats()
+    assert stats['compression'] == codec.ZLIB
+    assert stats['sent_ratio'] > 1
+    assert receiver.get_stats()['recv_size'] == stats['sent_size']
+
+def test_negotiate_compression():
+    assert codec.negotiate_compression(['zlib']) == 'zlib'
+    assert codec.negotiate_compression(None) is None
@@ -0,0 +1,113 @@
+import sys
+import time
+import queue
+
+from telepythy.lib import service
+from telepythy.lib import interpreter
+from telepythy.gui import control
+
+def recv(events, name):
+    while True:
+        event = events.get(timeout=5)
+        if event['evt'] == name:
+            return event
+
+def test_prepare(tmp_path):
+    startup = tmp_path / 'startup.py'
+    startup.write_text('value = 42\n')
+
+    ctl = control.ServerControl(('localhost', 0), compress=False)
+    ctl.startup_path = str(startup)
+    ctl.prepare()
+    assert ctl.prepared
+
+    svc = service.Client({}, flush_latency=0)
+    svc.start('{}:{}'.format(*ctl._address))
+    # the client stops by itself once the control closes the connection
+    thread = svc._thread
+    try:
+        # the session starts while the events are held
+        for _ in range(100):
+            if (isinstance(sys.stdout, interpreter.StreamRouter) and
+                    svc.locals.get('value') == 42):
+                break
+            time.sleep(0.05)
+        assert svc.locals['value'] == 42
+
+        events = queue.Queue()
+        for name in ('start', 'stdout'):
+            ctl.register(name, events.put)
+        ctl.release()
+        assert not ctl.prepared
+
+        assert 'version' in recv(events, 'start')['data']
+        ctl.evaluate('print(value)')
+        assert recv(events, 'stdout')['data']['text'] == '42\n'
+    finally:
+        ctl.stop()
+        svc.stop()
+        thread.join(5)
+
+def test_prepare_limit():
+    ctl = control.Control(('localhost', 0))
+    ctl.prepare()
+
+    # keepalives are not held, so they can't evict the start event
+    for _ in range(control.HOLD_LIMIT * 2):
+        ctl._call_handlers(None, ctl._address)
+    ctl._call_handlers('start', {'evt': 'start'})
+    for i in range(control.HOLD_LIMIT + 10):
+        ctl._call_handlers('stdout', {'data': {'text': '{}\n'.format(i)}})
+
+    events = []
+    for name in (None, 'start', 'stdout', 'dropped'):
+        ctl.register(name, lambda event, name=name: events.append(
+            (name, event)))
+    ctl.release()
+
+    assert events[0] == (None, ('localhost', 0))
+    assert events[1] == ('start', {'evt': 'start'})
+    assert events[2] == ('stdout', {'data': {'text': '0\n'}})
+    assert len(events) == control.HOLD_LIMIT + 2
+    assert events[-1][0] == 'dropped'
+    assert events[-1][1]['data']['lines'] == 11
+
+def test_stop_while_forking():
+    import threading
+
+    class Process:
+        killed = False
+        def kill(self):
+            self.killed = True
+
+    class SlowForkServer:
+        def __init__(self):
+            self.release = threading.Event()
+            self.forked = threading.Event()
+            self.proc = Process()
+        def fork(self, address):
+            # e.g. still importing the preload modules
+            self.release.wait(5)
+            self.forked.set()
+            return self.proc
+
+    server = SlowForkServer()
+    ctl = control.ProcessControl(('localhost', 0), 'python',
+        fork_server=server)
+    ctl.start()
+    assert ctl.is_running
+
+    # the pending fork isn't waited for
+    start = time.time()
+    ctl.stop()
+    assert time.time() - start < 1
+    assert not ctl.is_running
+
+    # the process is stopped once it has been forked
+    server.release.set()
+    assert server.forked.wait(5)
+    for _ in range(100):
+        if server.proc.killed:
+            break
+        time.sleep(0.01)
+    assert server.proc.killed
@@ -0,0 +1,110 @@
+import os
+import sys
+import signal
+import socket
+import subprocess
+
+import pytest
+
+from telepythy.lib import sockio
+
+from .conftest import recv_until
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'),
+    reason='requires os.fork')
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+def accept(server):
+    conn, _addr = server.accept()
+    conn.settimeout(5)
+    return sockio.SockIO(conn)
+
+def test_fork_clients():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('localhost', 0))
+    server.listen(2)
+    server.settimeout(10)
+    address = '{}:{}\n'.format(*server.getsockname())
+
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'telepythy', '--fork-server',
+            '--preload', 'fractions, missing_module_'],
+        cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        universal_newlines=True)
+    socks = []
+    pids = []
+    try:
+        for _ in range(2):
+            proc.stdin.write(address)
+            proc.stdin.flush()
+            name, pid = proc.stdout.readline().split()
+            assert name == 'forked'
+            pids.append(int(pid))
+            socks.append(accept(server))
+        assert proc.pid not in pids
+        assert len(set(pids)) == 2
+
+        first, second = socks
+        for sock in socks:
+            recv_until(sock, 'start')
+
+        # the module was imported by the server, but each client has its
+        # own namespace
+        first.sendmsg({'cmd': 'evaluate', 'data': {
+            'source': 'import sys; value = 1; print("fractions" in sys.modules)'}})
+        events = recv_until(first, 'done')
+        assert 'True\n' in [e['data'].get('text') for e in events]
+
+        second.sendmsg({'cmd': 'evaluate', 'data': {
+            'source': 'print("value" in globals())'}})
+        events = recv_until(second, 'done')
+        assert 'False\n' in [e['data'].get('text') for e in events]
+
+        # like the services they replace, clients keep retrying to connect,
+        # so they are killed by the server, which reports their exit. pids
+        # that aren't its clients are ignored.
+        proc.stdin.write('kill {}\n'.format(proc.pid))
+        for pid in pids:
+            proc.stdin.write('kill {}\n'.format(pid))
+        proc.stdin.flush()
+        for pid in pids:
+            assert proc.stdout.readline().split() == [
+                'exited', str(pid), str(-signal.SIGKILL)]
+        pids = []
+    finally:
+        for sock in socks:
+            sock.close()
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+        proc.stdin.close()
+        assert proc.wait(10) == 0
+        server.close()
+
+def test_fork_server_control(monkeypatch):
+    from telepythy.gui import control
+
+    def start_service(command, args, verbose=0, **kwargs):
+        return subprocess.Popen([sys.executable, '-m', 'telepythy'] + args,
+            cwd=ROOT, **kwargs)
+    monkeypatch.setattr(control, 'start_service', start_service)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('localhost', 0))
+    server.listen(1)
+    server.settimeout(10)
+
+    fork_server = control.ForkServer(sys.executable)
+    try:
+        child = fork_server.fork(server.getsockname())
+        sock = accept(server)
+        assert child.poll() is None
+
+        # the server kills the process, and reports its exit
+        child.kill()
+        assert child.wait(5) == -signal.SIGKILL
+        assert child.poll() == -signal.SIGKILL
+        sock.close()
+    finally:
+        fork_server.stop()
+        server.close()
@@ -1,3 +1,5 @@
+import time
+
 import pytest
 
 from telepythy.gui import history
@@ -71,3 +73,137 @@ def test_no_duplicates(hist):
     assert hist.previous() == 'zeta'
     assert hist.previous() == 'epsilon'
     assert hist.previous() == 'delta'
+
+def test_search(hist):
+    assert list(hist.search('ta')) == [(4, 'delta'), (2, 'eta'), (1, 'beta')]
+    assert list(hist.search('x')) == []
+
+def test_prefix_index():
+    h = history.History()
+    for i in range(100):
+        h.append('value{}'.format(i % 10))
+    h.append('value1 = 2')
+
+    assert h.previous('value1') == 'value1 = 2'
+    assert h.previous('value1') == 'value1'
+    assert h.index == 91
+    assert h.previous('value1') == 'value1'
+    assert h.index == 81
+    assert h.next('value1') == 'value1'
+    assert h.index == 91
+
+    # appending updates the index
+    h.append('value1 + 1')
+    assert h.previous('value1 ') == 'value1 + 1'
+    assert h.previous('value1 ') == 'value1 = 2'
+    assert h.previous('value1 ') is None
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / 'history')
+    h = history.History(path)
+    h.append('alpha')
+    h.append('beta\ngamma')
+    h.append('beta\ngamma')
+
+    h = history.History(path)
+    assert h.previous() == 'beta\ngamma'
+    assert h.previous() == 'alpha'
+    h.append('delta')
+
+    with open(path) as f:
+        assert len(f.readlines()) == 3
+
+def test_persistent_lazy(tmp_path):
+    path = tmp_path / 'history'
+    h = history.History(str(path))
+    # the file is read when the history is first used
+    path.write_text('"alpha"\n"beta"\nnot json\n"gamma"\n')
+    assert h.last() == 'gamma'
+    assert h.previous() == 'beta'
+    assert h.previous() == 'alpha'
+
+def test_persistent_missing(tmp_path):
+    h = history.History(str(tmp_path / 'missing' / 'history'))
+    assert not h
+    assert h.previous() is None
+    h.append('alpha')
+    assert h.previous() == 'alpha'
+
+def test_find():
+    h = history.History()
+    for value in ('import numpy as np', 'np.arange(10)', 'x = np.zeros(3)',
+            'numpy.zeros(3)', 'print(x)'):
+        h.append(value)
+
+    def find(query):
+        return [value for _, value in h.find(query)]
+
+    # closer matches rank first, then newer entries
+    assert find('zeros') == ['numpy.zeros(3)', 'x = np.zeros(3)']
+    assert find('np') == ['x = np.zeros(3)', 'np.arange(10)',
+        'import numpy as np', 'numpy.zeros(3)']
+    assert find('umpy') == ['numpy.zeros(3)', 'import numpy as np']
+    assert find('ZEROS np') == ['x = np.zeros(3)', 'numpy.zeros(3)']
+    # the characters of a term only need to appear in order
+    assert find('nz') == ['numpy.zeros(3)', 'x = np.zeros(3)']
+    assert find('arng') == ['np.arange(10)']
+    assert find('missing') == []
+    assert find('') == ['print(x)', 'numpy.zeros(3)', 'x = np.zeros(3)',
+        'np.arange(10)', 'import numpy as np']
+    assert len(h.find('', limit=2)) == 2
+
+def test_find_indexed():
+    h = history.History()
+    for i in range(100):
+        h.append('value = {}'.format(i))
+    h.find('value')
+
+    index = h._trigrams
+    for _ in range(100):
+        if index.ready:
+            break
+        time.sleep(0.01)
+    assert index.ready
+
+    # appended entries are indexed
+    h.append('value = 1000')
+    assert h.find('1000') == [(100, 'value = 1000')]
+    # terms can appear anywhere, after the entries matching the whole query
+    found = [i for i, _ in h.find('= 5')]
+    assert found[:11] == [59, 58, 57, 56, 55, 54, 53, 52, 51, 50, 5]
+    assert found[11:] == [95, 85, 75, 65, 45, 35, 25, 15]
+
+def test_find_bounded(monkeypatch):
+    monkeypatch.setattr(history, 'SEARCH_SCAN', 10)
+    h = history.History()
+    h.append('needle = 1')
+    for i in range(100):
+        h.append('value = {}'.format(i))
+
+    h.find('value')
+    index = h._trigrams
+    for _ in range(100):
+        if index.ready:
+            break
+        time.sleep(0.01)
+
+    # only the newest entries are scanned until the index is built
+    index._ready = False
+    assert h.find('needle') == []
+    assert [i for i, _ in h.find('value')] == list(range(100, 90, -1))
+
+    index._ready = True
+    assert h.find('needle') == [(0, 'needle = 1')]
+    # fuzzy matches of older entries need the trigrams of every term
+    assert h.find('ndl') == []
+
+def test_score_linear():
+    # a term whose last character is missing is rejected without
+    # backtracking over the earlier ones
+    text = 'e' * 3000
+    start = time.perf_counter()
+    assert history.score(text, 'eeeq') is None
+    assert history.score('ab' * 40, 'abababz') is None
+    assert time.perf_counter() - start < 0.1
+
+    assert history.find_positions('numpy.zeros', 'nzr') == [0, 6, 8]
@@ -0,0 +1,176 @@
+import threading
+
+from telepythy.lib import interpreter
+
+def matches(result):
+    return (result.matches, result.truncated)
+
+def test_complete_globals():
+    inter = interpreter.Interpreter({'alpha': 1, '_alpine': 2})
+    assert matches(inter.complete('al')) == (['all', 'alpha'], False)
+    assert matches(inter.complete('_al')) == (['_alpine'], False)
+
+def test_complete_ranking():
+    inter = interpreter.Interpreter({'_xa': 1, 'xb': 2, 'xa': 3})
+    assert inter.complete('x').matches == ['xa', 'xb']
+    names = inter.complete('', limit=1000).matches
+    assert names.index('xb') < names.index('_xa')
+
+def test_complete_limit():
+    names = dict(('name{}'.format(i), i) for i in range(10))
+    inter = interpreter.Interpreter(names)
+    result = inter.complete('name', limit=3)
+    assert matches(result) == (['name0', 'name1', 'name2'], True)
+
+def test_complete_invalidated():
+    inter = interpreter.Interpreter()
+    assert matches(inter.complete('spam')) == ([], False)
+    inter.evaluate('spam = 1')
+    assert matches(inter.complete('spam')) == (['spam'], False)
+    inter.locals['spammer'] = 2
+    assert matches(inter.complete('spam')) == (['spam', 'spammer'], False)
+
+def test_complete_renamed():
+    inter = interpreter.Interpreter({'spam': 1})
+    assert matches(inter.complete('spa')) == (['spam'], False)
+    # same number of names, but a different set
+    inter.evaluate('del spam; spade = 2')
+    assert matches(inter.complete('spa')) == (['spade'], False)
+
+def test_complete_attributes():
+    inter = interpreter.Interpreter({'value': 'text'})
+    assert inter.complete('value.up').matches == ['upper']
+    assert matches(inter.complete('missing.x')) == ([], False)
+
+class Expensive(object):
+    calls = 0
+
+    def __init__(self):
+        self.value = 'text'
+
+    @property
+    def computed(self):
+        Expensive.calls += 1
+        return 'text'
+
+    def __getattr__(self, name):
+        Expensive.calls += 1
+        return 'text'
+
+def test_complete_static():
+    inter = interpreter.Interpreter({'obj': Expensive()})
+    assert matches(inter.complete('obj.val')) == (['value'], False)
+    assert matches(inter.complete('obj.value.up')) == (['upper'], False)
+    assert matches(inter.complete('obj.computed.up')) == ([], False)
+    assert matches(inter.complete('obj.missing.up')) == ([], False)
+    assert matches(inter.complete('obj.compute().up')) == ([], False)
+    assert Expensive.calls == 0
+
+def test_complete_literals():
+    inter = interpreter.Interpreter()
+    assert matches(inter.complete("'a.b'.spl")) == (['split', 'splitlines'], False)
+    assert matches(inter.complete('[].app')) == (['append'], False)
+
+def test_complete_kinds():
+    inter = interpreter.Interpreter({'obj': Expensive(), 'mod': interpreter})
+    result = inter.complete('obj.')
+    kinds = dict(zip(result.matches, result.kinds))
+    assert kinds['computed'] == 'property'
+    assert kinds['value'] == 'attribute'
+    assert kinds['__class__'] == 'class'
+
+    result = inter.complete('mo')
+    assert dict(zip(result.matches, result.kinds))['mod'] == 'module'
+    assert Expensive.calls == 0
+
+class ExpensiveMeta(type):
+    calls = 0
+
+    def __getattr__(cls, name):
+        ExpensiveMeta.calls += 1
+        raise AttributeError(name)
+
+def test_inspect():
+    # the metaclass syntax differs between python 2 and 3. the class isn't
+    # defined at module level, where pytest would look up its attributes.
+    cls = ExpensiveMeta('ExpensiveClass', (object,), {'__doc__': 'Documented.'})
+    inter = interpreter.Interpreter({'obj': Expensive(), 'cls': cls})
+    details = inter.inspect('len')
+    assert details['kind'] == 'function'
+    assert details['doc']
+    assert inter.inspect('obj.computed') == {'kind': 'property'}
+    assert inter.inspect('while') == {'kind': 'keyword'}
+    assert inter.inspect('obj.missing') is None
+    assert Expensive.calls == 0
+
+    assert inter.inspect('cls') == {'kind': 'class', 'doc': 'Documented.'}
+    assert ExpensiveMeta.calls == 0
+
+def test_input_read():
+    stdin = interpreter.InputIO()
+    stdin.feed('ab')
+    stdin.feed('cdef')
+    assert stdin.read(3) == 'abc'
+    stdin.feed_eof()
+    assert stdin.read(10) == 'def'
+
+    stdin.feed('rest\n')
+    stdin.feed_eof()
+    assert stdin.read() == 'rest\n'
+
+def test_input_readline():
+    stdin = interpreter.InputIO()
+    stdin.feed('one\ntw')
+    stdin.feed('o\nthr')
+    assert stdin.readline() == 'one\n'
+    assert stdin.readline() == 'two\n'
+    assert stdin.readline(2) == 'th'
+    stdin.feed_eof()
+    assert stdin.readline() == 'r'
+
+def test_input_lines():
+    stdin = interpreter.InputIO()
+    stdin.feed('a\nb\n')
+    stdin.feed('c')
+    stdin.feed_eof()
+    assert list(stdin) == ['a\n', 'b\n', 'c']
+
+    stdin.feed('x\ny\n')
+    stdin.feed_eof()
+    assert stdin.readlines() == ['x\n', 'y\n']
+
+def test_input_blocks():
+    stdin = interpreter.InputIO()
+    lines = []
+    reader = threading.Thread(target=lambda: lines.append(stdin.readline()))
+    reader.start()
+    stdin.feed('partial')
+    reader.join(0.05)
+    assert reader.is_alive()
+    stdin.feed(' line\n')
+    reader.join(1)
+    assert lines == ['partial line\n']
+
+def test_input_buffer():
+    stdin = interpreter.InputIO()
+    stdin.feed('café\nbytes')
+    stdin.feed_eof()
+    assert stdin.buffer.readline() == 'café\n'.encode('utf8')
+    assert stdin.buffer.read(2) == b'by'
+    assert stdin.buffer.read() == b'tes'
+
+def test_input_builtin():
+    inter = interpreter.Interpreter()
+    inter.recv_input('hello\n')
+    with inter.hooked():
+        inter.evaluate('line = input()')
+    assert inter.locals['line'] == 'hello'
+
+def test_input_empty_read():
+    stdin = interpreter.InputIO()
+    stdin.feed_eof()
+    assert stdin.read(0) == ''
+    assert stdin.readline(0) == ''
+    assert stdin.read1(0) == ''
+    # EOF is still pending for the next real read
+    assert stdin.readline() == ''
@@ -0,0 +1,55 @@
+import inspect
+import argparse
+import collections
+
+from telepythy.gui import lexer
+
+SOURCE = '''\
+def f(a, *args, b=1, **kwargs):
+    """A docstring
+    on several lines, with a {placeholder}.
+    """
+    s = f'{a!r:>10} {b}' + rb'\\x00' + u"text"
+    t = \'\'\'a triple
+    quoted string\'\'\'
+    return [x @ y for x, y in zip(args, kwargs)]  # comment
+
+class C(object, metaclass=type):
+    @property
+    def value(self) -> int:
+        return 0x1f + 0o7 + 1_000.5e-3j
+'''
+
+def lex_lines(lex, text):
+    """Returns the tokens and the stack after each line of *text*, lexed one
+    line at a time as the highlighter does."""
+    lex.reset()
+    lines = []
+    for line in text.splitlines(True):
+        tokens = list(lex.get_tokens_unprocessed(line))
+        lines.append((tokens, lex.state))
+    return lines
+
+def test_combined_states():
+    combined = lexer.Lexer()
+    rules = lexer.Lexer()
+    # try the rules one by one in every state
+    rules._machines = collections.defaultdict(type(None))
+    assert any(combined._machines.values())
+
+    sources = [SOURCE, inspect.getsource(argparse), inspect.getsource(lexer)]
+    for text in sources:
+        assert lex_lines(combined, text) == lex_lines(rules, text)
+
+def test_state():
+    lex = lexer.Lexer()
+    list(lex.get_tokens_unprocessed('x = """start\n'))
+    state = lex.state
+    assert state is not None and len(state) > 1
+
+    # the state is carried to the next line, and can be restored
+    list(lex.get_tokens_unprocessed('end"""\n'))
+    assert lex.state != state
+    lex.state = state
+    tokens = list(lex.get_tokens_unprocessed('still in the string\n'))
+    assert all('String' in str(token) for _, token, _ in tokens)
@@ -0,0 +1,39 @@
+import sys
+import zipfile
+import subprocess
+
+from telepythy import pack
+
+def run(path, source):
+    return subprocess.check_output([sys.executable, '-c',
+        'import sys; sys.path.insert(0, {!r}); {}'.format(str(path), source)],
+        universal_newlines=True).strip()
+
+def test_pack(tmp_path):
+    path = pack.pack(str(tmp_path / 'service.pyz'))
+    with zipfile.ZipFile(path) as zip:
+        names = zip.namelist()
+    assert 'telepythy/lib/service.py' in names
+    assert 'telepythy/lib/service.pyc' in names
+    assert not any('gui' in name for name in names)
+
+    # the pycs are imported, and the sources are still found for tracebacks
+    assert run(path, 'import telepythy.lib.service as m; print(m.__file__); '
+        'print(m.__loader__.get_source("telepythy.lib.service") is not None)'
+        ).split() == [str(tmp_path / 'service.pyz/telepythy/lib/service.pyc'),
+            'True']
+
+def test_pack_other_version(tmp_path):
+    path = pack.pack(str(tmp_path / 'service.pyz'))
+    other = tmp_path / 'other.pyz'
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(str(other), 'w') as dst:
+        for name in src.namelist():
+            data = src.read(name)
+            if name.endswith('.pyc'):
+                # the magic number of another version
+                data = b'\0\0\r\n' + data[4:]
+            dst.writestr(name, data)
+
+    # modules are imported from the sources instead
+    assert run(other, 'import telepythy.lib.service as m; print(m.__file__)'
+        ) == str(other / 'telepythy/lib/service.py')
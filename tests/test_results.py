@@ -0,0 +1,64 @@
+import pprint
+
+from telepythy.lib import results
+
+def test_preview():
+    preview = results.format_preview({'b': 1, 'a': [1, 2]})
+    assert preview == ("{'b': 1, 'a': [1, 2]}", False, 21)
+
+def test_preview_size():
+    obj = list(range(1000))
+    preview = results.format_preview(obj, size=20)
+    assert preview.truncated
+    assert preview.offset == 20
+    assert pprint.pformat(obj).startswith(preview.text)
+
+def test_preview_timeout():
+    preview = results.format_preview([[1, 2], [3, 4]], timeout=-1)
+    # nothing could be formatted in time
+    assert preview == ('[[1, 2], [3, 4]]', True, 0)
+
+def test_store_limit():
+    namespace = {}
+    store = results.ResultStore(namespace, limit=2)
+    for i in range(4):
+        assert store.add(i) == '{}: {}'.format(i, i)
+    assert sorted(namespace) == ['_', '_2', '_3']
+    assert namespace['_'] == 3
+
+def test_store_reused_name():
+    namespace = {}
+    store = results.ResultStore(namespace, limit=1)
+    store.add('a')
+    namespace['_0'] = 'mine'
+    store.add('b')
+    assert namespace['_0'] == 'mine'
+
+def test_store_pages():
+    store = results.ResultStore({}, preview_size=10)
+    obj = list(range(100))
+    text = pprint.pformat(obj)
+    assert store.add(obj) == '0: {}...'.format(text[:10])
+
+    page = store.page(size=20)
+    assert page == {'id': 0, 'text': text[10:30], 'offset': 10, 'more': True}
+    page = store.page(0, 30, len(text))
+    assert page['text'] == text[30:]
+    assert not page['more']
+
+def test_store_page_bounded():
+    calls = []
+    class Item(object):
+        def __repr__(self):
+            calls.append(self)
+            return 'item'
+
+    store = results.ResultStore({}, preview_size=10)
+    store.add([Item() for _ in range(10000)])
+    del calls[:]
+
+    page = store.page(size=20)
+    assert page['more']
+    assert len(page['text']) == 20
+    # only the items up to the end of the page were formatted
+    assert len(calls) < 100
@@ -0,0 +1,328 @@
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import pytest
+
+from telepythy.lib import sockio
+from telepythy.lib import interpreter
+from telepythy.lib import service
+
+from .conftest import free_port, recv_until, output
+
+def stdout(text):
+    return {'evt': 'stdout', 'data': {'text': text}}
+
+def stderr(text):
+    return {'evt': 'stderr', 'data': {'text': text}}
+
+@pytest.fixture
+def events():
+    return service.EventQueue(flush_latency=0)
+
+def drain(events):
+    items = []
+    while True:
+        try:
+            items.append(events.get(timeout=0))
+        except queue.Empty:
+            return items
+
+def test_coalesce(events):
+    for i in range(3):
+        events.put('stdout', {'text': str(i)})
+        events.put('stdout', {'text': '\n'})
+    assert drain(events) == [stdout('0\n1\n2\n')]
+
+def test_coalesce_streams(events):
+    events.put('stdout', {'text': 'a'})
+    events.put('stdout', {'text': 'b'})
+    events.put('stderr', {'text': 'c'})
+    events.put('stdout', {'text': 'd'})
+    assert drain(events) == [stdout('ab'), stderr('c'), stdout('d')]
+
+def test_coalesce_order(events):
+    events.put('stdout', {'text': 'a'})
+    events.put('done', {})
+    events.put('stdout', {'text': 'b'})
+    assert drain(events) == [
+        stdout('a'), {'evt': 'done', 'data': {}}, stdout('b')]
+
+def test_coalesce_size():
+    events = service.EventQueue(flush_latency=0, flush_size=4)
+    for c in 'abcdef':
+        events.put('stdout', {'text': c})
+    assert drain(events) == [stdout('abcd'), stdout('ef')]
+
+def test_empty(events):
+    with pytest.raises(queue.Empty):
+        events.get(timeout=0)
+
+def test_pool_order():
+    pool = service.WorkerPool(2)
+    done = queue.Queue()
+    for i in range(5):
+        pool.submit('a', lambda i=i: done.put(i))
+    assert [done.get(timeout=1) for _ in range(5)] == list(range(5))
+    pool.stop()
+
+def test_pool_concurrent():
+    pool = service.WorkerPool(2)
+    release = threading.Event()
+    done = queue.Queue()
+    pool.submit('a', lambda: release.wait(1) and done.put('a'))
+    pool.submit('b', lambda: done.put('b'))
+    # 'b' must not wait for the blocked job for 'a'
+    assert done.get(timeout=1) == 'b'
+    release.set()
+    assert done.get(timeout=1) == 'a'
+    pool.stop()
+
+def test_pool_interrupt():
+    pool = service.WorkerPool(1)
+    started = threading.Event()
+    done = queue.Queue()
+
+    def job():
+        started.set()
+        try:
+            while True:
+                threading.Event().wait(0.01)
+        except KeyboardInterrupt:
+            done.put('interrupted')
+
+    pool.submit('a', job)
+    assert started.wait(1)
+    # no job is running for 'b'
+    pool.interrupt('b')
+    pool.interrupt('a')
+    assert done.get(timeout=1) == 'interrupted'
+
+    # the worker is free for the next key
+    pool.submit('b', lambda: done.put('b'))
+    assert done.get(timeout=1) == 'b'
+    pool.stop()
+
+class LateInterruptLock(object):
+    """A lock that raises `KeyboardInterrupt` once it has been acquired,
+    when *armed*, like an interrupt delivered after a job returned."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.armed = False
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self.armed and threading.current_thread().name != 'MainThread':
+            self.armed = False
+            self._lock.release()
+            raise KeyboardInterrupt()
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+def test_pool_late_interrupt():
+    pool = service.WorkerPool(1)
+    pool._lock = lock = LateInterruptLock()
+    done = queue.Queue()
+
+    def job():
+        lock.armed = True
+    pool.submit('a', job)
+    pool.submit('a', lambda: done.put('a'))
+    # the next job for the key still runs
+    assert done.get(timeout=1) == 'a'
+    pool.submit('b', lambda: done.put('b'))
+    assert done.get(timeout=1) == 'b'
+    pool.stop()
+
+def test_overflow_drop():
+    events = service.EventQueue(flush_latency=0, flush_size=2, max_size=4)
+    for c in 'abcdef':
+        events.put('stdout', {'text': c + '\n'})
+    events.put('done', {})
+    assert drain(events) == [
+        {'evt': 'dropped', 'data': {'events': 4, 'lines': 4, 'size': 8}},
+        stdout('e\n'), stdout('f\n'), {'evt': 'done', 'data': {}}]
+
+    stats = events.get_stats()
+    assert stats['dropped_lines'] == 4
+    assert stats['queued'] == 0
+
+def test_overflow_drop_keeps_events():
+    events = service.EventQueue(flush_latency=0, max_events=2)
+    events.put('stdout', {'text': 'a'})
+    events.put('done', {})
+    events.put('stdout', {'text': 'b'})
+    events.put('stdout', {'text': 'c'})
+    items = drain(events)
+    assert items[0]['evt'] == 'dropped'
+    assert items[1:] == [{'evt': 'done', 'data': {}}, stdout('bc')]
+
+def test_overflow_spill():
+    events = service.EventQueue(flush_latency=0, flush_size=2, max_size=2,
+        overflow=service.OVERFLOW_SPILL)
+    for c in 'abcdef':
+        events.put('stderr', {'text': c})
+    assert drain(events) == [stderr('ab'), stderr('cd'), stderr('ef')]
+    assert events.get_stats()['spilled_size'] == 4
+
+def test_overflow_block():
+    events = service.EventQueue(flush_latency=0, max_events=1,
+        overflow=service.OVERFLOW_BLOCK)
+    events.put('stdout', {'text': 'a'})
+    events.put('done', {})
+
+    writer = threading.Thread(target=events.put,
+        args=('stdout', {'text': 'b'}))
+    writer.start()
+    writer.join(0.05)
+    assert writer.is_alive()
+
+    assert drain(events) == [stdout('a'), {'evt': 'done', 'data': {}}]
+    writer.join(1)
+    assert drain(events) == [stdout('b')]
+
+def test_overflow_block_detached():
+    events = service.EventQueue(flush_latency=0, max_events=1,
+        overflow=service.OVERFLOW_BLOCK)
+    events.detach()
+    events.put('stdout', {'text': 'a'})
+    events.put('stderr', {'text': 'b'})
+    assert [e['evt'] for e in drain(events)] == ['dropped', 'stderr']
+
+def test_chunks():
+    events = service.EventQueue(flush_latency=0, chunk_size=4)
+    events.put('stdout', {'text': 'abcdefghij'})
+    events.put('error', {'text': '0123456'})
+    assert drain(events) == [
+        stdout('abcd'), stdout('efgh'), stdout('ij'),
+        {'evt': 'error', 'data': {'text': '0123', 'more': True}},
+        {'evt': 'error', 'data': {'text': '456'}},
+        ]
+
+def test_chunks_spilled():
+    events = service.EventQueue(flush_latency=0, max_size=1, chunk_size=4,
+        overflow=service.OVERFLOW_SPILL)
+    events.put('stdout', {'text': 'a'})
+    events.put('stderr', {'text': 'café au lait'})
+    assert drain(events) == [
+        stdout('a'), stderr('caf'), stderr('é au'), stderr(' lai'),
+        stderr('t')]
+
+## sessions ##
+
+@pytest.fixture
+def server():
+    """Returns a function that starts a server and returns its port.
+
+    The server is started by the test itself, since pytest replaces the
+    standard streams hooked by the service between test phases.
+    """
+    services = []
+
+    def start(**kwargs):
+        port = free_port()
+        svc = service.Server({}, flush_latency=0, **kwargs)
+        svc.start('localhost:{}'.format(port))
+        services.append((svc, svc._thread))
+        # wait for the streams to be hooked
+        while not isinstance(sys.stdout, interpreter.StreamRouter):
+            threading.Event().wait(0.01)
+        return port
+
+    yield start
+    for svc, thread in services:
+        svc.stop()
+        thread.join(5)
+
+class Controller(object):
+    """A minimal controller speaking the wire protocol."""
+    def __init__(self, port):
+        self.sock = sockio.connect(('localhost', port), 1)
+        self.sock.settimeout(5)
+
+    def send(self, cmd, data=None):
+        self.sock.sendmsg({'cmd': cmd, 'data': data})
+
+    def recv_until(self, name):
+        """Returns the events received up to and including *name*."""
+        return recv_until(self.sock, name)
+
+    def evaluate(self, source):
+        self.send('evaluate', {'source': source})
+        return output(self.recv_until('done'))
+
+    def close(self):
+        self.sock.close()
+
+def test_sessions_shared(server):
+    port = server()
+    a = Controller(port)
+    a.recv_until('start')
+    b = Controller(port)
+    b.recv_until('start')
+
+    # output of the service interpreter goes to every session sharing it
+    assert a.evaluate('x = 1; print(x)') == '1\n'
+    assert output(b.recv_until('done')) == '1\n'
+    assert b.evaluate('print(x + 1)') == '2\n'
+    assert output(a.recv_until('done')) == '2\n'
+    a.close()
+    b.close()
+
+def test_sessions_private(server):
+    port = server()
+    a = Controller(port)
+    a.recv_until('start')
+    b = Controller(port)
+    b.recv_until('start')
+
+    a.send('configure', {'namespace': 'private'})
+    assert a.evaluate('x = "private"; print(x)') == 'private\n'
+    assert b.evaluate('print("x" in dir())') == 'False\n'
+    # the shared output was not sent to the private session
+    assert a.evaluate('print(x)') == 'private\n'
+    a.close()
+    b.close()
+
+def test_sessions_backlog(server):
+    port = server()
+    a = Controller(port)
+    a.recv_until('start')
+    a.send('evaluate', {'source': 'import time; time.sleep(0.2); print(1)'})
+    a.close()
+
+    # the output was held until the next session connected
+    b = Controller(port)
+    events = b.recv_until('done')
+    assert output(events) == '1\n'
+    b.close()
+
+def test_sessions_bad_command(server):
+    port = server()
+    a = Controller(port)
+    a.recv_until('start')
+    a.send('configure', {'namespace': 'bogus'})
+    a.send('complete')
+    # the session still handles commands
+    assert a.evaluate('print(1)') == '1\n'
+    a.close()
+
+def test_sessions_result(server):
+    port = server(preview_size=10)
+    a = Controller(port)
+    a.recv_until('start')
+    assert a.evaluate('list(range(100))') == '0: [0,\n 1,\n 2...\n'
+
+    a.send('result', {'offset': None})
+    page = a.recv_until('result')[-1]['data']
+    assert page['id'] == 0
+    assert page['text'].startswith(',\n 3,\n')
+    assert not page['more']
+
+    a.send('result', {'id': 5})
+    assert a.recv_until('result')[-1]['data']['text'] == ''
+    a.close()
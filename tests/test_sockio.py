@@ -0,0 +1,51 @@
+import time
+import threading
+
+from telepythy.lib import sockio
+
+def test_wait_stopped():
+    rsock, wsock = sockio.socketpair()
+    stop = sockio.StopEvent()
+    waiter = sockio.Waiter(rsock, stop)
+
+    threading.Timer(0.05, stop.set).start()
+    start = time.time()
+    assert waiter.wait(5) is False
+    assert time.time() - start < 1
+
+    waiter.close()
+    rsock.close()
+    wsock.close()
+
+def test_wait_readable():
+    rsock, wsock = sockio.socketpair()
+    stop = sockio.StopEvent()
+    waiter = sockio.Waiter(rsock, stop)
+
+    assert waiter.wait(0) is False
+    threading.Timer(0.05, lambda: wsock.send(b'x')).start()
+    assert waiter.wait(5) is True
+
+    waiter.close()
+    rsock.close()
+    wsock.close()
+
+def test_stop_clear():
+    rsock, wsock = sockio.socketpair()
+    stop = sockio.StopEvent()
+    waiter = sockio.Waiter(rsock, stop)
+
+    for _ in range(3):
+        stop.set()
+    stop.clear()
+    # the wakeups were drained, so the waiter sleeps until the timeout
+    start = time.time()
+    assert waiter.wait(0.1) is False
+    assert time.time() - start >= 0.05
+
+    wsock.send(b'x')
+    assert waiter.wait(5) is True
+
+    waiter.close()
+    rsock.close()
+    wsock.close()